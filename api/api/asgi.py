@@ -11,8 +11,6 @@ import os
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
-from chat.middleware import WebSocketConnectionLoggingMiddleware
-import chat.routing
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api.settings')
 
@@ -20,6 +18,10 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api.settings')
 # is populated before importing code that may import ORM models.
 django_asgi_app = get_asgi_application()
 
+from chat.middleware import WebSocketConnectionLoggingMiddleware
+from chat.lifespan import LifespanApp
+import chat.routing
+
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": WebSocketConnectionLoggingMiddleware(
@@ -29,4 +31,5 @@ application = ProtocolTypeRouter({
             )
         )
     ),
+    "lifespan": LifespanApp(),
 })
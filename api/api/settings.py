@@ -76,6 +76,30 @@ TEMPLATES = [
 WSGI_APPLICATION = 'api.wsgi.application'
 ASGI_APPLICATION = 'api.asgi.application'  # Add ASGI application for WebSockets
 
+# Port the ASGI (WebSocket) server listens on, checked by /chat/diagnostics/
+ASGI_PORT = 8001
+
+# Live diagnostics probes time out after DIAGNOSTICS_PROBE_TIMEOUT seconds and
+# their results are reused for DIAGNOSTICS_PROBE_CACHE_TTL seconds
+DIAGNOSTICS_PROBE_TIMEOUT = 1.0
+DIAGNOSTICS_PROBE_CACHE_TTL = 5.0
+
+# Background WebSocket probe for the diagnostics endpoint. Every INTERVAL_MS
+# it connects to ws/probe/ and times the handshake and an echo through the
+# channel layer. MODE 'in_process' runs it against api.asgi.application in
+# this process; 'loopback' connects to URL over TCP instead. ws/probe/ only
+# accepts connections that send TOKEN in an X-Chat-Probe-Token header. Without
+# a TOKEN each process makes up its own, which only its in-process probe
+# knows, so set one for loopback probes.
+DIAGNOSTICS_HANDSHAKE_PROBE = {
+    'ENABLED': True,
+    'MODE': 'in_process',
+    'URL': 'ws://localhost:8001/ws/probe/',
+    'INTERVAL_MS': 30000,
+    'TIMEOUT_MS': 2000,
+    'TOKEN': None,
+}
+
 # Channel layers for WebSockets
 CHANNEL_LAYERS = {
     'default': {
@@ -83,6 +107,178 @@ CHANNEL_LAYERS = {
     },
 }
 
+# To run several ASGI worker processes on one host, share groups between them
+# over a Unix domain socket instead (no Redis needed):
+#
+# CHANNEL_LAYERS = {
+#     'default': {
+#         'BACKEND': 'chat.layers.UnixSocketChannelLayer',
+#         'CONFIG': {
+#             'path': '/tmp/chat-channel-layer.sock',
+#         },
+#     },
+# }
+
+# Write-behind buffer for WebSocket connection logging. Log records are queued
+# in memory and written with bulk_create by a background flusher.
+WEBSOCKET_LOG_BUFFER = {
+    'ENABLED': True,
+    'MAX_SIZE': 10000,  # Maximum number of queued records
+    'BATCH_SIZE': 200,  # Flush once this many records are queued...
+    'FLUSH_INTERVAL_MS': 250,  # ...or once the oldest record is this old
+    'OVERFLOW_POLICY': 'drop',  # 'drop', 'sample' or 'block' when the queue is full
+    'SAMPLE_RATE': 0.1,  # Fraction of records kept by 'sample' once the queue is half full
+}
+
+# How received frames are logged: 'aggregate' keeps per-connection counters
+# written once at disconnect, 'per_frame' also logs a row for every frame
+# (debugging only) and 'sample' logs a row for WEBSOCKET_FRAME_SAMPLE_RATE of frames.
+WEBSOCKET_FRAME_LOGGING = 'aggregate'
+WEBSOCKET_FRAME_SAMPLE_RATE = 0.01
+
+# prune_connection_attempts deletes ConnectionLifecycle and ConnectionAttempt rows older than this.
+# Their counts stay in the statistics rollups.
+CONNECTION_LOG_RETENTION_DAYS = 30
+
+# Chat message persistence. With 'fire_and_forget' and 'batched' durability the
+# broadcast goes out first and messages are written by a group-commit writer
+# shared by all connections; 'batched' waits for the commit before handling
+# the sender's next frame. 'sync' saves each message before broadcasting it.
+CHAT_MESSAGE_PERSISTENCE = {
+    'DURABILITY': 'batched',  # 'fire_and_forget', 'batched' or 'sync'
+    'MAX_SIZE': 10000,
+    'BATCH_SIZE': 100,
+    'FLUSH_INTERVAL_MS': 0,  # 0 writes as soon as the previous batch is committed
+    'OVERFLOW_POLICY': 'block',  # Never drop chat messages
+}
+
+# Chat history API. The newest CACHE_SIZE messages of up to CACHE_ROOMS rooms
+# are kept in memory so the first pages of a room never hit the database.
+CHAT_HISTORY = {
+    'CACHE_SIZE': 100,
+    'CACHE_ROOMS': 1000,
+    'PAGE_SIZE': 50,
+    'MAX_PAGE_SIZE': 200,
+}
+
+# Message sequence numbers and replay. Every chat message gets a sequence
+# number in its room, and the last BUFFER_SIZE messages of up to MAX_ROOMS
+# rooms are kept in memory. Clients reconnecting with ?last_seq=N get the
+# messages they missed, from the database when the gap starts before the
+# buffer. Gaps longer than MAX_DATABASE_MESSAGES aren't replayed; the client
+# is told to reload history instead.
+CHAT_MESSAGE_REPLAY = {
+    'BUFFER_SIZE': 500,
+    'MAX_ROOMS': 1000,
+    'MAX_DATABASE_MESSAGES': 1000,
+}
+
+# Per-room queue of broadcasts waiting to go out through the channel layer.
+# OVERFLOW_POLICY decides what happens once MAX_PENDING are queued:
+#   'block' makes the sender wait up to MAX_WAIT_MS for space, then drops
+#   'drop'  drops the broadcast straight away
+# Either way the sender gets a room_busy error frame for a dropped broadcast.
+CHAT_ROOMS = {
+    'MAX_PENDING': 1000,
+    'OVERFLOW_POLICY': 'block',
+    'MAX_WAIT_MS': 1000,
+}
+
+# Per-connection outbound queue for frames waiting to be sent to a client.
+# POLICY decides what happens when a client can't keep up:
+#   'drop_oldest' discards the oldest queued frame to make room
+#   'coalesce'    replaces a queued frame with the same coalesce key, else drops the oldest
+#   'disconnect'  closes the connection with CLOSE_CODE once the queue is full or
+#                 the oldest frame has waited LAG_THRESHOLD_MS
+CHAT_OUTBOUND_QUEUE = {
+    'MAX_SIZE': 256,                 # Frames queued per connection
+    'POLICY': 'drop_oldest',
+    'LAG_THRESHOLD_MS': 5000,        # Only used by the disconnect policy
+    'CLOSE_CODE': 4008,
+}
+
+# Token-bucket limits on frames clients send, per connection and per client
+# address. Frames over a limit are dropped, delayed until the bucket refills,
+# or the connection is closed with CLOSE_CODE. Set a rate to None to turn
+# that limit off.
+CHAT_RATE_LIMITS = {
+    'ENABLED': True,
+    'ACTION': 'drop',                # 'drop', 'delay' or 'close'
+    'CLOSE_CODE': 4029,
+    'MAX_DELAY_MS': 1000,            # Frames that would wait longer are dropped
+    'CONNECTION': {
+        'MESSAGES_PER_SECOND': 20,
+        'MESSAGE_BURST': 40,
+        'BYTES_PER_SECOND': 64 * 1024,
+        'BYTE_BURST': 1024 * 1024,   # Raised to CHAT_BINARY_PROTOCOL['MAX_MESSAGE_SIZE'] if lower
+    },
+    'IP': {
+        'MESSAGES_PER_SECOND': 100,
+        'MESSAGE_BURST': 200,
+        'BYTES_PER_SECOND': 256 * 1024,
+        'BYTE_BURST': 1024 * 1024,
+    },
+}
+
+# Connection liveness. Clients that connect with ?heartbeat=1 get a
+# {"type": "ping"} frame every HEARTBEAT_INTERVAL_MS, and are closed with
+# CLOSE_CODE once they have sent nothing for IDLE_TIMEOUT_MS. Every
+# SWEEP_INTERVAL_MS a sweeper closes idle connections and drops tracking
+# state for connections that have received nothing for TRACKING_TTL_MS.
+CHAT_CONNECTION_LIVENESS = {
+    'HEARTBEAT_INTERVAL_MS': 20000,
+    'IDLE_TIMEOUT_MS': 60000,
+    'CLOSE_CODE': 4408,
+    'SWEEP_INTERVAL_MS': 10000,
+    'TRACKING_TTL_MS': 24 * 60 * 60 * 1000,
+}
+
+# Upper limits for frame batching. Clients opt in per connection with
+# ?batch_size=N&batch_window_ms=M on the WebSocket URL and then receive an
+# array of messages in every frame.
+CHAT_FRAME_BATCHING = {
+    'MAX_BATCH_SIZE': 100,
+    'MAX_WINDOW_MS': 50,
+}
+
+# Binary chat protocol, for clients that request the chat.msgpack or
+# chat.msgpack+zlib WebSocket subprotocol. JSON clients are unaffected.
+CHAT_BINARY_PROTOCOL = {
+    'COMPRESSION_THRESHOLD': 1024,   # chat.msgpack+zlib compresses frames of at least this many bytes
+    'COMPRESSION_LEVEL': 6,
+    'MAX_MESSAGE_SIZE': 1048576,     # Largest decompressed frame accepted from a client
+}
+
+# Presence. Clients that connect with ?presence=1 get at most one update per
+# room every BROADCAST_INTERVAL_MS listing who came online or went offline.
+# Processes sharing a channel layer also exchange a full snapshot of their
+# connections every SYNC_INTERVAL_MS to repair lost updates.
+CHAT_PRESENCE = {
+    'BROADCAST_INTERVAL_MS': 1000,
+    'SYNC_INTERVAL_MS': 15000,
+}
+
+# Latency tracing. SAMPLE_RATE of chat messages carry monotonic timestamps
+# from receive through persisting, group_send and delivery to each
+# recipient. The time to each stage feeds the
+# chat_message_stage_latency_seconds histogram, and the diagnostics
+# endpoint summarises the last WINDOW samples of each stage.
+CHAT_LATENCY_TRACING = {
+    'SAMPLE_RATE': 0.01,
+    'WINDOW': 1000,
+}
+
+# Rows fetched per database round trip by the streaming export endpoints
+CHAT_EXPORT_CHUNK_SIZE = 2000
+
+# Full-text search over chat messages (chat/search/)
+CHAT_SEARCH = {
+    'PAGE_SIZE': 20,
+    'MAX_PAGE_SIZE': 100,
+    'SNIPPET_MARKERS': ('[', ']'),  # Put around the matching words in snippets
+    'SNIPPET_TOKENS': 12,  # Words of context in each snippet
+}
+
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
@@ -91,9 +287,26 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # WAL lets readers run while the writer thread commits, and
+            # synchronous=NORMAL only syncs the log at checkpoints
+            'init_command': 'PRAGMA journal_mode=WAL;PRAGMA synchronous=NORMAL',
+            # Writers outside the writer thread (admin, management commands)
+            # take the write lock up front and wait up to `timeout` seconds for it
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
+# All database writes made while serving WebSocket connections go through
+# one writer thread (chat/writer.py), which commits everything queued, up to
+# MAX_BATCH operations, in one transaction
+DATABASE_WRITER = {
+    'ENABLED': True,
+    'MAX_BATCH': 500,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import ConnectionAttempt, ChatMessage
+from .models import ConnectionAttempt, ConnectionLifecycle, ChatMessage
+from .search import fts_available, match_expression, matching_ids
 
 # Register your models here.
 @admin.register(ConnectionAttempt)
@@ -18,10 +19,25 @@ class ConnectionAttemptAdmin(admin.ModelAdmin):
         # Don't allow changing connection attempts
         return False
 
+@admin.register(ConnectionLifecycle)
+class ConnectionLifecycleAdmin(admin.ModelAdmin):
+    list_display = ('client_ip', 'outcome', 'timestamp', 'connection_duration_ms', 'close_code', 'user_agent')
+    list_filter = ('outcome', 'successful', 'timestamp')
+    search_fields = ('client_ip', 'user_agent', 'error_message')
+    readonly_fields = ('timestamp',)
+    ordering = ('-timestamp',)
+    
+    def has_add_permission(self, request):
+        # Connections are only recorded by the middleware
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
 @admin.register(ChatMessage)
 class ChatMessageAdmin(admin.ModelAdmin):
-    list_display = ('username', 'short_message', 'timestamp')
-    list_filter = ('timestamp', 'username')
+    list_display = ('room', 'username', 'short_message', 'timestamp')
+    list_filter = ('timestamp', 'room', 'username')
     search_fields = ('username', 'message')
     readonly_fields = ('timestamp',)
     ordering = ('-timestamp',)
@@ -29,3 +45,9 @@ class ChatMessageAdmin(admin.ModelAdmin):
     def short_message(self, obj):
         return obj.message[:50] + ('...' if len(obj.message) > 50 else '')
     short_message.short_description = 'Message'
+
+    def get_search_results(self, request, queryset, search_term):
+        # Use the full-text index when there is one instead of LIKE scans
+        if not match_expression(search_term) or not fts_available(queryset.db):
+            return super().get_search_results(request, queryset, search_term)
+        return queryset.filter(id__in=matching_ids(search_term)), False
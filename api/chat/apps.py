@@ -1,5 +1,11 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        from .search import forget_fts_available
+        # Migrating creates or drops the search index, so check for it again
+        post_migrate.connect(forget_fts_available, sender=self)
@@ -0,0 +1,235 @@
+import asyncio
+import base64
+import json
+import os
+import secrets
+import time
+from urllib.parse import urlsplit
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.db import transaction
+
+# Sent by benchmark clients, so the connections they log can be removed afterwards
+BENCHMARK_USER_AGENT = 'chat-benchmark'
+BENCHMARK_HEADERS = [(b'user-agent', BENCHMARK_USER_AGENT.encode('ascii'))]
+# Messages deleted per query, below SQLite's limit on query parameters
+DELETE_CHUNK_SIZE = 500
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def latency_summary(latencies_ms):
+    """Summarise a list of latencies in milliseconds"""
+    if not latencies_ms:
+        return {'count': 0}
+    return {
+        'count': len(latencies_ms),
+        'mean': round(sum(latencies_ms) / len(latencies_ms), 3),
+        'p50': round(percentile(latencies_ms, 50), 3),
+        'p95': round(percentile(latencies_ms, 95), 3),
+        'p99': round(percentile(latencies_ms, 99), 3),
+        'max': round(max(latencies_ms), 3),
+    }
+
+
+def chat_application():
+    """Return the chat WebSocket routes without the logging middleware"""
+    import chat.routing
+    return URLRouter(chat.routing.websocket_urlpatterns)
+
+
+def delete_benchmark_connections():
+    """
+    Delete the connection log rows of benchmark clients and take them back
+    out of the connection statistics. Returns the number of rows deleted.
+    """
+    from .models import ConnectionAttempt, ConnectionLifecycle, ConnectionStatsRollup
+    with transaction.atomic():
+        lifecycles = list(
+            ConnectionLifecycle.objects.filter(user_agent=BENCHMARK_USER_AGENT)
+            .only('timestamp', 'successful', 'error_message', 'connection_duration_ms')
+        )
+        ConnectionStatsRollup.remove(lifecycles)
+        ConnectionLifecycle.objects.filter(id__in=[lifecycle.id for lifecycle in lifecycles]).delete()
+        attempts, _ = ConnectionAttempt.objects.filter(user_agent=BENCHMARK_USER_AGENT).delete()
+    return len(lifecycles) + attempts
+
+
+def benchmark_room(prefix):
+    """A room of its own for one benchmark run, so it never shares a room with real messages"""
+    return f"{prefix}-{secrets.token_hex(4)}"
+
+
+def delete_benchmark_messages(room, seqs):
+    """
+    Delete the messages a benchmark run sent to ``room``, given the sequence
+    numbers it saw them come back with. Returns the number of rows deleted.
+    """
+    from .models import ChatMessage
+    seqs = sorted(seq for seq in seqs if seq is not None)
+    deleted = 0
+    for start in range(0, len(seqs), DELETE_CHUNK_SIZE):
+        count, _ = ChatMessage.objects.filter(room=room, seq__in=seqs[start:start + DELETE_CHUNK_SIZE]).delete()
+        deleted += count
+    return deleted
+
+
+async def connect_clients(application, path, count):
+    """Connect ``count`` in-process WebSocket clients to ``path``"""
+    clients = []
+    for _ in range(count):
+        client = WebsocketCommunicator(application, path)
+        connected, _ = await client.connect()
+        if not connected:
+            raise RuntimeError(f"Could not connect to {path}")
+        clients.append(client)
+    return clients
+
+
+async def disconnect_clients(clients):
+    await asyncio.gather(*(client.disconnect() for client in clients))
+
+
+async def measure_broadcasts(sender, listeners, messages, timeout=10, seqs=None):
+    """
+    Send ``messages`` chat messages from ``sender`` and time delivery to
+    every listener. Returns one latency in milliseconds per delivery. The
+    sequence numbers of the sent messages are added to the set ``seqs``
+    if one is given.
+    """
+    latencies = []
+
+    async def receive(client, sent_at):
+        frame = await client.receive_from(timeout)
+        latencies.append((time.perf_counter() - sent_at) * 1000)
+        if seqs is not None and client is sender:
+            seqs.add(json.loads(frame).get('seq'))
+
+    for i in range(messages):
+        sent_at = time.perf_counter()
+        await sender.send_json_to({"message": f"bench {i}", "username": "chatbench"})
+        await asyncio.gather(*(receive(client, sent_at) for client in listeners))
+    return latencies
+
+
+class InProcessClient:
+    """Benchmark client connected to an ASGI application in this process"""
+
+    def __init__(self, communicator):
+        self.communicator = communicator
+
+    @classmethod
+    async def connect(cls, application, path, timeout=1, headers=None):
+        communicator = WebsocketCommunicator(application, path, headers)
+        connected, _ = await communicator.connect(timeout)
+        if not connected:
+            raise RuntimeError(f"Could not connect to {path}")
+        return cls(communicator)
+
+    async def send_text(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def receive_text(self, timeout):
+        return await self.communicator.receive_from(timeout)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+def mask_payload(payload, mask):
+    """XOR a client frame payload with its 4-byte mask"""
+    repeated = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(len(payload), 'big')
+
+
+class LoopbackClient:
+    """
+    Minimal WebSocket client for benchmarking a running server.
+
+    Speaks just enough of RFC 6455 to exchange unfragmented text frames
+    without extensions, which keeps client overhead out of the numbers.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, url, headers=None):
+        parts = urlsplit(url)
+        reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        writer.write((
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {parts.netloc}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n"
+            f"Origin: http://{parts.netloc}\r\n"
+            + "".join(f"{name.decode('latin-1')}: {value.decode('latin-1')}\r\n" for name, value in headers or [])
+            + "\r\n"
+        ).encode('ascii'))
+        response = await reader.readuntil(b"\r\n\r\n")
+        if not response.startswith(b"HTTP/1.1 101"):
+            writer.close()
+            status = response.split(b"\r\n", 1)[0].decode('latin-1')
+            raise RuntimeError(f"Could not connect to {url}: {status}")
+        return cls(reader, writer)
+
+    async def send_frame(self, opcode, payload):
+        length = len(payload)
+        header = bytearray([0x80 | opcode])
+        if length < 126:
+            header.append(0x80 | length)
+        elif length < 65536:
+            header.append(0x80 | 126)
+            header += length.to_bytes(2, 'big')
+        else:
+            header.append(0x80 | 127)
+            header += length.to_bytes(8, 'big')
+        mask = os.urandom(4)
+        self.writer.write(bytes(header) + mask + mask_payload(payload, mask))
+        await self.writer.drain()
+
+    async def send_text(self, text):
+        await self.send_frame(0x1, text.encode('utf-8'))
+
+    async def read_frame(self):
+        first, second = await self.reader.readexactly(2)
+        length = second & 0x7F
+        if length == 126:
+            length = int.from_bytes(await self.reader.readexactly(2), 'big')
+        elif length == 127:
+            length = int.from_bytes(await self.reader.readexactly(8), 'big')
+        # Server frames are never masked
+        return first & 0x0F, await self.reader.readexactly(length)
+
+    async def receive_text(self, timeout):
+        async def receive():
+            while True:
+                opcode, payload = await self.read_frame()
+                if opcode in (0x1, 0x2):
+                    return payload.decode('utf-8')
+                if opcode == 0x8:
+                    raise ConnectionError("Server closed the connection")
+                if opcode == 0x9:
+                    await self.send_frame(0xA, payload)
+
+        return await asyncio.wait_for(receive(), timeout)
+
+    async def close(self):
+        try:
+            await self.send_frame(0x8, (1000).to_bytes(2, 'big'))
+        except ConnectionError:
+            pass
+        self.writer.close()
@@ -0,0 +1,350 @@
+import asyncio
+import atexit
+import collections
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .metrics import DB_ROWS_WRITTEN, DB_WRITE_DURATION
+from .writer import db_writer
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_DROP = 'drop'
+OVERFLOW_SAMPLE = 'sample'
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_SAMPLE, OVERFLOW_BLOCK)
+
+# Every buffer created in this process, so they can all be flushed on shutdown
+_buffers = []
+
+
+class WriteBehindBuffer:
+    """
+    Bounded in-process queue of unsaved model instances.
+
+    Instances are written by a background flusher with ``bulk_create`` once
+    ``batch_size`` rows are pending or ``flush_interval_ms`` has passed since
+    the oldest pending row was queued, whichever comes first. With an
+    interval of 0 the flusher writes as soon as it is idle, so rows that
+    arrive while a write is in progress are committed together. When the queue
+    is full the overflow policy decides what happens to new rows:
+
+    - ``drop``: discard the new row
+    - ``sample``: once the queue is past ``sample_threshold``, keep only a
+      ``sample_rate`` fraction of new rows, and drop them when full
+    - ``block``: wait for the flusher to make room
+    """
+
+    def __init__(self, model, enabled=True, max_size=10000, batch_size=200,
+                 flush_interval_ms=250, overflow_policy=OVERFLOW_DROP,
+                 sample_rate=0.1, sample_threshold=0.5, on_write=None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Unknown overflow policy {overflow_policy!r}, "
+                f"expected one of {', '.join(OVERFLOW_POLICIES)}"
+            )
+        self.model = model
+        self.enabled = enabled
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.overflow_policy = overflow_policy
+        self.sample_rate = sample_rate
+        self.sample_threshold = int(max_size * sample_threshold)
+        # Called with the list of instances after each successful write
+        self.on_write = on_write
+
+        self._pending = collections.deque()
+        # The batch the flusher is writing
+        self._writing = ()
+        self._loop = None
+        self._flusher = None
+        self._wakeup = None
+        self._space = None
+        self._closing = False
+
+        # Counters
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.flushes = 0
+        self.write_errors = 0
+
+        _buffers.append(self)
+
+    async def enqueue(self, instance, wait=False):
+        """
+        Queue an unsaved model instance for writing.
+
+        Returns True if the instance was accepted, False if the overflow
+        policy discarded it. With ``wait=True`` this only returns once the
+        batch containing the instance has been committed, and returns False
+        if that write failed.
+        """
+        if not self.enabled:
+            return await self._write([(instance, None)])
+
+        self._ensure_started()
+        pending = self._pending
+
+        if len(pending) >= self.max_size:
+            if self.overflow_policy != OVERFLOW_BLOCK:
+                self.dropped += 1
+                return False
+            while len(pending) >= self.max_size:
+                self._space.clear()
+                await self._space.wait()
+        elif (self.overflow_policy == OVERFLOW_SAMPLE
+              and len(pending) >= self.sample_threshold
+              and random.random() >= self.sample_rate):
+            self.sampled_out += 1
+            return False
+
+        waiter = self._loop.create_future() if wait else None
+        pending.append((instance, waiter))
+        self.enqueued += 1
+        if len(pending) == 1 or len(pending) >= self.batch_size:
+            self._wakeup.set()
+        if waiter is not None:
+            return await waiter
+        return True
+
+    def _ensure_started(self):
+        """Start the flusher on the running event loop if it isn't already"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and not self._flusher.done():
+            return
+        # Events are bound to the loop that first waits on them, so a new
+        # loop (e.g. one created by async_to_sync) gets its own set. Rows
+        # queued under a previous loop stay pending and are flushed here.
+        self._loop = loop
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._flusher = loop.create_task(self._run())
+
+    async def _run(self):
+        pending = self._pending
+        while True:
+            if not pending:
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            if len(pending) < self.batch_size and self.flush_interval > 0 and not self._closing:
+                # Give the batch a chance to fill up
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            batch = [pending.popleft() for _ in range(min(self.batch_size, len(pending)))]
+            self._space.set()
+            self._writing = batch
+            try:
+                await self._write(batch)
+            finally:
+                self._writing = ()
+
+    async def _write(self, batch):
+        try:
+            return await db_writer.run(self._write_sync, batch)
+        except Exception:
+            # The transaction around the write failed to commit
+            self.write_errors += len(batch)
+            logger.exception("Failed to commit %d %s rows", len(batch), self.model.__name__)
+            self._resolve_all(batch, False)
+            return False
+
+    def _write_sync(self, batch):
+        """
+        Write a batch of (instance, waiter) pairs and resolve the waiters.
+
+        On the database writer thread this runs inside a larger
+        transaction, so the waiters and ``on_write`` are only called once
+        that commits.
+        """
+        instances = [instance for instance, _ in batch]
+        model_name = self.model.__name__
+        try:
+            started = time.perf_counter()
+            try:
+                with transaction.atomic():
+                    self.model.objects.bulk_create(instances, batch_size=self.batch_size)
+            except IntegrityError:
+                # One conflicting row mustn't lose the rest of the batch
+                batch = self._write_each(batch)
+                instances = [instance for instance, _ in batch]
+            DB_WRITE_DURATION.labels(model_name).observe(time.perf_counter() - started)
+        except Exception:
+            self.write_errors += len(batch)
+            logger.exception("Failed to write %d %s rows", len(batch), model_name)
+            self._resolve_all(batch, False)
+            return False
+
+        def committed():
+            DB_ROWS_WRITTEN.labels(model_name).inc(len(instances))
+            self.written += len(batch)
+            self.flushes += 1
+            if self.on_write is not None:
+                self.on_write(instances)
+            self._resolve_all(batch, True)
+
+        transaction.on_commit(committed)
+        return True
+
+    def _write_each(self, batch):
+        """Insert a batch row by row, returning the pairs that were written"""
+        written = []
+        for instance, waiter in batch:
+            try:
+                with transaction.atomic():
+                    instance.save(force_insert=True)
+            except IntegrityError:
+                self.write_errors += 1
+                logger.exception("Failed to write %s row", self.model.__name__)
+                if waiter is not None:
+                    self._resolve(waiter, False)
+            else:
+                written.append((instance, waiter))
+        return written
+
+    def _resolve_all(self, batch, result):
+        for _, waiter in batch:
+            if waiter is not None:
+                self._resolve(waiter, result)
+
+    @staticmethod
+    def _resolve(waiter, result):
+        loop = waiter.get_loop()
+        if loop.is_closed():
+            return
+        loop.call_soon_threadsafe(
+            lambda: waiter.done() or waiter.set_result(result)
+        )
+
+    async def close(self):
+        """Stop the flusher once everything queued has been written"""
+        if self._flusher is None or self._flusher.done():
+            await db_writer.run(self.flush_sync)
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._flusher
+
+    def flush_sync(self):
+        """Write everything still queued from synchronous code (e.g. at exit)"""
+        while self._pending:
+            batch = [self._pending.popleft()
+                     for _ in range(min(self.batch_size, len(self._pending)))]
+            self._write_sync(batch)
+
+    def unsaved(self):
+        """Instances queued or being written, but not yet committed"""
+        return [instance for instance, _ in self._writing] + [instance for instance, _ in self._pending]
+
+    def stats(self):
+        """Return queue depth and counters"""
+        return {
+            'queue_depth': len(self._pending),
+            'max_size': self.max_size,
+            'overflow_policy': self.overflow_policy,
+            'enqueued': self.enqueued,
+            'written': self.written,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out,
+            'flushes': self.flushes,
+            'write_errors': self.write_errors,
+        }
+
+
+def buffer_from_settings(model, setting_name, on_write=None):
+    """Build a WriteBehindBuffer for ``model`` configured by a settings dict"""
+    options = getattr(settings, setting_name, {})
+    return WriteBehindBuffer(
+        model,
+        enabled=options.get('ENABLED', True),
+        max_size=options.get('MAX_SIZE', 10000),
+        batch_size=options.get('BATCH_SIZE', 200),
+        flush_interval_ms=options.get('FLUSH_INTERVAL_MS', 250),
+        overflow_policy=options.get('OVERFLOW_POLICY', OVERFLOW_DROP),
+        sample_rate=options.get('SAMPLE_RATE', 0.1),
+        on_write=on_write,
+    )
+
+
+DURABILITY_FIRE_AND_FORGET = 'fire_and_forget'
+DURABILITY_BATCHED = 'batched'
+DURABILITY_SYNC = 'sync'
+DURABILITY_LEVELS = (DURABILITY_FIRE_AND_FORGET, DURABILITY_BATCHED, DURABILITY_SYNC)
+
+
+def get_persistence_durability():
+    """Return the configured chat message durability level"""
+    durability = getattr(settings, 'CHAT_MESSAGE_PERSISTENCE', {}).get('DURABILITY', DURABILITY_BATCHED)
+    if durability not in DURABILITY_LEVELS:
+        raise ValueError(
+            f"Unknown chat message durability {durability!r}, "
+            f"expected one of {', '.join(DURABILITY_LEVELS)}"
+        )
+    return durability
+
+
+_connection_log_buffer = None
+_frame_log_buffer = None
+_chat_message_buffer = None
+
+
+def get_connection_log_buffer():
+    """Return the process-wide buffer for ConnectionLifecycle rows"""
+    global _connection_log_buffer
+    if _connection_log_buffer is None:
+        from .models import ConnectionLifecycle
+        _connection_log_buffer = buffer_from_settings(ConnectionLifecycle, 'WEBSOCKET_LOG_BUFFER')
+    return _connection_log_buffer
+
+
+def get_frame_log_buffer():
+    """Return the process-wide buffer for per-frame ConnectionAttempt rows"""
+    global _frame_log_buffer
+    if _frame_log_buffer is None:
+        from .models import ConnectionAttempt
+        _frame_log_buffer = buffer_from_settings(ConnectionAttempt, 'WEBSOCKET_LOG_BUFFER')
+    return _frame_log_buffer
+
+
+def get_chat_message_buffer():
+    """Return the process-wide group-commit writer for ChatMessage rows"""
+    global _chat_message_buffer
+    if _chat_message_buffer is None:
+        from .history import recent_messages
+        from .models import ChatMessage
+        _chat_message_buffer = buffer_from_settings(
+            ChatMessage, 'CHAT_MESSAGE_PERSISTENCE', on_write=recent_messages.add
+        )
+    return _chat_message_buffer
+
+
+async def close_buffers():
+    """Flush and stop every buffer in this process"""
+    for buffer in list(_buffers):
+        await buffer.close()
+
+
+@atexit.register
+def _flush_buffers_at_exit():
+    # Servers that don't send ASGI lifespan events (e.g. daphne) still get
+    # their queued rows written when the interpreter exits.
+    for buffer in _buffers:
+        try:
+            buffer.flush_sync()
+        except Exception:
+            logger.exception("Failed to flush %s buffer at exit", buffer.model.__name__)
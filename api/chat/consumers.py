@@ -1,69 +1,100 @@
-import json
+import asyncio
+import time
 from channels.generic.websocket import AsyncWebsocketConsumer
 from datetime import datetime
-from channels.db import database_sync_to_async
-from .models import ConnectionAttempt, ChatMessage
-import traceback
+from django.db import transaction
+from .buffers import (
+    DURABILITY_BATCHED,
+    DURABILITY_SYNC,
+    get_chat_message_buffer,
+    get_persistence_durability,
+)
+from .diagnostics import has_probe_token
+from .history import recent_messages
+from .liveness import SCOPE_KEY, liveness_settings, wants_heartbeat
+from .metrics import DB_ROWS_WRITTEN, DB_WRITE_DURATION, RECEIVE_DURATION
+from .models import ChatMessage
+from .outbound import OutboundQueue, frame_batching, outbound_settings
+from .presence import connection_options, presence_group, presence_registry
+from .protocol import ProtocolError, encode_chat_event, encode_event, negotiate
+from .replay import message_sequencer, resume_from
+from .rooms import DEFAULT_ROOM, room_registry
+from .tracing import STAGE_DELIVERED, STAGE_PERSISTED, TRACE_KEY, latency_tracer
+from .writer import write_operation
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
-        self.room_name = "chat_room"
+        # ws/chat/<room>/ joins that room, plain ws/chat/ joins the default one
+        self.room_name = self.scope.get("url_route", {}).get("kwargs", {}).get("room_name", DEFAULT_ROOM)
         self.room_group_name = f"chat_{self.room_name}"
         
-        try:
-            # Log connection attempt
-            headers = dict(self.scope.get('headers', []))
-            user_agent = headers.get(b'user-agent', b'').decode('utf-8', 'ignore')
-            client_ip = self.get_client_ip()
-            
-            # Store connection attempt asynchronously
-            await self.log_connection_attempt(client_ip, user_agent, True)
-
-            # Join room group
-            await self.channel_layer.group_add(
-                self.room_group_name,
-                self.channel_name
-            )
+        # Join room group. The middleware records the connection, including
+        # any error raised here.
+        await self.channel_layer.group_add(
+            self.room_group_name,
+            self.channel_name
+        )
+        self.room = room_registry.join(
+            self.room_name,
+            self.room_group_name,
+            self.channel_layer,
+            self.channel_name
+        )
 
-            await self.accept()
-        except Exception as e:
-            # Log failed connection attempt with error
-            error_message = f"{str(e)}\n{traceback.format_exc()}"
-            client_ip = self.get_client_ip()
-            await self.log_connection_attempt(client_ip, "", False, error_message)
-            # Re-raise to properly close connection with an error
-            raise
-
-    def get_client_ip(self):
-        """Extract client IP from scope"""
-        client = self.scope.get('client', None)
-        if client:
-            return client[0]
-        
-        # Fallback to headers if client not in scope
-        headers = dict(self.scope.get('headers', []))
-        x_forwarded_for = headers.get(b'x-forwarded-for', b'').decode('utf-8', 'ignore')
-        if x_forwarded_for:
-            return x_forwarded_for.split(',')[0].strip()
-        return None
-
-    @database_sync_to_async
-    def log_connection_attempt(self, client_ip, user_agent, successful, error_message=None):
-        """Log a connection attempt to the database"""
-        ConnectionAttempt.objects.create(
-            client_ip=client_ip,
-            user_agent=user_agent,
-            successful=successful,
-            error_message=error_message
+        # Track who is online, and send presence updates to clients that asked
+        self.username, self.presence_updates = connection_options(self.scope)
+        if self.presence_updates:
+            await self.channel_layer.group_add(presence_group(self.room_name), self.channel_name)
+        presence_registry.join(self.room_name, self.channel_name, self.username, self.channel_layer)
+
+        # JSON text frames unless the client asked for a binary subprotocol
+        self.protocol = negotiate(self.scope.get("subprotocols", []))
+
+        # Frames for this client go through a bounded queue so a slow
+        # client can't stall the channel layer or its room. Clients that
+        # asked for batching get several messages per frame.
+        outbound_config = outbound_settings()
+        batch_size, batch_window_ms = frame_batching(self.scope)
+        self.batching = batch_size > 1
+        self.close_code_on_lag = outbound_config['close_code']
+        self.outbound = OutboundQueue(
+            self.send_frame,
+            on_lag=self.close_slow_consumer,
+            name=self.channel_name,
+            max_size=outbound_config['max_size'],
+            policy=outbound_config['policy'],
+            lag_threshold_ms=outbound_config['lag_threshold_ms'],
+            batch_size=batch_size,
+            batch_window_ms=batch_window_ms,
+            join=self.protocol.join,
         )
 
-    @database_sync_to_async
-    def save_chat_message(self, username, message):
+        await self.accept(subprotocol=self.protocol.subprotocol)
+
+        # Clients that asked for heartbeats get a ping every interval and
+        # are closed once they stop sending anything back
+        if wants_heartbeat(self.scope):
+            self.start_heartbeat()
+
+        # Reconnecting clients that send ?last_seq=N get only what they missed
+        self.replayed = set()
+        last_seq = resume_from(self.scope)
+        if last_seq is not None:
+            await self.replay_missed(last_seq)
+
+    @write_operation
+    def save_chat_message(self, username, message, seq=None):
         """Save a chat message to the database"""
-        ChatMessage.objects.create(
+        started = time.perf_counter()
+        chat_message = ChatMessage.objects.create(
+            room=self.room_name,
             username=username,
-            message=message
+            message=message,
+            seq=seq
         )
+        DB_WRITE_DURATION.labels('ChatMessage').observe(time.perf_counter() - started)
+        DB_ROWS_WRITTEN.labels('ChatMessage').inc()
+        transaction.on_commit(lambda: recent_messages.add([chat_message]))
 
     async def disconnect(self, close_code):
         # Leave room group
@@ -71,37 +102,176 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        room_registry.leave(self.room_name, self.channel_name)
+        presence_registry.leave(self.room_name, self.channel_name)
+        if getattr(self, 'presence_updates', False):
+            await self.channel_layer.group_discard(presence_group(self.room_name), self.channel_name)
+        if getattr(self, 'outbound', None) is not None:
+            await self.outbound.aclose()
+        if getattr(self, 'heartbeat', None) is not None:
+            self.heartbeat.cancel()
 
     # Receive message from WebSocket
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json["message"]
-        username = text_data_json.get("username", "Anonymous")
+    async def receive(self, text_data=None, bytes_data=None):
+        started = time.perf_counter()
+        # Traced messages count from here, so decoding is part of their latency
+        received_at = time.monotonic()
+        try:
+            try:
+                data = self.protocol.decode(text_data=text_data, bytes_data=bytes_data)
+            except ProtocolError:
+                # 1007: the frame's data doesn't match the negotiated protocol
+                await self.close(code=1007)
+                return
+            if isinstance(data, dict) and data.get("type") in ("ping", "pong"):
+                # Heartbeats are never broadcast. Receiving one is enough to
+                # keep the connection from being reaped as idle.
+                if data["type"] == "ping":
+                    self.queue_event(encode_event("heartbeat", {"type": "pong", "timestamp": time.time()}))
+                return
+            await self.handle_chat_message(data, received_at)
+        finally:
+            RECEIVE_DURATION.observe(time.perf_counter() - started)
+
+    async def handle_chat_message(self, data, received_at=None):
+        # A sample of messages carry monotonic timestamps through the broadcast path
+        trace = latency_tracer.start(received_at)
+        message = data["message"]
+        username = data.get("username", "Anonymous")
         timestamp = datetime.now().strftime("%H:%M:%S")
+        seq = await message_sequencer.next(self.room_name)
 
-        # Save message to database
-        await self.save_chat_message(username, message)
+        # Encode the outgoing frame once here, so every member of the group
+        # sends the same string (or the same cached binary encoding of it)
+        # instead of re-serializing the message
+        event = encode_chat_event(message, username, timestamp, seq)
+        if trace is not None:
+            event[TRACE_KEY] = trace
+        durability = get_persistence_durability()
 
-        # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "chat_message",
-                "message": message,
-                "username": username,
-                "timestamp": timestamp
-            }
-        )
+        if durability == DURABILITY_SYNC:
+            # Save message to database before anyone sees it
+            await self.save_chat_message(username, message, seq)
+            latency_tracer.mark(trace, STAGE_PERSISTED)
+
+        # Keep it for clients that reconnect, then queue the broadcast on
+        # this room's own fan-out. If the queue stays full the broadcast is
+        # dropped and the sender told so; the message is still saved and
+        # replayed to clients that reconnect.
+        message_sequencer.record(self.room_name, event)
+        if not await self.room.publish(event):
+            self.queue_event(encode_event("error", {
+                "type": "error",
+                "error": "room_busy",
+                "seq": seq,
+            }))
+
+        if durability != DURABILITY_SYNC:
+            # Persist through the group-commit writer once the broadcast is queued.
+            # 'batched' waits for the batch to commit before this consumer
+            # handles its next event, 'fire_and_forget' does not.
+            saved = await get_chat_message_buffer().enqueue(
+                ChatMessage(room=self.room_name, username=username, message=message, seq=seq),
+                wait=(durability == DURABILITY_BATCHED)
+            )
+            if saved and durability == DURABILITY_BATCHED:
+                latency_tracer.mark(trace, STAGE_PERSISTED)
 
     # Receive message from room group
     async def chat_message(self, event):
-        message = event["message"]
-        username = event["username"]
-        timestamp = event["timestamp"]
-
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            "message": message,
-            "username": username,
-            "timestamp": timestamp
-        }))
\ No newline at end of file
+        latency_tracer.mark(event.get(TRACE_KEY), STAGE_DELIVERED)
+        seq = event.get("seq")
+        if seq is not None:
+            # Messages from other workers move this worker's counter forward
+            message_sequencer.record(self.room_name, event)
+            if seq in self.replayed:
+                # Already sent to this client by replay_missed
+                self.replayed.discard(seq)
+                return
+        self.queue_event(event)
+
+    # Receive a presence update for the room
+    async def presence_update(self, event):
+        self.queue_event(event)
+
+    async def replay_missed(self, last_seq):
+        """
+        Send the room's messages numbered after ``last_seq``, then a replay
+        frame saying where they came from and the room's latest sequence
+        number. When the client can't be caught up, because the gap is too
+        long or ``last_seq`` is ahead of the room, the frame says so with
+        ``complete: false`` and the client should reload the room's history.
+        """
+        events, source, complete, current = await message_sequencer.missed(self.room_name, last_seq)
+        for event in events:
+            self.queue_event(event)
+        # Live copies of these may still be on their way; skip them by number
+        self.replayed = {event["seq"] for event in events}
+        self.queue_event(encode_event("replay", {
+            "type": "replay",
+            "last_seq": current,
+            "replayed": len(events),
+            "source": source,
+            "complete": complete,
+        }))
+
+    def queue_event(self, event):
+        # Queue the encoded frame in this client's protocol. Events
+        # carrying a coalesce_key replace an unsent frame with the same key
+        # under the coalesce policy.
+        if self.batching:
+            frame = self.protocol.element(event)
+        else:
+            frame = self.protocol.frame(event)
+        self.outbound.put(frame, key=event.get("coalesce_key"))
+
+    async def send_frame(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    def start_heartbeat(self):
+        config = liveness_settings()
+        self.idle_close_code = config['close_code']
+        tracked = self.scope.get(SCOPE_KEY)
+        if tracked is not None:
+            tracked.watch_idle(config['idle_timeout'], self.close_idle)
+        self.heartbeat = asyncio.ensure_future(self.send_heartbeats(config['heartbeat_interval']))
+
+    async def send_heartbeats(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.queue_event(encode_event("heartbeat", {"type": "ping", "timestamp": time.time()}))
+
+    async def close_idle(self):
+        """Close a heartbeat connection that stopped answering"""
+        await self.close(code=self.idle_close_code)
+
+    async def close_slow_consumer(self):
+        """Close a connection that fell behind under the disconnect policy"""
+        await self.close(code=self.close_code_on_lag)
+
+
+class ProbeConsumer(AsyncWebsocketConsumer):
+    """
+    Echo endpoint for the diagnostics handshake probe. Text frames are sent
+    back through the channel layer, so a round trip covers the ASGI stack
+    and the layer.
+
+    Only connections that send the probe token may connect: the in-process
+    probe, and loopback probes once DIAGNOSTICS_HANDSHAKE_PROBE['TOKEN'] is
+    set.
+    """
+    async def connect(self):
+        if has_probe_token(self.scope):
+            await self.accept()
+        else:
+            await self.close()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if text_data is not None:
+            await self.channel_layer.send(self.channel_name, {"type": "probe.echo", "text": text_data})
+
+    async def probe_echo(self, event):
+        await self.send(text_data=event["text"])
@@ -0,0 +1,323 @@
+import asyncio
+import hmac
+import logging
+import secrets
+import time
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+PROBE_GROUP = "diagnostics_probe"
+
+# How the handshake probe reaches the server
+PROBE_MODE_IN_PROCESS = 'in_process'
+PROBE_MODE_LOOPBACK = 'loopback'
+PROBE_MODES = (PROBE_MODE_IN_PROCESS, PROBE_MODE_LOOPBACK)
+
+PROBE_USER_AGENT = b'chat-diagnostics-probe'
+
+# Routed to ProbeConsumer. Connections to it aren't logged or counted.
+PROBE_PATH = '/ws/probe/'
+
+# Connections to the probe endpoint must send the probe token in this header
+PROBE_TOKEN_HEADER = b'x-chat-probe-token'
+# Used when DIAGNOSTICS_HANDSHAKE_PROBE has no TOKEN, so only the
+# in-process probe knows it
+_process_probe_token = secrets.token_urlsafe(32)
+
+
+def probe_token():
+    """The shared token the probe endpoint asks for"""
+    return getattr(settings, 'DIAGNOSTICS_HANDSHAKE_PROBE', {}).get('TOKEN') or _process_probe_token
+
+
+def probe_headers():
+    return [(b'user-agent', PROBE_USER_AGENT), (PROBE_TOKEN_HEADER, probe_token().encode('latin-1'))]
+
+
+def has_probe_token(scope):
+    """True if a connection sent the probe token"""
+    sent = dict(scope.get('headers', [])).get(PROBE_TOKEN_HEADER)
+    return sent is not None and hmac.compare_digest(sent, probe_token().encode('latin-1'))
+
+
+async def run_probe(name, probe, timeout):
+    """
+    Run one probe with a timeout and report how it went and how long it took
+    """
+    start = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(probe(), timeout)
+        status = "ok"
+    except asyncio.TimeoutError:
+        result = None
+        status = "timeout"
+    except Exception as e:
+        result = str(e)
+        status = "error"
+    return name, {
+        "status": status,
+        "result": result,
+        "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+    }
+
+
+async def probe_channel_layer():
+    """Send a message through the channel layer and wait for it to come back"""
+    channel_layer = get_channel_layer()
+    channel = await channel_layer.new_channel()
+    await channel_layer.group_add(PROBE_GROUP, channel)
+    try:
+        await channel_layer.group_send(
+            PROBE_GROUP,
+            {
+                "type": "test.message",
+                "text": "Hello from diagnostics"
+            }
+        )
+        await channel_layer.receive(channel)
+    finally:
+        # Don't leave the probe channel behind in the group
+        await channel_layer.group_discard(PROBE_GROUP, channel)
+    return "Successfully sent and received a test message through the channel layer"
+
+
+async def probe_asgi_port():
+    """Check if the ASGI server port accepts TCP connections"""
+    port = getattr(settings, 'ASGI_PORT', 8001)
+    try:
+        reader, writer = await asyncio.open_connection('localhost', port)
+    except OSError as e:
+        return f"closed ({e.strerror or e})"
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        # It accepted the connection, which is all this checks
+        pass
+    return "open"
+
+
+@sync_to_async
+def probe_connection_log():
+    """Load recent connections and statistics from the database"""
+    from .models import ConnectionLifecycle
+    recent_attempts = [
+        {
+            "client_ip": lifecycle.client_ip,
+            "timestamp": lifecycle.timestamp.isoformat(),
+            "connected_at": lifecycle.connected_at.isoformat() if lifecycle.connected_at else None,
+            "closed_at": lifecycle.closed_at.isoformat() if lifecycle.closed_at else None,
+            "user_agent": lifecycle.user_agent,
+            "outcome": lifecycle.outcome,
+            "successful": lifecycle.successful,
+            "error_message": lifecycle.error_message,
+            "connection_duration_ms": lifecycle.connection_duration_ms,
+            "close_code": lifecycle.close_code,
+            "connection_path": lifecycle.connection_path,
+            "frames_in": lifecycle.frames_in,
+            "frames_out": lifecycle.frames_out,
+            "bytes_in": lifecycle.bytes_in,
+            "bytes_out": lifecycle.bytes_out
+        }
+        for lifecycle in ConnectionLifecycle.objects.order_by('-timestamp')[:20]
+    ]
+    return {
+        "recent_connection_attempts": recent_attempts,
+        "connection_statistics": ConnectionLifecycle.get_connection_statistics(),
+    }
+
+
+LIVE_PROBES = {
+    "channel_layer": probe_channel_layer,
+    "asgi_port": probe_asgi_port,
+    "connection_log": probe_connection_log,
+}
+
+
+class LiveProbeCache:
+    """
+    Caches live probe results for a short TTL.
+    Concurrent requests share the probe run that is already in flight.
+    """
+
+    def __init__(self):
+        self.results = None
+        self.expires = 0
+        self.task = None
+
+    async def get(self):
+        """Return (results, cached)"""
+        if self.results is not None and time.monotonic() < self.expires:
+            return self.results, True
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+        results = await asyncio.shield(self.task)
+        return results, False
+
+    async def run(self):
+        timeout = getattr(settings, 'DIAGNOSTICS_PROBE_TIMEOUT', 1.0)
+        results = dict(await asyncio.gather(*(
+            run_probe(name, probe, timeout) for name, probe in LIVE_PROBES.items()
+        )))
+        self.results = results
+        self.expires = time.monotonic() + getattr(settings, 'DIAGNOSTICS_PROBE_CACHE_TTL', 5.0)
+        return results
+
+
+live_probes = LiveProbeCache()
+
+
+def handshake_probe_settings():
+    options = getattr(settings, 'DIAGNOSTICS_HANDSHAKE_PROBE', {})
+    mode = options.get('MODE', PROBE_MODE_IN_PROCESS)
+    if mode not in PROBE_MODES:
+        raise ValueError(
+            f"Unknown handshake probe mode {mode!r}, expected one of {', '.join(PROBE_MODES)}"
+        )
+    return {
+        'enabled': options.get('ENABLED', True),
+        'mode': mode,
+        'path': options.get('PATH', PROBE_PATH),
+        'url': options.get('URL', f"ws://localhost:{getattr(settings, 'ASGI_PORT', 8001)}{PROBE_PATH}"),
+        'interval': options.get('INTERVAL_MS', 30000) / 1000,
+        'timeout': options.get('TIMEOUT_MS', 2000) / 1000,
+    }
+
+
+class HandshakeProbe:
+    """
+    Checks that WebSocket connections actually work, end to end.
+
+    Every ``interval`` a background task opens a WebSocket connection to
+    the probe endpoint, either in-process against ``api.asgi.application``
+    or over loopback to the running server. It then sends a frame that
+    comes back through the channel layer. The handshake and round-trip
+    times of the latest run are kept for the diagnostics endpoint.
+
+    The background task needs an event loop that outlives requests, which
+    only an ASGI server has. Under WSGI every request gets a loop of its
+    own, so the diagnostics view calls ``run_if_due`` instead and the probe
+    runs inline, at most once per ``interval``.
+    """
+
+    def __init__(self, enabled=True, mode=PROBE_MODE_IN_PROCESS, path=PROBE_PATH, url=None,
+                 interval=30.0, timeout=2.0):
+        self.enabled = enabled
+        self.mode = mode
+        self.path = path
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self.last = None
+        self._loop = None
+        self._task = None
+        self._due = 0
+
+        # Counters
+        self.runs = 0
+        self.failures = 0
+
+    def ensure_started(self):
+        if not self.enabled:
+            return
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and not self._task.done():
+            return
+        self._loop = loop
+        self._task = loop.create_task(self._run())
+
+    async def run_if_due(self):
+        """Run the probe in the caller's loop if ``interval`` has passed since the last inline run"""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now < self._due:
+            return
+        # Set before running, so concurrent requests don't all run it
+        self._due = now + self.interval
+        try:
+            await self.run_once()
+        except Exception:
+            logger.exception("Handshake probe failed")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Handshake probe failed")
+            await asyncio.sleep(self.interval)
+
+    async def connect(self):
+        if self.mode == PROBE_MODE_LOOPBACK:
+            from .benchmarking import LoopbackClient
+            return await asyncio.wait_for(LoopbackClient.connect(self.url, probe_headers()), self.timeout)
+        from api.asgi import application
+        from .benchmarking import InProcessClient
+        return await InProcessClient.connect(application, self.path, self.timeout, headers=probe_headers())
+
+    async def run_once(self):
+        """Run the probe and record its result"""
+        self.runs += 1
+        result = {
+            "status": "ok",
+            "checked_at": timezone.now().isoformat(),
+            "handshake_ms": None,
+            "round_trip_ms": None,
+            "error": None,
+        }
+        started = time.perf_counter()
+        try:
+            client = await self.connect()
+        except Exception as e:
+            return self.record(result, e)
+        result["handshake_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        try:
+            payload = f"probe {self.runs}"
+            sent = time.perf_counter()
+            await client.send_text(payload)
+            echoed = await client.receive_text(self.timeout)
+            result["round_trip_ms"] = round((time.perf_counter() - sent) * 1000, 3)
+            if echoed != payload:
+                raise RuntimeError(f"Expected {payload!r} back, got {echoed!r}")
+        except Exception as e:
+            return self.record(result, e)
+        finally:
+            try:
+                await client.close()
+            except Exception:
+                pass
+        return self.record(result)
+
+    def record(self, result, error=None):
+        if error is not None:
+            self.failures += 1
+            result["status"] = "timeout" if isinstance(error, asyncio.TimeoutError) else "error"
+            result["error"] = f"{type(error).__name__}: {error}"
+        self.last = result
+        return result
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "mode": self.mode,
+            "interval_s": self.interval,
+            "runs": self.runs,
+            "failures": self.failures,
+            # None until the first run has finished
+            "last": self.last,
+        }
+
+
+handshake_probe = HandshakeProbe(**handshake_probe_settings())
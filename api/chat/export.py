@@ -0,0 +1,188 @@
+import csv
+import io
+import json
+import zlib
+from datetime import datetime, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+# Columns of each export, in output order
+CHAT_MESSAGE_FIELDS = ('id', 'room', 'seq', 'username', 'message', 'timestamp')
+CONNECTION_LIFECYCLE_FIELDS = (
+    'id', 'timestamp', 'connected_at', 'closed_at', 'outcome', 'successful',
+    'client_ip', 'user_agent', 'connection_path', 'close_code',
+    'connection_duration_ms', 'error_message', 'frames_in', 'frames_out',
+    'bytes_in', 'bytes_out', 'first_message_at', 'last_message_at',
+    'header_set_id',
+)
+
+
+def export_chunk_size():
+    return getattr(settings, 'CHAT_EXPORT_CHUNK_SIZE', 2000)
+
+
+def parse_time(value, name):
+    """Parse an ISO 8601 query parameter, treating naive times as UTC"""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f"Invalid {name} time {value!r}, expected ISO 8601")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=dt_timezone.utc)
+    return parsed
+
+
+def filter_time_range(queryset, since=None, until=None):
+    """Rows with since <= timestamp < until"""
+    if since:
+        queryset = queryset.filter(timestamp__gte=parse_time(since, 'since'))
+    if until:
+        queryset = queryset.filter(timestamp__lt=parse_time(until, 'until'))
+    return queryset
+
+
+def json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+class NdjsonEncoder:
+    """One JSON object per line"""
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def header(self):
+        return ''
+
+    def rows(self, rows):
+        return ''.join(
+            json.dumps(dict(zip(self.fields, map(json_value, row)))) + '\n'
+            for row in rows
+        )
+
+
+class CsvEncoder:
+    """CSV with a header row"""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def _take(self):
+        text = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return text
+
+    def header(self):
+        self.writer.writerow(self.fields)
+        return self._take()
+
+    def rows(self, rows):
+        self.writer.writerows([map(json_value, row) for row in rows])
+        return self._take()
+
+
+ENCODERS = {
+    'ndjson': NdjsonEncoder,
+    'csv': CsvEncoder,
+}
+
+
+def fetch_chunk(queryset, fields, after, chunk_size):
+    """The next ``chunk_size`` rows ordered by (timestamp, id), after the key ``after``"""
+    if after is not None:
+        timestamp, row_id = after
+        # The lower bound on timestamp alone lets the database walk a
+        # (timestamp, id) index from the key, rather than sort everything after it
+        queryset = queryset.filter(Q(timestamp__gte=timestamp), Q(timestamp__gt=timestamp) | Q(id__gt=row_id))
+    return list(queryset.order_by('timestamp', 'id').values_list(*fields)[:chunk_size])
+
+
+class ExportEncoder:
+    """Turns chunks of rows into export bytes, gzipped if ``compress`` is set"""
+
+    def __init__(self, fields, export_format, compress=False):
+        self.encoder = ENCODERS[export_format](fields)
+        self.compressor = zlib.compressobj(wbits=31) if compress else None
+        # Keyset columns are read alongside the exported ones
+        self.timestamp_index = fields.index('timestamp')
+        self.id_index = fields.index('id')
+
+    def output(self, text):
+        data = text.encode('utf-8')
+        return self.compressor.compress(data) if self.compressor is not None else data
+
+    def header(self):
+        return self.output(self.encoder.header())
+
+    def rows(self, rows):
+        return self.output(self.encoder.rows(rows)) if rows else b''
+
+    def finish(self):
+        return self.compressor.flush() if self.compressor is not None else b''
+
+    def key(self, row):
+        return (row[self.timestamp_index], row[self.id_index])
+
+
+async def stream_rows(queryset, fields, export_format, compress=False):
+    """
+    Yield an export of ``queryset`` chunk by chunk.
+
+    Rows are read in keyset-paginated chunks on (timestamp, id), one short
+    query per chunk, so no cursor or read transaction stays open while the
+    client downloads. Each chunk is encoded as it arrives, so memory use
+    stays flat however many rows are exported. With ``compress`` the output
+    is gzipped as it's produced.
+    """
+    chunk_size = export_chunk_size()
+    encoder = ExportEncoder(fields, export_format, compress)
+    header = encoder.header()
+    if header:
+        yield header
+    after = None
+    while True:
+        rows = await sync_to_async(fetch_chunk)(queryset, fields, after, chunk_size)
+        data = encoder.rows(rows)
+        if data:
+            yield data
+        if len(rows) < chunk_size:
+            break
+        after = encoder.key(rows[-1])
+    data = encoder.finish()
+    if data:
+        yield data
+
+
+def iter_rows(queryset, fields, export_format, compress=False):
+    """The same export as ``stream_rows``, as a plain iterator for WSGI servers"""
+    chunk_size = export_chunk_size()
+    encoder = ExportEncoder(fields, export_format, compress)
+    header = encoder.header()
+    if header:
+        yield header
+    after = None
+    while True:
+        rows = fetch_chunk(queryset, fields, after, chunk_size)
+        data = encoder.rows(rows)
+        if data:
+            yield data
+        if len(rows) < chunk_size:
+            break
+        after = encoder.key(rows[-1])
+    data = encoder.finish()
+    if data:
+        yield data
@@ -0,0 +1,174 @@
+import base64
+import collections
+import json
+import threading
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+
+def encode_cursor(timestamp, message_id):
+    """Build an opaque keyset cursor from a message's (timestamp, id)"""
+    raw = json.dumps([timestamp.isoformat(), message_id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Return the (timestamp, id) pair in a cursor, or raise ValueError"""
+    try:
+        iso, message_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(iso), int(message_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def serialize_message(message):
+    return {
+        "id": message.id,
+        "room": message.room,
+        "username": message.username,
+        "message": message.message,
+        "timestamp": message.timestamp.isoformat(),
+        "seq": message.seq,
+    }
+
+
+class RoomHistory:
+    """Newest messages of one room, oldest first"""
+    __slots__ = ('entries', 'has_all_older')
+
+    def __init__(self, size):
+        # Each entry is ((timestamp, id), serialized message)
+        self.entries = collections.deque(maxlen=size)
+        # True when no message older than entries[0] exists
+        self.has_all_older = False
+
+
+class RecentMessageCache:
+    """
+    Bounded ring buffer of the newest messages per room.
+
+    The buffer is filled as messages are written and seeded from the
+    database the first time a room is read, so the newest pages of a room
+    are served without touching the database. Messages written by other
+    worker processes are not seen until the room falls out of the cache.
+    """
+
+    def __init__(self, size=100, max_rooms=1000):
+        self.size = size
+        self.max_rooms = max_rooms
+        self.rooms = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _room(self, name):
+        history = self.rooms.get(name)
+        if history is None:
+            history = self.rooms[name] = RoomHistory(self.size)
+            if len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+        else:
+            self.rooms.move_to_end(name)
+        return history
+
+    def add(self, messages):
+        """Record newly written ChatMessage instances"""
+        with self.lock:
+            for message in messages:
+                history = self._room(message.room)
+                key = (message.timestamp, message.id)
+                if len(history.entries) == history.entries.maxlen:
+                    # The oldest entry is about to be evicted
+                    history.has_all_older = False
+                if history.entries and key < history.entries[-1][0]:
+                    entries = sorted([*history.entries, (key, serialize_message(message))],
+                                     key=lambda entry: entry[0])
+                    history.entries.clear()
+                    history.entries.extend(entries[-history.entries.maxlen:])
+                else:
+                    history.entries.append((key, serialize_message(message)))
+
+    def seed(self, room, messages):
+        """Load the newest messages of a room read from the database (newest first)"""
+        with self.lock:
+            history = self._room(room)
+            newest_id = messages[0].id if messages else 0
+            # Keep anything written after the database read
+            newer = [entry for entry in history.entries if entry[0][1] > newest_id]
+            history.entries.clear()
+            for message in reversed(messages):
+                history.entries.append(((message.timestamp, message.id), serialize_message(message)))
+            history.entries.extend(newer)
+            history.has_all_older = len(messages) < self.size
+
+    def page(self, room, limit, before=None):
+        """
+        Return up to ``limit`` messages older than ``before`` (newest last),
+        or None if the cache cannot answer without the database.
+        """
+        with self.lock:
+            history = self.rooms.get(room)
+            if history is None:
+                self.misses += 1
+                return None
+            page = []
+            for key, message in reversed(history.entries):
+                if before is not None and key >= before:
+                    continue
+                page.append((key, message))
+                if len(page) == limit:
+                    break
+            if len(page) < limit and not history.has_all_older:
+                self.misses += 1
+                return None
+            self.hits += 1
+            page.reverse()
+            return page
+
+    def stats(self):
+        return {
+            'rooms': len(self.rooms),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+def history_settings():
+    return getattr(settings, 'CHAT_HISTORY', {})
+
+
+recent_messages = RecentMessageCache(
+    size=history_settings().get('CACHE_SIZE', 100),
+    max_rooms=history_settings().get('CACHE_ROOMS', 1000),
+)
+
+
+def fetch_history(room, limit, before=None):
+    """
+    Return a page of a room's history (oldest first) and whether it came
+    from the cache. Pages use keyset pagination on (timestamp, id).
+    """
+    from .models import ChatMessage
+
+    page = recent_messages.page(room, limit, before)
+    if page is not None:
+        return page, True
+
+    queryset = ChatMessage.objects.filter(room=room)
+    if before is not None:
+        timestamp, message_id = before
+        queryset = queryset.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+        )
+    if before is None and limit <= recent_messages.size:
+        # Seed the cache with the room's newest messages so the next read is a hit
+        messages = list(queryset.order_by('-timestamp', '-id')[:recent_messages.size])
+        recent_messages.seed(room, messages)
+        messages = messages[:limit]
+    else:
+        messages = list(queryset.order_by('-timestamp', '-id')[:limit])
+    messages.reverse()
+    return [((message.timestamp, message.id), serialize_message(message)) for message in messages], False
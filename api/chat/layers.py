@@ -0,0 +1,438 @@
+import asyncio
+import fcntl
+import itertools
+import logging
+import os
+import random
+import string
+import threading
+import time
+import weakref
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+logger = logging.getLogger(__name__)
+
+# Frames are a 4-byte big-endian length followed by a msgpack-encoded list
+# of operations, so everything queued during one loop iteration goes out as
+# a single write.
+HEADER_SIZE = 4
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# Stop queueing messages for a peer that isn't reading once this much is
+# buffered. Membership and counter operations are still sent, so a slow
+# peer loses messages but its groups stay right.
+MAX_WRITE_BUFFER = 16 * 1024 * 1024
+DROPPABLE_OPS = frozenset(['send', 'group_send', 'deliver'])
+# Give up connecting to the broker after this long
+CONNECT_TIMEOUT = 5
+CONNECT_RETRY_DELAY = 0.05
+# How long a new broker holds counter requests, so every process has
+# reconnected and reported the values it has seen before any are given out
+SEQUENCE_SETTLE_TIME = 0.25
+
+
+def pack_ops(ops):
+    payload = msgpack.packb(ops, use_bin_type=True)
+    return len(payload).to_bytes(HEADER_SIZE, 'big') + payload
+
+
+async def read_ops(reader):
+    """Read one frame and return its list of operations"""
+    header = await reader.readexactly(HEADER_SIZE)
+    length = int.from_bytes(header, 'big')
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return msgpack.unpackb(await reader.readexactly(length), raw=False)
+
+
+class OpWriter:
+    """
+    Batches operations for a stream and writes them once per loop iteration.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.ops = []
+        self.scheduled = False
+        self.closed = False
+        self.dropped = 0
+        # Futures waiting on the other end's reply, by request id
+        self.requests = {}
+
+    def send(self, op):
+        if self.closed:
+            self.dropped += 1
+            return
+        self.ops.append(op)
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.scheduled = False
+        ops, self.ops = self.ops, []
+        if not ops or self.closed:
+            return
+        if self.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            kept = [op for op in ops if op[0] not in DROPPABLE_OPS]
+            self.dropped += len(ops) - len(kept)
+            ops = kept
+            if not ops:
+                return
+        self.writer.write(pack_ops(ops))
+
+    def close(self):
+        self.closed = True
+        self.writer.close()
+        for future in self.requests.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Channel layer connection closed"))
+        self.requests.clear()
+
+
+def channel_owner(channel):
+    """Return the peer id embedded in a process-specific channel name"""
+    local_part = channel.split('!', 1)[0]
+    return local_part.rsplit('.', 1)[-1]
+
+
+class Broker:
+    """
+    Routes messages between the worker processes on one host.
+
+    Each process connects over a Unix domain socket and registers the group
+    memberships of its own channels. ``group_send`` is forwarded once to
+    every other process with members in the group, together with the list
+    of its member channels; the sending process delivers to its own members
+    directly.
+
+    It also keeps counters shared by every process, which chat rooms number
+    their messages from.
+    """
+
+    def __init__(self, group_expiry=86400, settle_time=SEQUENCE_SETTLE_TIME):
+        self.group_expiry = group_expiry
+        self.settle_until = time.monotonic() + settle_time
+        # group -> {channel: (peer_id, OpWriter, joined_at)}
+        self.groups = {}
+        # peer_id -> set of OpWriters
+        self.peers = {}
+        # counter name -> last value given out
+        self.sequences = {}
+
+    async def handle(self, reader, writer):
+        conn = OpWriter(writer)
+        peer_id = None
+        try:
+            while True:
+                for op in await read_ops(reader):
+                    kind = op[0]
+                    if kind == 'hello':
+                        peer_id = op[1]
+                        self.peers.setdefault(peer_id, set()).add(conn)
+                    elif kind == 'group_add':
+                        self.groups.setdefault(op[1], {})[op[2]] = (peer_id, conn, time.time())
+                    elif kind == 'group_discard':
+                        self.discard(op[1], op[2])
+                    elif kind == 'group_send':
+                        self.group_send(peer_id, op[1], op[2])
+                    elif kind == 'send':
+                        self.send(op[1], op[2])
+                    elif kind == 'sequence':
+                        self.answer_sequence(conn, *op[1:])
+                    elif kind == 'sequence_floor':
+                        self.raise_sequence(op[1], op[2])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            logger.exception("Dropping channel layer peer %s after a bad frame", peer_id)
+        finally:
+            self.remove_connection(peer_id, conn)
+            conn.close()
+
+    def discard(self, group, channel):
+        members = self.groups.get(group)
+        if members:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+
+    def group_send(self, sender_peer_id, group, message):
+        members = self.groups.get(group)
+        if not members:
+            return
+        expired_before = time.time() - self.group_expiry
+        targets = {}
+        for channel, (peer_id, conn, joined_at) in list(members.items()):
+            if joined_at < expired_before:
+                del members[channel]
+                continue
+            if peer_id != sender_peer_id:
+                targets.setdefault(conn, []).append(channel)
+        for conn, channels in targets.items():
+            conn.send(['deliver', channels, message])
+
+    def send(self, channel, message):
+        conns = self.peers.get(channel_owner(channel))
+        if conns:
+            next(iter(conns)).send(['deliver', [channel], message])
+
+    def answer_sequence(self, conn, request_id, name, floor):
+        wait = self.settle_until - time.monotonic()
+        if wait > 0:
+            asyncio.get_running_loop().call_later(wait, self.answer_sequence, conn, request_id, name, floor)
+            return
+        conn.send(['sequenced', request_id, self.next_sequence(name, floor)])
+
+    def next_sequence(self, name, floor):
+        """Return the counter's next value, above ``floor`` and everything given out before"""
+        seq = max(self.sequences.get(name, 0), floor) + 1
+        self.sequences[name] = seq
+        return seq
+
+    def raise_sequence(self, name, seq):
+        if seq > self.sequences.get(name, 0):
+            self.sequences[name] = seq
+
+    def remove_connection(self, peer_id, conn):
+        conns = self.peers.get(peer_id)
+        if conns is not None:
+            conns.discard(conn)
+            if not conns:
+                del self.peers[peer_id]
+        for group, members in list(self.groups.items()):
+            for channel, member in list(members.items()):
+                if member[1] is conn:
+                    del members[channel]
+            if not members:
+                del self.groups[group]
+
+
+class BrokerThread(threading.Thread):
+    """Runs a Broker on its own event loop so it outlives any one app loop"""
+
+    def __init__(self, path, group_expiry):
+        super().__init__(name='channel-layer-broker', daemon=True)
+        self.path = path
+        self.broker = Broker(group_expiry=group_expiry)
+        self.ready = threading.Event()
+        self.error = None
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(asyncio.start_unix_server(self.broker.handle, path=self.path))
+            os.chmod(self.path, 0o600)
+        except Exception as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+        loop.run_forever()
+
+
+class UnixSocketChannelLayer(InMemoryChannelLayer):
+    """
+    Channel layer shared by several worker processes on one host, without Redis.
+
+    Each process keeps its own channels in memory, as InMemoryChannelLayer
+    does. Group membership and cross-process deliveries go through a broker
+    listening on a Unix domain socket. The first process to start takes a
+    lock file and runs the broker in a background thread. If that process
+    exits, the others elect a new broker and register their groups again.
+
+    Only process-specific channels (those containing ``!``, which is what
+    consumers use) and groups cross process boundaries. Plain named channels
+    stay local to the process.
+
+    ``next_sequence`` gives out numbers from counters kept by the broker, so
+    they are unique across processes. Each process tells a new broker the
+    highest numbers it has seen, so counters carry on after a failover.
+    """
+
+    def __init__(self, path='/tmp/chat-channel-layer.sock', **kwargs):
+        super().__init__(**kwargs)
+        self.path = str(path)
+        self.peer_id = f"p{os.getpid()}x{''.join(random.choices(string.ascii_lowercase, k=6))}"
+        self._lock_file = None
+        self._broker_thread = None
+        # One broker connection per event loop
+        self._connections = weakref.WeakKeyDictionary()
+        self._connect_locks = weakref.WeakKeyDictionary()
+        self._request_ids = itertools.count()
+        # counter name -> highest value given out or seen by this process
+        self.sequences = {}
+
+    extensions = ["groups", "flush"]
+
+    async def new_channel(self, prefix="specific."):
+        return "%s%s!%s" % (
+            prefix,
+            self.peer_id,
+            "".join(random.choice(string.ascii_letters) for i in range(12)),
+        )
+
+    def is_local(self, channel):
+        return '!' not in channel or channel_owner(channel) == self.peer_id
+
+    async def send(self, channel, message):
+        if self.is_local(channel):
+            return await super().send(channel, message)
+        self.require_valid_channel_name(channel)
+        (await self._connection()).send(['send', channel, message])
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        (await self._connection()).send(['group_add', group, channel])
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        (await self._connection()).send(['group_discard', group, channel])
+
+    async def group_send(self, group, message):
+        # Local members are delivered directly, the broker handles the rest
+        await super().group_send(group, message)
+        (await self._connection()).send(['group_send', group, message])
+
+    async def next_sequence(self, name, floor=0):
+        """
+        Return the next value of a counter shared with the other processes,
+        above ``floor``, e.g. the highest value this process has seen
+        delivered or stored.
+        """
+        self.sequences[name] = max(self.sequences.get(name, 0), floor)
+        while True:
+            conn = await self._connection()
+            request_id = next(self._request_ids)
+            future = conn.requests[request_id] = asyncio.get_running_loop().create_future()
+            conn.send(['sequence', request_id, name, self.sequences[name]])
+            try:
+                seq = await future
+            except ConnectionError:
+                # The broker went away before answering; ask the new one
+                continue
+            finally:
+                conn.requests.pop(request_id, None)
+            if seq > self.sequences[name]:
+                self.sequences[name] = seq
+            return seq
+
+    async def flush(self):
+        await super().flush()
+        for conn in list(self._connections.values()):
+            conn.close()
+        self._connections.clear()
+
+    async def close(self):
+        for conn in list(self._connections.values()):
+            conn.close()
+        self._connections.clear()
+
+    # Broker connection
+
+    async def _connection(self):
+        loop = asyncio.get_running_loop()
+        conn = self._connections.get(loop)
+        if conn is not None and not conn.closed:
+            return conn
+        lock = self._connect_locks.setdefault(loop, asyncio.Lock())
+        async with lock:
+            conn = self._connections.get(loop)
+            if conn is None or conn.closed:
+                conn = await self._connect()
+                self._connections[loop] = conn
+        return conn
+
+    async def _connect(self):
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                if await self._start_broker():
+                    continue
+                # Another process is starting the broker
+                if time.monotonic() >= deadline:
+                    logger.error("Could not connect to the channel layer broker at %s: %s", self.path, e)
+                    raise
+                await asyncio.sleep(CONNECT_RETRY_DELAY)
+
+        conn = OpWriter(writer)
+        conn.send(['hello', self.peer_id])
+        # Register local groups again in case this is a new broker
+        for group, channels in self.groups.items():
+            for channel in channels:
+                conn.send(['group_add', group, channel])
+        # and carry our counters over to it
+        for name, seq in self.sequences.items():
+            conn.send(['sequence_floor', name, seq])
+        asyncio.get_running_loop().create_task(self._read(reader, conn))
+        return conn
+
+    async def _read(self, reader, conn):
+        try:
+            while True:
+                for op in await read_ops(reader):
+                    if op[0] == 'deliver':
+                        _, channels, message = op
+                        for channel in channels:
+                            try:
+                                await InMemoryChannelLayer.send(self, channel, message)
+                            except ChannelFull:
+                                pass
+                    elif op[0] == 'sequenced':
+                        future = conn.requests.get(op[1])
+                        if future is not None and not future.done():
+                            future.set_result(op[2])
+        except asyncio.CancelledError:
+            conn.close()
+            raise
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if not conn.closed:
+                logger.warning("Lost connection to the channel layer broker at %s", self.path)
+        except Exception:
+            logger.exception("Error reading from the channel layer broker")
+
+        if not conn.closed:
+            # The broker went away rather than us closing the connection.
+            # Reconnect straight away so our groups are registered with
+            # whichever process becomes the new broker.
+            conn.close()
+            await asyncio.sleep(random.random() / 20)
+            try:
+                await self._connection()
+            except ConnectionError:
+                # Logged by _connect; the next operation tries again
+                pass
+
+    async def _start_broker(self):
+        """Become the broker if no other process holds the lock"""
+        if self._broker_thread is not None and self._broker_thread.is_alive():
+            return False
+        lock_file = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+
+        # Holding the lock means any existing socket file is stale
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        thread = BrokerThread(self.path, self.group_expiry)
+        thread.start()
+        # Wait for the socket without holding up this loop
+        await asyncio.get_running_loop().run_in_executor(None, thread.ready.wait)
+        if thread.error is not None:
+            lock_file.close()
+            raise thread.error
+        # Keep the lock for the life of the process
+        self._lock_file = lock_file
+        self._broker_thread = thread
+        return True
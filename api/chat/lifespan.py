@@ -0,0 +1,24 @@
+from .buffers import close_buffers
+from .diagnostics import handshake_probe
+
+
+class LifespanApp:
+    """
+    ASGI lifespan handler.
+
+    Starts the diagnostics handshake probe, and flushes the write-behind
+    buffers when the server shuts down so queued log records are not lost
+    on a clean restart.
+    """
+
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                handshake_probe.ensure_started()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                handshake_probe.stop()
+                await close_buffers()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import time
+from urllib.parse import parse_qs
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Close code sent to heartbeat clients that stop answering
+IDLE_CLOSE_CODE = 4408
+
+# Scope key under which the middleware hands its tracking entry to the consumer
+SCOPE_KEY = 'chat.connection'
+
+
+def liveness_settings():
+    options = getattr(settings, 'CHAT_CONNECTION_LIVENESS', {})
+    return {
+        'heartbeat_interval': options.get('HEARTBEAT_INTERVAL_MS', 20000) / 1000,
+        'idle_timeout': options.get('IDLE_TIMEOUT_MS', 60000) / 1000,
+        'close_code': options.get('CLOSE_CODE', IDLE_CLOSE_CODE),
+        'sweep_interval': options.get('SWEEP_INTERVAL_MS', 10000) / 1000,
+        'tracking_ttl': options.get('TRACKING_TTL_MS', 24 * 60 * 60 * 1000) / 1000,
+    }
+
+
+def wants_heartbeat(scope):
+    """Clients opt in to heartbeat frames with ``?heartbeat=1`` on the WebSocket URL"""
+    params = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    return params.get('heartbeat', ['0'])[0] in ('1', 'true')
+
+
+class TrackedConnection:
+    """What the server knows about one open connection"""
+    __slots__ = ('id', 'client_ip', 'path', 'started', 'last_seen',
+                 'idle_timeout', 'on_idle', 'reaped')
+
+    def __init__(self, connection_id, client_ip, path):
+        self.id = connection_id
+        self.client_ip = client_ip
+        self.path = path
+        # Wall clock for durations in the log, monotonic for idle checks
+        self.started = time.time()
+        self.last_seen = time.monotonic()
+        self.idle_timeout = None
+        self.on_idle = None
+        self.reaped = False
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    def watch_idle(self, idle_timeout, on_idle):
+        """Call the coroutine function ``on_idle`` once nothing is received for ``idle_timeout`` seconds"""
+        self.idle_timeout = idle_timeout
+        self.on_idle = on_idle
+
+
+class ConnectionTracker:
+    """
+    Every connection the middleware is handling in this process.
+
+    The middleware adds an entry when a connection opens and removes it when
+    its handler returns, however the connection ended. Entries record when
+    a frame was last received. A sweeper task runs every
+    ``sweep_interval`` and:
+
+    - closes connections that asked to be watched (heartbeat clients) and
+      have received nothing for their idle timeout
+    - drops entries that have received nothing for ``tracking_ttl``, as a
+      backstop against anything that never removed its entry
+
+    ``live`` counts running connection handlers independently of the
+    entries, so ``tracked`` staying close to ``live`` shows nothing leaks.
+    """
+
+    def __init__(self, sweep_interval=10.0, tracking_ttl=86400.0):
+        self.sweep_interval = sweep_interval
+        self.tracking_ttl = tracking_ttl
+        self.connections = {}
+        self.live = 0
+        self._next_id = 0
+        self._loop = None
+        self._sweeper = None
+
+        # Counters
+        self.opened = 0
+        self.closed = 0
+        self.reaped = 0
+        self.expired = 0
+
+    def open(self, client_ip, path):
+        self._ensure_started()
+        self._next_id += 1
+        connection = TrackedConnection(self._next_id, client_ip, path)
+        self.connections[connection.id] = connection
+        self.live += 1
+        self.opened += 1
+        return connection
+
+    def close(self, connection):
+        self.live -= 1
+        self.closed += 1
+        self.connections.pop(connection.id, None)
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and not self._sweeper.done():
+            return
+        self._loop = loop
+        self._sweeper = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Connection sweep failed")
+
+    def sweep(self, now=None):
+        now = time.monotonic() if now is None else now
+        for connection in list(self.connections.values()):
+            idle = now - connection.last_seen
+            if (connection.on_idle is not None and not connection.reaped
+                    and idle > connection.idle_timeout):
+                connection.reaped = True
+                self.reaped += 1
+                self._loop.create_task(connection.on_idle())
+            elif idle > self.tracking_ttl:
+                del self.connections[connection.id]
+                self.expired += 1
+
+    def stats(self):
+        return {
+            'tracked': len(self.connections),
+            'live': self.live,
+            'watched': sum(1 for connection in self.connections.values() if connection.on_idle is not None),
+            'opened': self.opened,
+            'closed': self.closed,
+            'reaped_idle': self.reaped,
+            'expired': self.expired,
+        }
+
+
+connection_tracker = ConnectionTracker(
+    sweep_interval=liveness_settings()['sweep_interval'],
+    tracking_ttl=liveness_settings()['tracking_ttl'],
+)
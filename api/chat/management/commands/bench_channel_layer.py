@@ -0,0 +1,138 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from chat.layers import UnixSocketChannelLayer
+
+GROUP = 'bench_group'
+
+
+async def receive_all(layer, channels, expected_per_channel):
+    async def drain(channel):
+        for _ in range(expected_per_channel):
+            await layer.receive(channel)
+
+    await asyncio.gather(*(drain(channel) for channel in channels))
+
+
+async def join_group(layer, count):
+    channels = [await layer.new_channel() for _ in range(count)]
+    for channel in channels:
+        await layer.group_add(GROUP, channel)
+    return channels
+
+
+def run_worker(path, channel_count, messages, ready, results):
+    """Join the group from a separate process and time delivery of every message"""
+    async def main():
+        layer = UnixSocketChannelLayer(path=path, capacity=messages + 1)
+        channels = await join_group(layer, channel_count)
+        # Give the broker a moment to register the memberships
+        await asyncio.sleep(0.2)
+        ready.put(os.getpid())
+        await receive_all(layer, channels, messages)
+        results.put(time.time())
+        await layer.close()
+
+    asyncio.run(main())
+
+
+class Command(BaseCommand):
+    help = "Compare group_send throughput of the in-memory and Unix socket channel layers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--channels', type=int, default=100,
+                            help="Group members per process")
+        parser.add_argument('--messages', type=int, default=1000,
+                            help="Number of group_send calls")
+        parser.add_argument('--workers', type=int, default=2,
+                            help="Extra processes joining the group for the cross-process run")
+        parser.add_argument('--json', action='store_true',
+                            help="Print results as JSON")
+
+    def handle(self, *args, **options):
+        channel_count = options['channels']
+        messages = options['messages']
+        socket_path = os.path.join(tempfile.mkdtemp(), 'bench.sock')
+
+        results = {
+            'in_memory': asyncio.run(self.run_in_process(
+                InMemoryChannelLayer(capacity=messages + 1), channel_count, messages
+            )),
+            'unix_socket': asyncio.run(self.run_in_process(
+                UnixSocketChannelLayer(path=socket_path, capacity=messages + 1),
+                channel_count, messages
+            )),
+        }
+        if options['workers']:
+            results['unix_socket_cross_process'] = self.run_cross_process(
+                socket_path, options['workers'], channel_count, messages
+            )
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(f"{'layer':<28}{'processes':>10}{'sends/s':>12}{'deliveries/s':>15}")
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<28}{result['processes']:>10}"
+                f"{result['sends_per_second']:>12}{result['deliveries_per_second']:>15}"
+            )
+
+    async def run_in_process(self, layer, channel_count, messages):
+        channels = await join_group(layer, channel_count)
+        receiver = asyncio.ensure_future(receive_all(layer, channels, messages))
+        start = time.perf_counter()
+        for i in range(messages):
+            await layer.group_send(GROUP, {'type': 'bench.message', 'text': f'message {i}'})
+        await receiver
+        elapsed = time.perf_counter() - start
+        await layer.close()
+        return self.summary(1, messages, messages * channel_count, elapsed)
+
+    def run_cross_process(self, socket_path, workers, channel_count, messages):
+        context = multiprocessing.get_context('spawn')
+        ready = context.Queue()
+        results = context.Queue()
+        processes = [
+            context.Process(target=run_worker,
+                            args=(socket_path, channel_count, messages, ready, results))
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+
+        async def send():
+            layer = UnixSocketChannelLayer(path=socket_path)
+            # Connect first so this process is already known to the broker
+            await layer.group_discard(GROUP, await layer.new_channel())
+            for _ in processes:
+                await asyncio.get_running_loop().run_in_executor(None, ready.get)
+            start = time.time()
+            for i in range(messages):
+                await layer.group_send(GROUP, {'type': 'bench.message', 'text': f'message {i}'})
+            return start
+
+        start = asyncio.run(send())
+        finished = max(results.get(timeout=60) for _ in processes)
+        for process in processes:
+            process.join()
+        return self.summary(workers + 1, messages, messages * channel_count * workers, finished - start)
+
+    @staticmethod
+    def summary(processes, messages, deliveries, elapsed):
+        return {
+            'processes': processes,
+            'messages': messages,
+            'deliveries': deliveries,
+            'seconds': round(elapsed, 3),
+            'sends_per_second': round(messages / elapsed),
+            'deliveries_per_second': round(deliveries / elapsed),
+        }
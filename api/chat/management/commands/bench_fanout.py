@@ -0,0 +1,91 @@
+import asyncio
+import json
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from chat.protocol import encode_chat_frame
+
+GROUP = 'bench_group'
+
+
+def per_recipient_event(i):
+    return {"type": "chat_message", "message": f"message {i}", "username": "chatbench", "timestamp": "12:00:00"}
+
+
+def per_recipient_frame(event):
+    # How every recipient built its frame before encode-once fan-out
+    return json.dumps({
+        "message": event["message"],
+        "username": event["username"],
+        "timestamp": event["timestamp"]
+    })
+
+
+def encode_once_event(i):
+    return {"type": "chat_message", "text": encode_chat_frame(f"message {i}", "chatbench", "12:00:00")}
+
+
+def encode_once_frame(event):
+    return event["text"]
+
+
+STRATEGIES = {
+    'per_recipient': (per_recipient_event, per_recipient_frame),
+    'encode_once': (encode_once_event, encode_once_frame),
+}
+
+
+class Command(BaseCommand):
+    help = "Measure CPU time per group broadcast as the room grows"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,1000,5000',
+                            help="Comma-separated room sizes")
+        parser.add_argument('--broadcasts', type=int, default=200,
+                            help="Broadcasts per room size")
+        parser.add_argument('--json', action='store_true',
+                            help="Print results as JSON")
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        results = []
+        for size in sizes:
+            row = {'room_size': size}
+            for name, (make_event, make_frame) in STRATEGIES.items():
+                cpu = asyncio.run(self.run(size, options['broadcasts'], make_event, make_frame))
+                row[f'{name}_cpu_us'] = round(cpu * 1e6, 1)
+            row['speedup'] = round(row['per_recipient_cpu_us'] / row['encode_once_cpu_us'], 2)
+            results.append(row)
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write("CPU time per broadcast (microseconds)")
+        self.stdout.write(f"{'room size':>10}{'per recipient':>16}{'encode once':>14}{'speedup':>10}")
+        for row in results:
+            self.stdout.write(
+                f"{row['room_size']:>10}{row['per_recipient_cpu_us']:>16}"
+                f"{row['encode_once_cpu_us']:>14}{row['speedup']:>9}x"
+            )
+
+    async def run(self, size, broadcasts, make_event, make_frame):
+        """
+        Broadcast through an in-memory layer and build every recipient's
+        frame. Recipient queues are drained directly so the layer's expiry
+        sweep in receive() doesn't swamp the serialization cost.
+        """
+        layer = InMemoryChannelLayer(capacity=broadcasts + 1)
+        channels = [await layer.new_channel() for _ in range(size)]
+        for channel in channels:
+            await layer.group_add(GROUP, channel)
+
+        start = time.process_time()
+        for i in range(broadcasts):
+            await layer.group_send(GROUP, make_event(i))
+            for channel in channels:
+                _, event = layer.channels[channel].get_nowait()
+                make_frame(event)
+        return (time.process_time() - start) / broadcasts
@@ -0,0 +1,68 @@
+import asyncio
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from chat.benchmarking import (
+    benchmark_room,
+    chat_application,
+    connect_clients,
+    delete_benchmark_messages,
+    disconnect_clients,
+    latency_summary,
+    measure_broadcasts,
+)
+from chat.buffers import DURABILITY_LEVELS, get_chat_message_buffer
+
+
+class Command(BaseCommand):
+    help = "Measure chat broadcast latency for each message durability level"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50,
+                            help="Number of connected clients in the room")
+        parser.add_argument('--messages', type=int, default=200,
+                            help="Messages to send for each durability level")
+        parser.add_argument('--level', choices=DURABILITY_LEVELS, action='append',
+                            help="Only benchmark this level (can be repeated)")
+        parser.add_argument('--json', action='store_true',
+                            help="Print results as JSON")
+
+    def handle(self, *args, **options):
+        levels = options['level'] or DURABILITY_LEVELS
+        room = benchmark_room('bench-persistence')
+        seqs = set()
+        results = {}
+        try:
+            for level in levels:
+                persistence = {**getattr(settings, 'CHAT_MESSAGE_PERSISTENCE', {}), 'DURABILITY': level}
+                with override_settings(CHAT_MESSAGE_PERSISTENCE=persistence):
+                    results[level] = asyncio.run(
+                        self.run_level(room, options['clients'], options['messages'], seqs)
+                    )
+        finally:
+            # Remove the messages this run sent, and nothing else
+            delete_benchmark_messages(room, seqs)
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(f"{'level':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for level, summary in results.items():
+            self.stdout.write(
+                f"{level:<16}{summary['p50']:>10}{summary['p95']:>10}"
+                f"{summary['p99']:>10}{summary['max']:>10}"
+            )
+
+    async def run_level(self, room, client_count, messages, seqs):
+        clients = await connect_clients(chat_application(), f"/ws/chat/{room}/", client_count)
+        try:
+            latencies = await measure_broadcasts(clients[0], clients, messages, seqs=seqs)
+        finally:
+            await disconnect_clients(clients)
+        # Make sure every message is committed before the next level starts
+        await get_chat_message_buffer().close()
+        return latency_summary(latencies)
@@ -0,0 +1,109 @@
+import json
+import random
+import time
+
+import msgpack
+from django.core.management.base import BaseCommand
+
+from chat.protocol import (
+    CompressedMsgpackProtocol,
+    JsonProtocol,
+    MsgpackProtocol,
+    compress_frame,
+    encode_chat_frame,
+    protocol_settings,
+)
+
+
+def encode_json(message):
+    return encode_chat_frame(message, "chatbench", "12:00:00")
+
+
+def encode_msgpack(message):
+    return msgpack.packb(
+        {"message": message, "username": "chatbench", "timestamp": "12:00:00"}, use_bin_type=True
+    )
+
+
+def encode_msgpack_zlib(message):
+    config = protocol_settings()
+    return compress_frame(encode_msgpack(message), config['compression_threshold'],
+                          config['compression_level'])
+
+
+# name -> (encoder, protocol that decodes its frames)
+PROTOCOLS = {
+    'json': (encode_json, JsonProtocol()),
+    'msgpack': (encode_msgpack, MsgpackProtocol()),
+    'msgpack+zlib': (encode_msgpack_zlib, CompressedMsgpackProtocol()),
+}
+
+
+def sample_message(size):
+    """A chat message of ``size`` characters of random English-like words"""
+    words = ("the quick brown fox jumps over a lazy dog while chat room members keep talking "
+             "about deploys latency websockets lunch meetings and weekend plans").split()
+    rng = random.Random(size)
+    text = []
+    length = 0
+    while length < size:
+        word = rng.choice(words)
+        text.append(word)
+        length += len(word) + 1
+    return " ".join(text)[:size]
+
+
+def time_per_call(func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations
+
+
+class Command(BaseCommand):
+    help = "Compare frame size and encode/decode cost of the JSON and msgpack chat protocols"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='20,200,2000,20000',
+                            help="Comma-separated message lengths in characters")
+        parser.add_argument('--iterations', type=int, default=2000,
+                            help="Encode/decode calls timed per measurement")
+        parser.add_argument('--json', action='store_true',
+                            help="Print results as JSON")
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        results = []
+        for size in [int(size) for size in options['sizes'].split(',')]:
+            message = sample_message(size)
+            for name, (encode, protocol) in PROTOCOLS.items():
+                frame = encode(message)
+                if isinstance(frame, bytes):
+                    decode = lambda: protocol.decode(bytes_data=frame)
+                else:
+                    decode = lambda: protocol.decode(text_data=frame)
+                results.append({
+                    'message_chars': size,
+                    'protocol': name,
+                    'frame_bytes': len(frame) if isinstance(frame, bytes) else len(frame.encode('utf-8')),
+                    'encode_us': round(time_per_call(lambda: encode(message), iterations) * 1e6, 2),
+                    'decode_us': round(time_per_call(decode, iterations) * 1e6, 2),
+                })
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(
+            f"{'chars':>7}  {'protocol':<14}{'frame bytes':>12}{'vs json':>9}"
+            f"{'encode us':>11}{'decode us':>11}"
+        )
+        json_bytes = {}
+        for row in results:
+            if row['protocol'] == 'json':
+                json_bytes[row['message_chars']] = row['frame_bytes']
+            ratio = row['frame_bytes'] / json_bytes[row['message_chars']]
+            self.stdout.write(
+                f"{row['message_chars']:>7}  {row['protocol']:<14}{row['frame_bytes']:>12}"
+                f"{ratio:>8.0%} {row['encode_us']:>10} {row['decode_us']:>10}"
+            )
@@ -0,0 +1,238 @@
+import asyncio
+import json
+import subprocess
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.benchmarking import (
+    BENCHMARK_HEADERS,
+    InProcessClient,
+    LoopbackClient,
+    benchmark_room,
+    delete_benchmark_connections,
+    delete_benchmark_messages,
+    latency_summary,
+)
+from chat.buffers import close_buffers, get_persistence_durability
+from chat.models import ChatMessage, ConnectionAttempt, ConnectionLifecycle
+from chat.outbound import outbound_settings
+from chat.ratelimit import rate_limiter
+
+USERNAME = 'chatbench'
+
+
+@sync_to_async
+def count_rows():
+    return {
+        'chat_messages': ChatMessage.objects.count(),
+        'connections': ConnectionLifecycle.objects.count(),
+        'connection_attempts': ConnectionAttempt.objects.count(),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, timeout=5, cwd=settings.BASE_DIR
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Run simulated chat clients against the ASGI application in this process, "
+        "or against a running server, and report connect and fan-out latency"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50,
+                            help="Number of connected clients in the room")
+        parser.add_argument('--senders', type=int, default=1,
+                            help="How many of the clients send messages")
+        parser.add_argument('--rate', type=float, default=50,
+                            help="Messages per second across all senders")
+        parser.add_argument('--duration', type=float, default=10,
+                            help="Seconds to send for")
+        parser.add_argument('--room',
+                            help="Room the clients join, by default a new chatbench-<random> room")
+        parser.add_argument('--url',
+                            help="Base URL of a running server, e.g. ws://localhost:8001. "
+                                 "Without it the benchmark runs in this process.")
+        parser.add_argument('--batch-size', type=int, default=1,
+                            help="Ask the server to batch up to this many messages per frame")
+        parser.add_argument('--batch-window-ms', type=float, default=0,
+                            help="How long the server may wait to fill a batch")
+        parser.add_argument('--drain-timeout', type=float, default=5,
+                            help="Seconds to wait for outstanding deliveries after sending stops")
+        parser.add_argument('--rate-limits', action='store_true',
+                            help="Apply CHAT_RATE_LIMITS in in-process runs. They are off by default "
+                                 "because every simulated client shares one address.")
+        parser.add_argument('--label', default='',
+                            help="Free-form label stored with the results")
+        parser.add_argument('--output',
+                            help="Write the results as JSON to this file")
+        parser.add_argument('--json', action='store_true',
+                            help="Print results as JSON")
+
+    def handle(self, *args, **options):
+        if not 0 < options['senders'] <= options['clients']:
+            self.stderr.write("--senders must be between 1 and --clients")
+            return
+
+        options['room'] = options['room'] or benchmark_room('chatbench')
+        seqs = set()
+        try:
+            result = asyncio.run(self.run(options, seqs))
+        finally:
+            # Remove the messages and connections of this run, and nothing else
+            delete_benchmark_messages(options['room'], seqs)
+            delete_benchmark_connections()
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(result, f, indent=2)
+        if options['json']:
+            self.stdout.write(json.dumps(result, indent=2))
+            return
+
+        self.stdout.write(
+            f"{result['mode']}: {result['clients']} clients, {result['senders']} senders, "
+            f"{result['duration_s']}s at {result['target_rate']} msg/s"
+        )
+        self.stdout.write(f"{'':<22}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+        for name in ('connect_ms', 'fanout_ms'):
+            summary = result[name]
+            if summary['count']:
+                self.stdout.write(
+                    f"{name:<22}{summary['p50']:>10}{summary['p95']:>10}"
+                    f"{summary['p99']:>10}{summary['max']:>10}"
+                )
+        self.stdout.write(
+            f"sent {result['messages_sent']} ({result['messages_per_second']} msg/s), "
+            f"delivered {result['deliveries']}/{result['expected_deliveries']} "
+            f"({result['deliveries_per_second']}/s) in {result['frames_received']} frames"
+        )
+        self.stdout.write(
+            f"DB rows written: {result['db_rows_written']['chat_messages']} chat messages, "
+            f"{result['db_rows_written']['connections']} connections, "
+            f"{result['db_rows_written']['connection_attempts']} connection attempts"
+        )
+
+    async def run(self, options, seqs):
+        url = options['url']
+        path = f"/ws/chat/{options['room']}/"
+        if options['batch_size'] > 1:
+            path += f"?batch_size={options['batch_size']}&batch_window_ms={options['batch_window_ms']}"
+        if url:
+            def connect():
+                return LoopbackClient.connect(url.rstrip('/') + path, BENCHMARK_HEADERS)
+        else:
+            from api.asgi import application
+            rate_limiter.enabled = options['rate_limits']
+
+            def connect():
+                return InProcessClient.connect(application, path, headers=BENCHMARK_HEADERS)
+
+        rows_before = await count_rows()
+
+        clients = []
+        connect_latencies = []
+        for _ in range(options['clients']):
+            started = time.perf_counter()
+            clients.append(await connect())
+            connect_latencies.append((time.perf_counter() - started) * 1000)
+
+        sent_at = {}
+        fanout_latencies = []
+        frames_received = 0
+
+        async def receive(client):
+            nonlocal frames_received
+            while True:
+                try:
+                    frame = json.loads(await client.receive_text(options['drain_timeout']))
+                except asyncio.TimeoutError:
+                    continue
+                frames_received += 1
+                # Batched frames are arrays of messages
+                for message in frame if isinstance(frame, list) else [frame]:
+                    received_at = sent_at.get(message.get('message'))
+                    if received_at is not None:
+                        fanout_latencies.append((time.perf_counter() - received_at) * 1000)
+                        seqs.add(message.get('seq'))
+
+        async def send(sender_index, client):
+            interval = options['senders'] / options['rate']
+            deadline = start + options['duration']
+            sequence = 0
+            while True:
+                # Keep to the schedule even if a send was slow
+                due = start + sequence * interval
+                if due >= deadline:
+                    return
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                key = f"{sender_index}:{sequence}"
+                sent_at[key] = time.perf_counter()
+                await client.send_text(json.dumps({"message": key, "username": USERNAME}))
+                sequence += 1
+
+        receivers = [asyncio.ensure_future(receive(client)) for client in clients]
+        start = time.perf_counter()
+        await asyncio.gather(*(send(i, client) for i, client in enumerate(clients[:options['senders']])))
+        sending_time = time.perf_counter() - start
+
+        expected = len(sent_at) * len(clients)
+        drain_deadline = time.perf_counter() + options['drain_timeout']
+        while len(fanout_latencies) < expected and time.perf_counter() < drain_deadline:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+
+        for receiver in receivers:
+            receiver.cancel()
+        await asyncio.gather(*receivers, return_exceptions=True)
+        await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+
+        if url:
+            # Give the server's write-behind buffers a chance to flush
+            await asyncio.sleep(1)
+        else:
+            await close_buffers()
+        rows_after = await count_rows()
+
+        return {
+            'label': options['label'],
+            'revision': git_revision(),
+            'timestamp': timezone.now().isoformat(),
+            'mode': 'loopback' if url else 'in_process',
+            'url': url,
+            'room': options['room'],
+            'clients': len(clients),
+            'senders': options['senders'],
+            'target_rate': options['rate'],
+            'batch_size': options['batch_size'],
+            'batch_window_ms': options['batch_window_ms'],
+            'duration_s': options['duration'],
+            'durability': get_persistence_durability(),
+            'outbound_policy': outbound_settings()['policy'],
+            # A running server applies its own settings
+            'rate_limits': None if url else rate_limiter.enabled,
+            'connect_ms': latency_summary(connect_latencies),
+            'messages_sent': len(sent_at),
+            'messages_per_second': round(len(sent_at) / sending_time, 1),
+            'expected_deliveries': expected,
+            'deliveries': len(fanout_latencies),
+            'deliveries_per_second': round(len(fanout_latencies) / elapsed, 1),
+            'frames_received': frames_received,
+            'fanout_ms': latency_summary(fanout_latencies),
+            'db_rows_written': {
+                name: rows_after[name] - rows_before[name] for name in rows_after
+            },
+        }
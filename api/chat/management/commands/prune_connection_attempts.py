@@ -0,0 +1,100 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from chat.models import (
+    ConnectionAttempt,
+    ConnectionErrorRollup,
+    ConnectionLifecycle,
+    ConnectionStatsRollup,
+    HeaderSet,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete ConnectionLifecycle rows, and any ConnectionAttempt rows, older than "
+        "the retention period in small transactions. Their statistics stay in the "
+        "rollup tables."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=getattr(settings, 'CONNECTION_LOG_RETENTION_DAYS', 30),
+                            help="Keep rows from the last N days")
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help="Rows deleted per transaction")
+        parser.add_argument('--pause-ms', type=int, default=50,
+                            help="Pause between transactions so writers can get the lock")
+
+    def handle(self, *args, **options):
+        # Prune whole hours so each hourly rollup covers either only pruned
+        # rows or only retained ones (see rebuild_connection_rollups)
+        cutoff = ConnectionStatsRollup.truncate_hour(
+            timezone.now() - timezone.timedelta(days=options['days'])
+        )
+        chunk_size = options['chunk_size']
+        pause = options['pause_ms'] / 1000
+
+        deleted = self.prune(ConnectionLifecycle, cutoff, chunk_size, pause, archive=True)
+        # Per-frame rows, and connections logged before ConnectionLifecycle
+        deleted_attempts = self.prune(ConnectionAttempt, cutoff, chunk_size, pause)
+
+        # Header sets no longer referenced by any row
+        deleted_header_sets = 0
+        while True:
+            with transaction.atomic():
+                fingerprints = list(
+                    HeaderSet.objects.filter(first_seen__lt=cutoff, connectionattempt__isnull=True,
+                                              connectionlifecycle__isnull=True)
+                    .values_list('fingerprint', flat=True)[:chunk_size]
+                )
+                if not fingerprints:
+                    break
+                HeaderSet.objects.filter(fingerprint__in=fingerprints).delete()
+            deleted_header_sets += len(fingerprints)
+            time.sleep(pause)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {deleted} connections, {deleted_attempts} connection attempts and "
+            f"{deleted_header_sets} header sets "
+            f"older than {cutoff.isoformat()}"
+        ))
+
+    def prune(self, model, cutoff, chunk_size, pause, archive=False):
+        deleted = 0
+        while True:
+            with transaction.atomic():
+                ids = list(
+                    model.objects.filter(timestamp__lt=cutoff)
+                    .order_by('timestamp', 'id')
+                    .values_list('id', flat=True)[:chunk_size]
+                )
+                if not ids:
+                    break
+                if archive:
+                    self.archive_errors(ids)
+                model.objects.filter(id__in=ids).delete()
+            deleted += len(ids)
+            time.sleep(pause)
+        return deleted
+
+    def archive_errors(self, ids):
+        """Record that these rows' error counts no longer have raw rows behind them"""
+        errors = ConnectionLifecycle.objects.filter(
+            id__in=ids,
+            successful=False,
+            error_message__isnull=False
+        ).exclude(
+            error_message=""
+        ).values('error_message').annotate(
+            count=Count('id')
+        ).order_by()
+        for row in errors:
+            ConnectionErrorRollup.objects.filter(
+                error_hash=ConnectionErrorRollup.hash_message(row['error_message'])
+            ).update(archived_count=F('archived_count') + row['count'])
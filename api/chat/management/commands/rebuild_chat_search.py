@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from chat.models import ChatMessage
+from chat.search import fts_available, fts_supported, rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-index every existing message in the chat message full-text search index"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help="Database to rebuild the index in")
+
+    def handle(self, *args, **options):
+        using = options['database']
+        if not fts_supported(using):
+            self.stderr.write("The search index needs SQLite with FTS5; searches fall back to substring matching")
+            return
+        if not fts_available(using):
+            raise CommandError("The search index doesn't exist; run migrate to create it")
+        with transaction.atomic(using=using):
+            rebuild_search_index(using)
+        self.stdout.write(f"Indexed {ChatMessage.objects.using(using).count()} chat messages")
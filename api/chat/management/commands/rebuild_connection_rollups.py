@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncHour
+
+from chat.models import ConnectionLifecycle, ConnectionErrorRollup, ConnectionStatsRollup, increment_rollup
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the connection statistics rollups from the ConnectionLifecycle rows. "
+        "Counts for rows removed by prune_connection_attempts are kept."
+    )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            # Hours before the oldest raw row have been pruned; their rollups
+            # are the only record left, so keep them
+            oldest = ConnectionLifecycle.objects.order_by('timestamp').values_list('timestamp', flat=True).first()
+            hourly_rollups = ConnectionStatsRollup.objects.filter(period=ConnectionStatsRollup.PERIOD_HOUR)
+            if oldest is not None:
+                hourly_rollups.filter(period_start__gte=ConnectionStatsRollup.truncate_hour(oldest)).delete()
+            ConnectionStatsRollup.objects.filter(period=ConnectionStatsRollup.PERIOD_TOTAL).delete()
+            kept = list(ConnectionStatsRollup.objects.filter(period=ConnectionStatsRollup.PERIOD_HOUR))
+
+            hourly = ConnectionLifecycle.objects.annotate(
+                hour=TruncHour('timestamp')
+            ).values('hour').annotate(
+                attempts=Count('id'),
+                successes=Count('id', filter=Q(successful=True)),
+                duration_sum=Sum('connection_duration_ms'),
+                duration_count=Count('connection_duration_ms'),
+            ).order_by()
+
+            rollups = [
+                ConnectionStatsRollup(
+                    period=ConnectionStatsRollup.PERIOD_HOUR,
+                    period_start=row['hour'],
+                    attempts=row['attempts'],
+                    successes=row['successes'],
+                    failures=row['attempts'] - row['successes'],
+                    duration_sum=row['duration_sum'] or 0,
+                    duration_count=row['duration_count'],
+                )
+                for row in hourly
+            ]
+            total = ConnectionStatsRollup(
+                period=ConnectionStatsRollup.PERIOD_TOTAL,
+                period_start=ConnectionStatsRollup.TOTAL_START,
+            )
+            for rollup in kept + rollups:
+                for field in ('attempts', 'successes', 'failures', 'duration_sum', 'duration_count'):
+                    setattr(total, field, getattr(total, field) + getattr(rollup, field))
+            if kept or rollups:
+                rollups.append(total)
+            ConnectionStatsRollup.objects.bulk_create(rollups)
+
+            # Error counts start from what has been archived by pruning
+            ConnectionErrorRollup.objects.update(count=F('archived_count'))
+
+            errors = ConnectionLifecycle.objects.filter(
+                successful=False,
+                error_message__isnull=False
+            ).exclude(
+                error_message=""
+            ).values('error_message').annotate(
+                count=Count('id')
+            ).order_by()
+            for row in errors:
+                increment_rollup(
+                    ConnectionErrorRollup,
+                    {'error_hash': ConnectionErrorRollup.hash_message(row['error_message'])},
+                    defaults={'error_message': row['error_message']},
+                    count=row['count'],
+                )
+            ConnectionErrorRollup.objects.filter(count=0).delete()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt {len(rollups)} connection rollups and {len(errors)} error rollups"
+        ))
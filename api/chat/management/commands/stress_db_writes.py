@@ -0,0 +1,202 @@
+import asyncio
+import collections
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+
+from chat.benchmarking import (
+    BENCHMARK_HEADERS,
+    InProcessClient,
+    benchmark_room,
+    delete_benchmark_connections,
+    delete_benchmark_messages,
+)
+from chat.buffers import DURABILITY_LEVELS, DURABILITY_SYNC, _buffers, close_buffers
+from chat.models import ChatMessage, ConnectionAttempt, ConnectionLifecycle
+from chat.ratelimit import rate_limiter
+from chat.writer import db_writer
+
+USERNAME = 'stress_db_writes'
+
+
+@sync_to_async
+def count_rows():
+    return {
+        'chat_messages': ChatMessage.objects.count(),
+        'connections': ConnectionLifecycle.objects.count(),
+        'connection_attempts': ConnectionAttempt.objects.count(),
+    }
+
+
+def read_messages():
+    return ChatMessage.objects.filter(username=USERNAME).order_by('-timestamp')[:50].count()
+
+
+def journal_mode():
+    if connection.vendor != 'sqlite':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA journal_mode")
+        return cursor.fetchone()[0]
+
+
+class Command(BaseCommand):
+    help = (
+        "Open hundreds of concurrent in-process WebSocket connections that all write "
+        "to the database at once, with readers running alongside, and report rows "
+        "written, database errors and how the writer thread batched the writes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=300,
+                            help="Concurrent connections, each in its own room")
+        parser.add_argument('--messages', type=int, default=5,
+                            help="Messages each connection sends")
+        parser.add_argument('--readers', type=int, default=4,
+                            help="Concurrent tasks reading chat messages from their own threads")
+        parser.add_argument('--durability', choices=DURABILITY_LEVELS, default=DURABILITY_SYNC,
+                            help="Chat message durability; 'sync' writes each message on its own")
+        parser.add_argument('--no-writer', action='store_true',
+                            help="Write from executor threads instead of the database writer thread")
+        parser.add_argument('--timeout', type=float, default=30,
+                            help="Seconds to wait for each connection and each message to come back")
+        parser.add_argument('--json', action='store_true',
+                            help="Print results as JSON")
+
+    def handle(self, *args, **options):
+        # Every simulated client shares one address
+        rate_limiter.enabled = False
+        db_writer.enabled = not options['no_writer']
+        persistence = {**getattr(settings, 'CHAT_MESSAGE_PERSISTENCE', {}), 'DURABILITY': options['durability']}
+        # room -> sequence numbers of the messages sent to it
+        sent = collections.defaultdict(set)
+        try:
+            with override_settings(CHAT_MESSAGE_PERSISTENCE=persistence):
+                result = asyncio.run(self.run(options, sent))
+        finally:
+            # Remove the messages and connections of this run, and nothing else
+            for room, seqs in sent.items():
+                delete_benchmark_messages(room, seqs)
+            delete_benchmark_connections()
+
+        if options['json']:
+            self.stdout.write(json.dumps(result, indent=2))
+            return
+
+        self.stdout.write(
+            f"{result['connections']} connections x {result['messages_per_connection']} messages, "
+            f"durability {result['durability']}, writer thread {'on' if result['writer_thread'] else 'off'}, "
+            f"journal mode {result['journal_mode']}"
+        )
+        self.stdout.write(
+            f"{result['elapsed_s']}s, {result['messages_per_second']} msg/s, "
+            f"{result['delivered']}/{result['expected_messages']} messages echoed, {result['reads']} reads"
+        )
+        self.stdout.write(
+            f"DB rows written: {result['db_rows_written']['chat_messages']} chat messages, "
+            f"{result['db_rows_written']['connections']} connections, "
+            f"{result['db_rows_written']['connection_attempts']} connection attempts, "
+            f"{result['buffer_write_errors']} rows lost to write errors"
+        )
+        if result['writer_thread']:
+            writer = result['writer']
+            self.stdout.write(
+                f"Writer: {writer['operations']} operations in {writer['transactions']} transactions, "
+                f"largest batch {writer['largest_batch']}"
+            )
+        if result['errors']:
+            self.stdout.write("Errors:")
+            for error, count in result['errors'].items():
+                self.stdout.write(f"  {count:>6}  {error}")
+        else:
+            self.stdout.write("No errors")
+
+    async def run(self, options, sent):
+        from api.asgi import application
+
+        run_room = benchmark_room('stress')
+
+        rows_before = await count_rows()
+        write_errors_before = sum(buffer.write_errors for buffer in _buffers)
+        writer_before = db_writer.stats()
+        errors = collections.Counter()
+
+        def record_error(e):
+            errors[f"{type(e).__name__}: {e}".splitlines()[0][:200]] += 1
+
+        async def session(index):
+            room = f"{run_room}-{index}"
+            try:
+                client = await InProcessClient.connect(
+                    application, f"/ws/chat/{room}/", options['timeout'], headers=BENCHMARK_HEADERS
+                )
+            except Exception as e:
+                record_error(e)
+                return 0
+            delivered = 0
+            try:
+                for sequence in range(options['messages']):
+                    await client.send_text(json.dumps({"message": f"{index}:{sequence}", "username": USERNAME}))
+                for _ in range(options['messages']):
+                    frame = await client.receive_text(options['timeout'])
+                    sent[room].add(json.loads(frame).get('seq'))
+                    delivered += 1
+            except Exception as e:
+                record_error(e)
+            finally:
+                try:
+                    await client.close()
+                except Exception as e:
+                    record_error(e)
+            return delivered
+
+        stopping = False
+        reads = 0
+
+        async def reader():
+            nonlocal reads
+            while not stopping:
+                try:
+                    await sync_to_async(read_messages, thread_sensitive=False)()
+                    reads += 1
+                except Exception as e:
+                    record_error(e)
+                await asyncio.sleep(0)
+
+        readers = [asyncio.ensure_future(reader()) for _ in range(options['readers'])]
+        started = time.perf_counter()
+        delivered = await asyncio.gather(*(session(index) for index in range(options['connections'])))
+        await close_buffers()
+        elapsed = time.perf_counter() - started
+        stopping = True
+        await asyncio.gather(*readers)
+
+        rows_after = await count_rows()
+        writer_after = db_writer.stats()
+        expected = options['connections'] * options['messages']
+        return {
+            'connections': options['connections'],
+            'messages_per_connection': options['messages'],
+            'durability': options['durability'],
+            'writer_thread': db_writer.enabled,
+            'journal_mode': await sync_to_async(journal_mode)(),
+            'elapsed_s': round(elapsed, 2),
+            'expected_messages': expected,
+            'delivered': sum(delivered),
+            'messages_per_second': round(expected / elapsed, 1),
+            'reads': reads,
+            'db_rows_written': {
+                name: rows_after[name] - rows_before[name] for name in rows_after
+            },
+            'buffer_write_errors': sum(buffer.write_errors for buffer in _buffers) - write_errors_before,
+            'writer': {
+                name: writer_after[name] - writer_before[name]
+                for name in ('operations', 'transactions', 'retried', 'errors')
+            } | {'largest_batch': writer_after['largest_batch']},
+            'errors': dict(errors.most_common()),
+        }
@@ -0,0 +1,309 @@
+import bisect
+import math
+
+# Latency buckets in seconds, from half a millisecond to ten seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in labels) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    """
+    A named metric with optional labels, exported in the Prometheus text format.
+
+    Each distinct set of label values gets a child from ``labels()`` that
+    callers can keep and update directly, so the hot path is one attribute
+    update. Updates aren't locked: every metric here is updated from a
+    single thread, either the event loop or the database writer.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        if not self.labelnames:
+            self._unlabelled = self.labels()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            child = self.children[values] = self.child_class(self)
+        return child
+
+    def samples(self):
+        """Yield (suffix, labels, value) for every child"""
+        for values, child in list(self.children.items()):
+            yield from child.samples(list(zip(self.labelnames, values)))
+
+
+class CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self, metric):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, labels):
+        yield '', labels, self.value
+
+
+class Counter(Metric):
+    type = 'counter'
+    child_class = CounterChild
+
+    def inc(self, amount=1):
+        self._unlabelled.value += amount
+
+
+class GaugeChild:
+    __slots__ = ('value',)
+
+    def __init__(self, metric):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, labels):
+        yield '', labels, self.value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+    child_class = GaugeChild
+
+    def inc(self, amount=1):
+        self._unlabelled.value += amount
+
+    def dec(self, amount=1):
+        self._unlabelled.value -= amount
+
+
+class HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, metric):
+        self.buckets = metric.buckets
+        # Per-bucket counts, made cumulative only when scraped
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, labels):
+        cumulative = 0
+        for bound, count in zip((*self.buckets, math.inf), self.counts):
+            cumulative += count
+            yield '_bucket', [*labels, ('le', format_value(bound))], cumulative
+        yield '_sum', labels, self.sum
+        yield '_count', labels, cumulative
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    child_class = HistogramChild
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value):
+        self._unlabelled.observe(value)
+
+
+class Registry:
+    """
+    Holds the process's metrics and renders them on demand.
+
+    Collectors are callables run only when the metrics are scraped. They
+    read state the server keeps anyway, such as queue depths, and return
+    ``(name, type, documentation, [(labels, value), ...])`` tuples, so
+    that state costs nothing to export between scrapes.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+        return collector
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        for collector in self.collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{format_labels(list(labels.items()))} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+HANDSHAKE_DURATION = registry.histogram(
+    'chat_handshake_duration_seconds',
+    "Time from the WebSocket connect to each handshake stage",
+    ['stage'],
+)
+CONNECTIONS_ACTIVE = registry.gauge(
+    'chat_connections_active',
+    "Accepted WebSocket connections that are still open",
+)
+CONNECTIONS = registry.counter(
+    'chat_connections_total',
+    "WebSocket connections by handshake outcome",
+    ['outcome'],
+)
+FRAMES = registry.counter(
+    'chat_frames_total',
+    "WebSocket frames by direction",
+    ['direction'],
+)
+FRAME_BYTES = registry.counter(
+    'chat_frame_bytes_total',
+    "WebSocket frame payload bytes by direction",
+    ['direction'],
+)
+GROUP_SEND_DURATION = registry.histogram(
+    'chat_group_send_duration_seconds',
+    "Time taken by channel layer group_send for room broadcasts",
+)
+MESSAGE_STAGE_LATENCY = registry.histogram(
+    'chat_message_stage_latency_seconds',
+    "Time from ChatConsumer.receive to each stage of the broadcast path, for traced messages",
+    ['stage'],
+)
+RECEIVE_DURATION = registry.histogram(
+    'chat_receive_duration_seconds',
+    "Time ChatConsumer.receive takes to handle an incoming message",
+)
+DB_WRITE_DURATION = registry.histogram(
+    'chat_db_write_duration_seconds',
+    "Time taken by each database write, by model",
+    ['model'],
+)
+DB_ROWS_WRITTEN = registry.counter(
+    'chat_db_rows_written_total',
+    "Rows written to the database, by model",
+    ['model'],
+)
+
+
+@registry.add_collector
+def collect_server_state():
+    """Export queue depths and cache counters the server already tracks"""
+    from .buffers import _buffers
+    from .diagnostics import handshake_probe
+    from .history import recent_messages
+    from .liveness import connection_tracker
+    from .outbound import outbound_stats
+    from .ratelimit import totals as rate_limit_totals
+    from .replay import message_sequencer
+    from .rooms import room_registry
+    from .writer import db_writer
+
+    buffer_stats = [(buffer.model.__name__, buffer.stats()) for buffer in _buffers]
+    outbound = outbound_stats(slowest=0)
+    rooms = room_registry.stats()
+    history = recent_messages.stats()
+    writer = db_writer.stats()
+    tracking = connection_tracker.stats()
+    probe = handshake_probe.last or {}
+    return [
+        ('chat_write_buffer_depth', 'gauge', "Rows waiting in each write-behind buffer",
+         [({'model': model}, stats['queue_depth']) for model, stats in buffer_stats]),
+        ('chat_write_buffer_dropped_total', 'counter', "Rows discarded by each write-behind buffer",
+         [({'model': model}, stats['dropped'] + stats['sampled_out']) for model, stats in buffer_stats]),
+        ('chat_write_buffer_errors_total', 'counter', "Rows lost to failed writes in each write-behind buffer",
+         [({'model': model}, stats['write_errors']) for model, stats in buffer_stats]),
+        ('chat_outbound_queued', 'gauge', "Frames waiting in per-connection outbound queues",
+         [({}, outbound['queued'])]),
+        ('chat_outbound_max_depth', 'gauge', "Deepest per-connection outbound queue",
+         [({}, outbound['max_depth'])]),
+        ('chat_outbound_actions_total', 'counter', "Slow-consumer policy actions",
+         [({'action': action}, outbound[action]) for action in ('dropped', 'coalesced', 'disconnected')]),
+        ('chat_rate_limited_frames_total', 'counter', "Incoming frames over a rate limit, by limit scope and action",
+         [({'scope': scope, 'action': action}, count) for (scope, action), count in sorted(rate_limit_totals.items())]),
+        ('chat_db_writer_queue_depth', 'gauge', "Write operations waiting for the database writer thread",
+         [({}, writer['queue_depth'])]),
+        ('chat_db_writer_transactions_total', 'counter', "Transactions committed by the database writer thread",
+         [({}, writer['transactions'])]),
+        ('chat_db_writer_operations_total', 'counter', "Write operations run by the database writer thread",
+         [({}, writer['operations'])]),
+        ('chat_connections_tracked', 'gauge', "Connections with tracking state in this process",
+         [({}, tracking['tracked'])]),
+        ('chat_connections_live', 'gauge', "Connection handlers running in this process",
+         [({}, tracking['live'])]),
+        ('chat_connections_reaped_total', 'counter', "Heartbeat connections closed for being idle",
+         [({}, tracking['reaped_idle'])]),
+        ('chat_connection_tracking_expired_total', 'counter', "Tracking entries dropped by the sweeper",
+         [({}, tracking['expired'])]),
+        ('chat_probe_up', 'gauge', "Whether the last diagnostics handshake probe succeeded",
+         [({}, 1 if probe.get('status') == 'ok' else 0)] if probe else []),
+        ('chat_probe_handshake_seconds', 'gauge', "WebSocket handshake time of the last diagnostics probe",
+         [({}, probe['handshake_ms'] / 1000)] if probe.get('handshake_ms') is not None else []),
+        ('chat_probe_round_trip_seconds', 'gauge', "Echo round trip through the channel layer in the last diagnostics probe",
+         [({}, probe['round_trip_ms'] / 1000)] if probe.get('round_trip_ms') is not None else []),
+        ('chat_probe_failures_total', 'counter', "Failed diagnostics handshake probes",
+         [({}, handshake_probe.failures)]),
+        ('chat_rooms', 'gauge', "Rooms with members in this process",
+         [({}, rooms['rooms'])]),
+        ('chat_room_members', 'gauge', "Room members in this process",
+         [({}, rooms['members'])]),
+        ('chat_room_broadcasts_lost_total', 'counter', "Room broadcasts dropped on a full queue or failed in the channel layer",
+         [({'reason': 'dropped'}, rooms['dropped_broadcasts']), ({'reason': 'failed'}, rooms['failed_broadcasts'])]),
+        ('chat_replays_total', 'counter', "Reconnecting clients sent the messages they missed, by source",
+         [({'source': source}, count) for source, count in sorted(message_sequencer.replays.items())]),
+        ('chat_replayed_messages_total', 'counter', "Messages replayed to reconnecting clients, by source",
+         [({'source': source}, count) for source, count in sorted(message_sequencer.replayed.items())]),
+        ('chat_history_cache_requests_total', 'counter', "Chat history cache lookups",
+         [({'result': 'hit'}, history['hits']), ({'result': 'miss'}, history['misses'])]),
+    ]
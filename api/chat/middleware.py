@@ -1,20 +1,119 @@
 from channels.middleware import BaseMiddleware
-from asgiref.sync import sync_to_async
-from .models import ConnectionAttempt
+from django.conf import settings
+from .buffers import get_connection_log_buffer, get_frame_log_buffer
+from .diagnostics import PROBE_PATH
+from .liveness import SCOPE_KEY, connection_tracker
+from .metrics import CONNECTIONS, CONNECTIONS_ACTIVE, FRAME_BYTES, FRAMES, HANDSHAKE_DURATION
+from .models import ConnectionAttempt, ConnectionLifecycle, HeaderSet
+from .ratelimit import ACTION_CLOSE, ACTION_DELAY, ACTION_DROP, rate_limiter
+import asyncio
 import traceback
 import json
+import random
 import time
+from datetime import datetime, timezone as dt_timezone
 from django.utils import timezone
 
+FRAME_LOGGING_MODES = ('aggregate', 'per_frame', 'sample')
+
+FRAMES_IN = FRAMES.labels('in')
+FRAMES_OUT = FRAMES.labels('out')
+BYTES_IN = FRAME_BYTES.labels('in')
+BYTES_OUT = FRAME_BYTES.labels('out')
+
+
+def frame_size(message):
+    """Return the payload size in bytes of a websocket.receive/send message"""
+    if message.get('bytes') is not None:
+        return len(message['bytes'])
+    if message.get('text') is not None:
+        return len(message['text'].encode('utf-8'))
+    return 0
+
+
+class FrameCounters:
+    """
+    In-memory frame and byte counters for a single connection.
+    They are written once, on the connection's disconnect record.
+    """
+    __slots__ = ('frames_in', 'frames_out', 'bytes_in', 'bytes_out',
+                 'first_message_at', 'last_message_at')
+
+    def __init__(self):
+        self.frames_in = 0
+        self.frames_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.first_message_at = None
+        self.last_message_at = None
+
+    def _touch(self):
+        now = time.time()
+        if self.first_message_at is None:
+            self.first_message_at = now
+        self.last_message_at = now
+
+    def record_in(self, message):
+        size = frame_size(message)
+        self.frames_in += 1
+        self.bytes_in += size
+        self._touch()
+        FRAMES_IN.inc()
+        BYTES_IN.inc(size)
+        return size
+
+    def record_out(self, message):
+        size = frame_size(message)
+        self.frames_out += 1
+        self.bytes_out += size
+        self._touch()
+        FRAMES_OUT.inc()
+        BYTES_OUT.inc(size)
+
+    def as_fields(self):
+        """Return the counters as ConnectionLifecycle field values"""
+        def to_datetime(ts):
+            return datetime.fromtimestamp(ts, tz=dt_timezone.utc) if ts is not None else None
+
+        return {
+            'frames_in': self.frames_in,
+            'frames_out': self.frames_out,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'first_message_at': to_datetime(self.first_message_at),
+            'last_message_at': to_datetime(self.last_message_at),
+        }
+
 class WebSocketConnectionLoggingMiddleware:
     """
     ASGI middleware to log WebSocket connection attempts.
     This logs connections even if they fail before reaching the consumer.
+
+    Each connection is written once, as a ConnectionLifecycle row queued
+    when its handler returns, with the time of every stage it reached.
     """
     
     def __init__(self, inner):
         self.inner = inner
-        self.connection_start_times = {}
+
+        # 'aggregate' only writes per-connection counters at disconnect,
+        # 'per_frame' also logs a row for every received frame and 'sample'
+        # logs a row for a fraction of received frames.
+        self.frame_logging = getattr(settings, 'WEBSOCKET_FRAME_LOGGING', 'aggregate')
+        if self.frame_logging not in FRAME_LOGGING_MODES:
+            raise ValueError(
+                f"Unknown WEBSOCKET_FRAME_LOGGING mode {self.frame_logging!r}, "
+                f"expected one of {', '.join(FRAME_LOGGING_MODES)}"
+            )
+        self.frame_sample_rate = getattr(settings, 'WEBSOCKET_FRAME_SAMPLE_RATE', 0.01)
+
+    def should_log_frame(self):
+        """Decide whether a received frame gets its own log row"""
+        if self.frame_logging == 'per_frame':
+            return True
+        if self.frame_logging == 'sample':
+            return random.random() < self.frame_sample_rate
+        return False
     
     async def __call__(self, scope, receive, send):
         """
@@ -25,6 +124,11 @@ class WebSocketConnectionLoggingMiddleware:
             receive: The receive channel
             send: The send channel
         """
+        if scope['type'] == 'websocket' and scope.get('path') == PROBE_PATH:
+            # Diagnostics probe connections would skew the connection log,
+            # its rollups and the metrics every probe interval
+            return await self.inner(scope, receive, send)
+
         if scope['type'] == 'websocket':
             # Extract client info from the scope
             client_ip = None
@@ -48,37 +152,47 @@ class WebSocketConnectionLoggingMiddleware:
             # Extract user agent from headers if available
             user_agent = headers_dict.get('user-agent', '')
             
-            # Create unique connection identifier
-            connection_id = f"{client_ip}:{id(scope)}"
+            # Headers are stored once per distinct set and referenced by fingerprint
+            header_set = HeaderSet.for_headers(headers_dict)
+            
+            # Track the connection until its handler returns, however it ends
+            tracked = connection_tracker.open(client_ip, connection_path)
+            scope = dict(scope, **{SCOPE_KEY: tracked})
+            handshake_start = time.perf_counter()
+            accepted = False
+            
+            # Frame and byte counters for this connection
+            counters = FrameCounters()
             
-            # Record start time
-            self.connection_start_times[connection_id] = time.time()
+            # Filled in as the connection goes through its stages, written when it ends
+            lifecycle = ConnectionLifecycle(
+                client_ip=client_ip,
+                user_agent=user_agent,
+                connection_path=connection_path,
+                header_set=header_set
+            )
             
-            # Create a wrapper for the send function to track disconnection
+            # Token buckets for this connection and its address
+            rate_limit = rate_limiter.connect(client_ip)
+            
+            def record_close(close_code):
+                # The first close, from either side, is the one that counts
+                if lifecycle.closed_at is None:
+                    lifecycle.closed_at = timezone.now()
+                    lifecycle.close_code = close_code
+            
+            # Create a wrapper for the send function to track outgoing frames and disconnection
             original_send = send
             
             async def send_wrapper(message):
-                if message['type'] == 'websocket.close':
-                    # Calculate connection duration
-                    start_time = self.connection_start_times.get(connection_id)
-                    duration_ms = None
-                    if start_time:
-                        duration_ms = int((time.time() - start_time) * 1000)
-                        # Clean up the start time
-                        if connection_id in self.connection_start_times:
-                            del self.connection_start_times[connection_id]
-                    
-                    # Log disconnection with close code
-                    close_code = message.get('code')
-                    await self.log_connection_stage(
-                        client_ip, 
-                        user_agent, 
-                        'disconnected', 
-                        connection_path,
-                        headers_dict,
-                        close_code=close_code,
-                        connection_duration_ms=duration_ms
-                    )
+                if message['type'] == 'websocket.send':
+                    counters.record_out(message)
+                elif message['type'] == 'websocket.close':
+                    if not accepted:
+                        HANDSHAKE_DURATION.labels('rejected').observe(time.perf_counter() - handshake_start)
+                        CONNECTIONS.labels('rejected').inc()
+                        lifecycle.outcome = ConnectionLifecycle.OUTCOME_REJECTED
+                    record_close(message.get('code'))
                 
                 # Call the original send function
                 return await original_send(message)
@@ -87,95 +201,112 @@ class WebSocketConnectionLoggingMiddleware:
             original_receive = receive
             
             async def receive_wrapper():
-                message = await original_receive()
+                while True:
+                    message = await original_receive()
+                    if message['type'] != 'websocket.receive':
+                        break
+                    size = counters.record_in(message)
+                    tracked.touch()
+                    action, delay = rate_limit.check(size)
+                    if action == ACTION_DROP:
+                        # The consumer never sees the frame
+                        continue
+                    if action == ACTION_DELAY:
+                        await asyncio.sleep(delay)
+                    elif action == ACTION_CLOSE:
+                        close_code = rate_limiter.config['close_code']
+                        await send_wrapper({'type': 'websocket.close', 'code': close_code})
+                        # Let the consumer run its disconnect handler and stop
+                        return {'type': 'websocket.disconnect', 'code': close_code}
+                    break
                 
                 if message['type'] == 'websocket.receive':
-                    # Log message received event
-                    await self.log_connection_stage(
-                        client_ip,
-                        user_agent,
-                        'message_received',
-                        connection_path,
-                        headers_dict,
-                        successful=True
-                    )
+                    if self.should_log_frame():
+                        # Log message received event
+                        await self.log_connection_stage(
+                            client_ip,
+                            user_agent,
+                            'message_received',
+                            connection_path,
+                            header_set,
+                            successful=True
+                        )
+                elif message['type'] == 'websocket.disconnect':
+                    # The client went away without the server closing
+                    record_close(message.get('code'))
                 
                 return message
             
             try:
-                # Log pre-handshake connection attempt
-                await self.log_connection_stage(
-                    client_ip, 
-                    user_agent, 
-                    'pre_handshake',
-                    connection_path,
-                    headers_dict
-                )
-                
                 # Intercept the accept message
                 original_inner = self.inner
                 
                 async def inner_wrapper(inner_scope, inner_receive, inner_send):
                     async def inner_send_wrapper(message):
+                        nonlocal accepted
                         if message['type'] == 'websocket.accept':
-                            # Log successful handshake
-                            await self.log_connection_stage(
-                                client_ip,
-                                user_agent,
-                                'connected',
-                                connection_path,
-                                headers_dict,
-                                successful=True
-                            )
+                            accepted = True
+                            HANDSHAKE_DURATION.labels('connected').observe(time.perf_counter() - handshake_start)
+                            CONNECTIONS.labels('accepted').inc()
+                            CONNECTIONS_ACTIVE.inc()
+                            lifecycle.connected_at = timezone.now()
+                            lifecycle.successful = True
                         
                         return await inner_send(message)
                     
                     return await original_inner(inner_scope, inner_receive, inner_send_wrapper)
                 
                 # Continue processing the connection with our wrappers
+                HANDSHAKE_DURATION.labels('pre_handshake').observe(time.perf_counter() - handshake_start)
                 return await inner_wrapper(scope, receive_wrapper, send_wrapper)
                 
             except Exception as e:
                 # If an error occurs, log the failed connection
-                error_message = f"{str(e)}\n{traceback.format_exc()}"
-                
-                # Calculate connection duration
-                start_time = self.connection_start_times.get(connection_id)
-                duration_ms = None
-                if start_time:
-                    duration_ms = int((time.time() - start_time) * 1000)
-                    # Clean up the start time
-                    if connection_id in self.connection_start_times:
-                        del self.connection_start_times[connection_id]
-                
-                await self.log_connection_stage(
-                    client_ip, 
-                    user_agent, 
-                    'handshake', 
-                    connection_path,
-                    headers_dict,
-                    successful=False,
-                    error_message=error_message,
-                    connection_duration_ms=duration_ms
-                )
+                if not accepted:
+                    HANDSHAKE_DURATION.labels('failed').observe(time.perf_counter() - handshake_start)
+                    CONNECTIONS.labels('failed').inc()
+                lifecycle.error_message = f"{str(e)}\n{traceback.format_exc()}"
+                lifecycle.outcome = ConnectionLifecycle.OUTCOME_FAILED
                 # Re-raise the exception
                 raise
+            finally:
+                await self.log_connection(lifecycle, accepted, tracked, counters)
+                connection_tracker.close(tracked)
+                rate_limit.release()
+                if accepted:
+                    CONNECTIONS_ACTIVE.dec()
         else:
             # Not a WebSocket connection, pass through
             return await self.inner(scope, receive, send)
     
-    @sync_to_async
-    def log_connection_stage(self, client_ip, user_agent, connection_stage, connection_path, headers, 
-                           successful=False, error_message=None, close_code=None, connection_duration_ms=None):
-        """Log a connection attempt or stage to the database"""
-        ConnectionAttempt.objects.create(
+    async def log_connection(self, lifecycle, accepted, tracked, counters):
+        """Complete a connection's lifecycle record and queue it for the write-behind log buffer"""
+        if not lifecycle.outcome:
+            if accepted:
+                lifecycle.outcome = ConnectionLifecycle.OUTCOME_CLOSED
+            else:
+                lifecycle.outcome = ConnectionLifecycle.OUTCOME_ABANDONED
+        if lifecycle.closed_at is None:
+            lifecycle.closed_at = timezone.now()
+        lifecycle.connection_duration_ms = int((time.time() - tracked.started) * 1000)
+        for field, value in counters.as_fields().items():
+            setattr(lifecycle, field, value)
+        await get_connection_log_buffer().enqueue(lifecycle)
+    
+    async def log_connection_stage(self, client_ip, user_agent, connection_stage, connection_path, header_set, 
+                           successful=False, error_message=None, close_code=None, connection_duration_ms=None,
+                           counters=None):
+        """Queue a per-frame ConnectionAttempt row for the frame log buffer"""
+        counter_fields = counters.as_fields() if counters is not None else {}
+        await get_frame_log_buffer().enqueue(ConnectionAttempt(
             client_ip=client_ip,
             user_agent=user_agent,
             successful=successful,
             error_message=error_message,
             connection_path=connection_path,
-            headers=headers,
+            header_set=header_set,
             close_code=close_code,
             connection_duration_ms=connection_duration_ms,
-            connection_stage=connection_stage
-        )
+            connection_stage=connection_stage,
+            **counter_fields
+        ))
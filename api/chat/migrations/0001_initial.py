@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:19
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=255)),
+                ('message', models.TextField()),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ['timestamp'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ConnectionAttempt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('client_ip', models.GenericIPAddressField(blank=True, null=True)),
+                ('user_agent', models.TextField(blank=True, null=True)),
+                ('successful', models.BooleanField(default=False)),
+                ('error_message', models.TextField(blank=True, null=True)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('connection_path', models.CharField(blank=True, max_length=255, null=True)),
+                ('headers', models.JSONField(blank=True, null=True)),
+                ('close_code', models.IntegerField(blank=True, null=True)),
+                ('connection_duration_ms', models.IntegerField(blank=True, null=True)),
+                ('connection_stage', models.CharField(blank=True, choices=[('pre_handshake', 'Before Handshake'), ('handshake', 'During Handshake'), ('connected', 'Connected'), ('message_received', 'Message Received'), ('message_sent', 'Message Sent'), ('disconnected', 'Disconnected')], max_length=50, null=True)),
+            ],
+            options={
+                'ordering': ['-timestamp'],
+            },
+        ),
+    ]
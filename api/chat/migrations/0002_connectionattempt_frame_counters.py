@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='connectionattempt',
+            name='bytes_in',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='connectionattempt',
+            name='bytes_out',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='connectionattempt',
+            name='first_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='connectionattempt',
+            name='frames_in',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='connectionattempt',
+            name='frames_out',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='connectionattempt',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
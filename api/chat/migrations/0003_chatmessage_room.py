@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_connectionattempt_frame_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='room',
+            field=models.CharField(default='chat_room', max_length=64),
+        ),
+    ]
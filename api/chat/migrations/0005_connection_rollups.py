@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chatmessage_history_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConnectionErrorRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('error_hash', models.CharField(max_length=64, unique=True)),
+                ('error_message', models.TextField()),
+                ('count', models.PositiveBigIntegerField(db_index=True, default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ConnectionStatsRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('total', 'All time')], max_length=10)),
+                ('period_start', models.DateTimeField()),
+                ('attempts', models.PositiveBigIntegerField(default=0)),
+                ('successes', models.PositiveBigIntegerField(default=0)),
+                ('failures', models.PositiveBigIntegerField(default=0)),
+                ('duration_sum', models.PositiveBigIntegerField(default=0)),
+                ('duration_count', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('period', 'period_start'), name='chat_stats_rollup_period_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:19
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_connection_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HeaderSet',
+            fields=[
+                ('fingerprint', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('headers', models.JSONField()),
+                ('first_seen', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='connectionerrorrollup',
+            name='archived_count',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='connectionattempt',
+            name='header_set',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='chat.headerset'),
+        ),
+        migrations.AddIndex(
+            model_name='connectionattempt',
+            index=models.Index(fields=['timestamp'], name='chat_attempt_timestamp_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:19
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_headerset'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConnectionLifecycle',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('client_ip', models.GenericIPAddressField(blank=True, null=True)),
+                ('user_agent', models.TextField(blank=True, null=True)),
+                ('connection_path', models.CharField(blank=True, max_length=255, null=True)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('connected_at', models.DateTimeField(blank=True, null=True)),
+                ('closed_at', models.DateTimeField(blank=True, null=True)),
+                ('outcome', models.CharField(choices=[('closed', 'Accepted, then closed'), ('rejected', 'Rejected by the server'), ('abandoned', 'Client left during the handshake'), ('failed', 'Failed with an error')], max_length=20)),
+                ('successful', models.BooleanField(default=False)),
+                ('error_message', models.TextField(blank=True, null=True)),
+                ('close_code', models.IntegerField(blank=True, null=True)),
+                ('connection_duration_ms', models.IntegerField(blank=True, null=True)),
+                ('frames_in', models.PositiveIntegerField(default=0)),
+                ('frames_out', models.PositiveIntegerField(default=0)),
+                ('bytes_in', models.PositiveBigIntegerField(default=0)),
+                ('bytes_out', models.PositiveBigIntegerField(default=0)),
+                ('first_message_at', models.DateTimeField(blank=True, null=True)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('header_set', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='chat.headerset')),
+            ],
+            options={
+                'ordering': ['-timestamp'],
+                'indexes': [models.Index(fields=['timestamp'], name='chat_lifecycle_timestamp_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:53
+
+from django.db import migrations, models
+
+
+def clear_duplicate_seqs(apps, schema_editor):
+    # Workers numbering the same room on their own counters could give out
+    # a number twice. Keep it on the earliest row, the others go unnumbered.
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    duplicates = (
+        ChatMessage.objects.filter(seq__isnull=False)
+        .values('room', 'seq')
+        .annotate(count=models.Count('id'), first=models.Min('id'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates:
+        ChatMessage.objects.filter(room=duplicate['room'], seq=duplicate['seq']).exclude(
+            id=duplicate['first']
+        ).update(seq=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_chatmessage_seq'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_seqs, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='chatmessage',
+            name='chat_msg_room_seq_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='chatmessage',
+            constraint=models.UniqueConstraint(fields=('room', 'seq'), name='chat_msg_room_seq_uniq'),
+        ),
+    ]
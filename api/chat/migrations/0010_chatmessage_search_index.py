@@ -0,0 +1,75 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:55
+
+from django.db import migrations
+
+
+class SQLiteFTS5RunSQL(migrations.RunSQL):
+    """RunSQL that only runs on SQLite databases built with FTS5"""
+
+    def applies_to(self, connection):
+        if connection.vendor != 'sqlite':
+            return False
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+            return bool(cursor.fetchone()[0])
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if self.applies_to(schema_editor.connection):
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if self.applies_to(schema_editor.connection):
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_chatmessage_room_seq_unique'),
+    ]
+
+    operations = [
+        # External-content FTS5 index over ChatMessage. The text lives only in
+        # chat_chatmessage, and the triggers keep the index in step with it.
+        # IF NOT EXISTS adopts an index created before this migration.
+        SQLiteFTS5RunSQL(
+            sql=[
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS chat_chatmessage_fts USING fts5(
+                    message, username,
+                    content='chat_chatmessage', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
+                )
+                """,
+                """
+                CREATE TRIGGER IF NOT EXISTS chat_chatmessage_fts_ai AFTER INSERT ON chat_chatmessage BEGIN
+                    INSERT INTO chat_chatmessage_fts(rowid, message, username)
+                    VALUES (new.id, new.message, new.username);
+                END
+                """,
+                """
+                CREATE TRIGGER IF NOT EXISTS chat_chatmessage_fts_ad AFTER DELETE ON chat_chatmessage BEGIN
+                    INSERT INTO chat_chatmessage_fts(chat_chatmessage_fts, rowid, message, username)
+                    VALUES ('delete', old.id, old.message, old.username);
+                END
+                """,
+                """
+                CREATE TRIGGER IF NOT EXISTS chat_chatmessage_fts_au
+                AFTER UPDATE OF message, username ON chat_chatmessage BEGIN
+                    INSERT INTO chat_chatmessage_fts(chat_chatmessage_fts, rowid, message, username)
+                    VALUES ('delete', old.id, old.message, old.username);
+                    INSERT INTO chat_chatmessage_fts(rowid, message, username)
+                    VALUES (new.id, new.message, new.username);
+                END
+                """,
+                # Index the messages already stored
+                "INSERT INTO chat_chatmessage_fts(chat_chatmessage_fts) VALUES ('rebuild')",
+            ],
+            reverse_sql=[
+                "DROP TRIGGER IF EXISTS chat_chatmessage_fts_au",
+                "DROP TRIGGER IF EXISTS chat_chatmessage_fts_ad",
+                "DROP TRIGGER IF EXISTS chat_chatmessage_fts_ai",
+                "DROP TABLE IF EXISTS chat_chatmessage_fts",
+            ],
+        ),
+    ]
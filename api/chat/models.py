@@ -1,11 +1,80 @@
-from django.db import models
+import hashlib
+import json
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import models, transaction
+from django.db.models import F
 from django.utils import timezone
 
 # Create your models here.
 
+def increment_rollup(model, lookup, defaults=None, **amounts):
+    """Add ``amounts`` to the rollup row matching ``lookup``, creating it if needed"""
+    updates = {field: F(field) + amount for field, amount in amounts.items()}
+    if model.objects.filter(**lookup).update(**updates):
+        return
+    obj, created = model.objects.get_or_create(**lookup, defaults={**(defaults or {}), **amounts})
+    if not created:
+        model.objects.filter(**lookup).update(**updates)
+
+
+class HeaderSet(models.Model):
+    """
+    A distinct set of WebSocket request headers, stored once and
+    referenced from ConnectionLifecycle and ConnectionAttempt by its fingerprint
+    """
+    fingerprint = models.CharField(max_length=64, primary_key=True)
+    headers = models.JSONField()
+    first_seen = models.DateTimeField(default=timezone.now)
+    
+    def __str__(self):
+        return self.fingerprint
+    
+    @classmethod
+    def for_headers(cls, headers):
+        """Return an unsaved HeaderSet for a headers dict, keyed by its SHA-256 fingerprint"""
+        canonical = json.dumps(headers, sort_keys=True, separators=(',', ':'))
+        return cls(fingerprint=hashlib.sha256(canonical.encode('utf-8')).hexdigest(), headers=headers)
+    
+    @classmethod
+    def ensure(cls, attempts, using=None):
+        """Insert the header sets referenced by ``attempts`` that don't exist yet"""
+        header_sets = {}
+        for attempt in attempts:
+            # Only instances attached in memory need inserting; a bare id already exists
+            field = attempt._meta.get_field('header_set')
+            if field.is_cached(attempt) and attempt.header_set is not None:
+                header_sets[attempt.header_set.fingerprint] = attempt.header_set
+        if header_sets:
+            cls.objects.using(using).bulk_create(header_sets.values(), ignore_conflicts=True)
+
+
+class ConnectionAttemptQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        """Insert the rows along with the header sets they reference"""
+        objs = list(objs)
+        with transaction.atomic(using=self.db):
+            HeaderSet.ensure(objs, using=self.db)
+            objs = super().bulk_create(objs, *args, **kwargs)
+        return objs
+
+
+class ConnectionLifecycleQuerySet(ConnectionAttemptQuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        """Insert the rows and add them to the statistics rollups in one transaction"""
+        with transaction.atomic(using=self.db):
+            objs = super().bulk_create(objs, *args, **kwargs)
+            ConnectionStatsRollup.record(objs)
+        return objs
+
+
 class ConnectionAttempt(models.Model):
     """
-    Model to track WebSocket connection attempts for diagnostic purposes
+    Model to track WebSocket connection attempts for diagnostic purposes.
+
+    Connections are now recorded once each in ConnectionLifecycle. This
+    table keeps the rows written before that, and the per-frame rows of
+    WEBSOCKET_FRAME_LOGGING's 'per_frame' and 'sample' modes.
     """
     client_ip = models.GenericIPAddressField(null=True, blank=True)
     user_agent = models.TextField(null=True, blank=True)
@@ -15,7 +84,9 @@ class ConnectionAttempt(models.Model):
     
     # Additional diagnostic fields
     connection_path = models.CharField(max_length=255, null=True, blank=True)
+    # Only set on rows written before headers were deduplicated into HeaderSet
     headers = models.JSONField(null=True, blank=True)
+    header_set = models.ForeignKey(HeaderSet, null=True, blank=True, on_delete=models.SET_NULL)
     close_code = models.IntegerField(null=True, blank=True)
     connection_duration_ms = models.IntegerField(null=True, blank=True)
     connection_stage = models.CharField(max_length=50, null=True, blank=True, 
@@ -28,57 +99,132 @@ class ConnectionAttempt(models.Model):
                                             ('disconnected', 'Disconnected')
                                         ))
     
+    # Per-connection frame counters, written on the disconnect records of older rows
+    frames_in = models.PositiveIntegerField(null=True, blank=True)
+    frames_out = models.PositiveIntegerField(null=True, blank=True)
+    bytes_in = models.PositiveBigIntegerField(null=True, blank=True)
+    bytes_out = models.PositiveBigIntegerField(null=True, blank=True)
+    first_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    
+    objects = ConnectionAttemptQuerySet.as_manager()
+    
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['timestamp'], name='chat_attempt_timestamp_idx'),
+        ]
     
     def __str__(self):
         status = "Successful" if self.successful else "Failed"
         stage = f" ({self.connection_stage})" if self.connection_stage else ""
         return f"{status}{stage} connection from {self.client_ip} at {self.timestamp}"
     
+    def save(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            if self._state.adding:
+                HeaderSet.ensure([self], using=kwargs.get('using'))
+            super().save(*args, **kwargs)
+
+
+class ConnectionLifecycle(models.Model):
+    """
+    One row per WebSocket connection, written once when it ends, with the
+    time of each stage it reached, how it ended and its frame counters
+    """
+    OUTCOME_CLOSED = 'closed'
+    OUTCOME_REJECTED = 'rejected'
+    OUTCOME_ABANDONED = 'abandoned'
+    OUTCOME_FAILED = 'failed'
+    
+    client_ip = models.GenericIPAddressField(null=True, blank=True)
+    user_agent = models.TextField(null=True, blank=True)
+    connection_path = models.CharField(max_length=255, null=True, blank=True)
+    header_set = models.ForeignKey(HeaderSet, null=True, blank=True, on_delete=models.SET_NULL)
+    
+    # When the connection opened (before the handshake), was accepted and ended
+    timestamp = models.DateTimeField(default=timezone.now)
+    connected_at = models.DateTimeField(null=True, blank=True)
+    closed_at = models.DateTimeField(null=True, blank=True)
+    
+    outcome = models.CharField(max_length=20, choices=(
+        (OUTCOME_CLOSED, 'Accepted, then closed'),
+        (OUTCOME_REJECTED, 'Rejected by the server'),
+        (OUTCOME_ABANDONED, 'Client left during the handshake'),
+        (OUTCOME_FAILED, 'Failed with an error'),
+    ))
+    # Whether the handshake completed
+    successful = models.BooleanField(default=False)
+    error_message = models.TextField(null=True, blank=True)
+    close_code = models.IntegerField(null=True, blank=True)
+    connection_duration_ms = models.IntegerField(null=True, blank=True)
+    
+    frames_in = models.PositiveIntegerField(default=0)
+    frames_out = models.PositiveIntegerField(default=0)
+    bytes_in = models.PositiveBigIntegerField(default=0)
+    bytes_out = models.PositiveBigIntegerField(default=0)
+    first_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    
+    objects = ConnectionLifecycleQuerySet.as_manager()
+    
+    class Meta:
+        ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['timestamp'], name='chat_lifecycle_timestamp_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.get_outcome_display()} connection from {self.client_ip} at {self.timestamp}"
+    
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        with transaction.atomic(using=kwargs.get('using')):
+            if adding:
+                HeaderSet.ensure([self], using=kwargs.get('using'))
+            super().save(*args, **kwargs)
+            if adding:
+                ConnectionStatsRollup.record([self])
+    
     @classmethod
     def get_connection_statistics(cls):
         """
-        Get statistics about WebSocket connections
+        Get statistics about WebSocket connections.
+        These are read from the rollup tables, so the cost doesn't grow with the number of attempts.
         """
-        from django.db.models import Count, Avg, F, FloatField
-        from django.db.models.functions import TruncHour
-        
-        # Get total counts
-        total_attempts = cls.objects.count()
-        successful_attempts = cls.objects.filter(successful=True).count()
+        totals = ConnectionStatsRollup.objects.filter(
+            period=ConnectionStatsRollup.PERIOD_TOTAL
+        ).first()
+        total_attempts = totals.attempts if totals else 0
+        successful_attempts = totals.successes if totals else 0
         failed_attempts = total_attempts - successful_attempts
         
         # Get success rate
         success_rate = (successful_attempts / total_attempts * 100) if total_attempts > 0 else 0
         
         # Get most common error messages
-        common_errors = cls.objects.filter(
-            successful=False, 
-            error_message__isnull=False
-        ).exclude(
-            error_message=""
-        ).values('error_message').annotate(
-            count=Count('error_message')
-        ).order_by('-count')[:5]
+        common_errors = ConnectionErrorRollup.objects.order_by('-count').values(
+            'error_message', 'count'
+        )[:5]
         
         # Get hourly connection attempts for the last 24 hours
-        hourly_data = cls.objects.filter(
-            timestamp__gte=timezone.now() - timezone.timedelta(hours=24)
-        ).annotate(
-            hour=TruncHour('timestamp')
-        ).values('hour').annotate(
-            attempts=Count('id'),
-            successful=Count('id', filter=models.Q(successful=True)),
-            failed=Count('id', filter=models.Q(successful=False)),
-        ).order_by('hour')
+        hourly_data = [
+            {
+                'hour': rollup.period_start,
+                'attempts': rollup.attempts,
+                'successful': rollup.successes,
+                'failed': rollup.failures,
+            }
+            for rollup in ConnectionStatsRollup.objects.filter(
+                period=ConnectionStatsRollup.PERIOD_HOUR,
+                period_start__gte=ConnectionStatsRollup.truncate_hour(
+                    timezone.now() - timezone.timedelta(hours=24)
+                )
+            ).order_by('period_start')
+        ]
         
         # Calculate average connection duration
-        avg_duration = cls.objects.filter(
-            connection_duration_ms__isnull=False
-        ).aggregate(
-            avg_duration=Avg('connection_duration_ms')
-        )['avg_duration'] or 0
+        avg_duration = (totals.duration_sum / totals.duration_count) if totals and totals.duration_count else 0
         
         return {
             'total_attempts': total_attempts,
@@ -86,21 +232,140 @@ class ConnectionAttempt(models.Model):
             'failed_attempts': failed_attempts,
             'success_rate': round(success_rate, 2),
             'common_errors': list(common_errors),
-            'hourly_data': list(hourly_data),
+            'hourly_data': hourly_data,
             'avg_duration': round(avg_duration, 2)
         }
 
 
+class ConnectionStatsRollup(models.Model):
+    """
+    Connection counters per hour, plus one all-time row.
+    Updated in the same transaction as the ConnectionLifecycle rows they count.
+    """
+    PERIOD_HOUR = 'hour'
+    PERIOD_TOTAL = 'total'
+    
+    period = models.CharField(max_length=10, choices=(
+        (PERIOD_HOUR, 'Hour'),
+        (PERIOD_TOTAL, 'All time'),
+    ))
+    period_start = models.DateTimeField()
+    attempts = models.PositiveBigIntegerField(default=0)
+    successes = models.PositiveBigIntegerField(default=0)
+    failures = models.PositiveBigIntegerField(default=0)
+    duration_sum = models.PositiveBigIntegerField(default=0)
+    duration_count = models.PositiveBigIntegerField(default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['period', 'period_start'], name='chat_stats_rollup_period_unique'),
+        ]
+    
+    def __str__(self):
+        return f"{self.period} {self.period_start}: {self.attempts} attempts"
+    
+    # The all-time row uses a fixed start so it can share the unique constraint
+    TOTAL_START = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+    
+    @staticmethod
+    def truncate_hour(value):
+        return value.replace(minute=0, second=0, microsecond=0)
+    
+    @classmethod
+    def record(cls, attempts):
+        """Add newly written ConnectionLifecycle rows to the rollups"""
+        cls._add(attempts, 1)
+    
+    @classmethod
+    def remove(cls, attempts):
+        """
+        Take ConnectionLifecycle rows that are about to be deleted back out
+        of the rollups. Pruned rows stay counted; this is for rows that
+        shouldn't have been counted, like a benchmark's.
+        """
+        cls._add(attempts, -1)
+        cls.objects.filter(period=cls.PERIOD_HOUR, attempts=0).delete()
+        ConnectionErrorRollup.objects.filter(count=0).delete()
+    
+    @classmethod
+    def _add(cls, attempts, sign):
+        counters = {}
+        errors = {}
+        for attempt in attempts:
+            for key in ((cls.PERIOD_HOUR, cls.truncate_hour(attempt.timestamp)),
+                        (cls.PERIOD_TOTAL, cls.TOTAL_START)):
+                counts = counters.setdefault(key, [0, 0, 0, 0, 0])
+                counts[0] += 1
+                if attempt.successful:
+                    counts[1] += 1
+                else:
+                    counts[2] += 1
+                if attempt.connection_duration_ms is not None:
+                    counts[3] += attempt.connection_duration_ms
+                    counts[4] += 1
+            if not attempt.successful and attempt.error_message:
+                errors[attempt.error_message] = errors.get(attempt.error_message, 0) + 1
+        
+        for (period, period_start), counts in counters.items():
+            increment_rollup(
+                cls,
+                {'period': period, 'period_start': period_start},
+                attempts=sign * counts[0],
+                successes=sign * counts[1],
+                failures=sign * counts[2],
+                duration_sum=sign * counts[3],
+                duration_count=sign * counts[4],
+            )
+        for error_message, count in errors.items():
+            increment_rollup(
+                ConnectionErrorRollup,
+                {'error_hash': ConnectionErrorRollup.hash_message(error_message)},
+                defaults={'error_message': error_message},
+                count=sign * count,
+            )
+
+
+class ConnectionErrorRollup(models.Model):
+    """
+    Number of failed connections per distinct error message
+    """
+    error_hash = models.CharField(max_length=64, unique=True)
+    error_message = models.TextField()
+    count = models.PositiveBigIntegerField(default=0, db_index=True)
+    # Part of ``count`` whose ConnectionLifecycle rows have been pruned
+    archived_count = models.PositiveBigIntegerField(default=0)
+    
+    def __str__(self):
+        return f"{self.count}x {self.error_message[:50]}"
+    
+    @staticmethod
+    def hash_message(error_message):
+        return hashlib.sha256(error_message.encode('utf-8')).hexdigest()
+
+
 class ChatMessage(models.Model):
     """
     Model to store chat messages
     """
+    room = models.CharField(max_length=64, default='chat_room')
     username = models.CharField(max_length=255)
     message = models.TextField()
     timestamp = models.DateTimeField(default=timezone.now)
+    # Position in the room, counting up from 1. Null on messages written before sequence numbers.
+    seq = models.PositiveBigIntegerField(null=True, blank=True)
     
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Keyset pagination of a room's history on (timestamp, id)
+            models.Index(fields=['room', 'timestamp', 'id'], name='chat_msg_room_ts_id_idx'),
+            # and of every room's, for exports
+            models.Index(fields=['timestamp', 'id'], name='chat_msg_ts_id_idx'),
+        ]
+        constraints = [
+            # A number is given out once per room; also serves replaying what a reconnecting client missed
+            models.UniqueConstraint(fields=['room', 'seq'], name='chat_msg_room_seq_uniq'),
+        ]
     
     def __str__(self):
         return f"{self.username}: {self.message[:50]}{'...' if len(self.message) > 50 else ''}"
@@ -0,0 +1,270 @@
+import asyncio
+import collections
+import logging
+import time
+import weakref
+from urllib.parse import parse_qs
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# What to do when a connection's outbound queue is full
+POLICY_DROP_OLDEST = 'drop_oldest'
+# Replace a queued frame that has the same coalesce key, else drop the oldest
+POLICY_COALESCE = 'coalesce'
+# Close the connection once it falls too far behind
+POLICY_DISCONNECT = 'disconnect'
+POLICIES = (POLICY_DROP_OLDEST, POLICY_COALESCE, POLICY_DISCONNECT)
+
+# Close code sent to connections dropped by the disconnect policy
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+# Policy actions across every connection in this process
+totals = collections.Counter()
+# Every open outbound queue in this process
+open_queues = weakref.WeakSet()
+
+
+def frame_batching(scope):
+    """
+    Return the (batch_size, window_ms) a client asked for in its query
+    string with ``batch_size`` and ``batch_window_ms``, clamped to
+    CHAT_FRAME_BATCHING. Clients that don't ask get (1, 0): one frame per
+    message.
+    """
+    limits = getattr(settings, 'CHAT_FRAME_BATCHING', {})
+    params = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    try:
+        batch_size = int(params.get('batch_size', ['1'])[0])
+        window_ms = float(params.get('batch_window_ms', ['0'])[0])
+    except ValueError:
+        return 1, 0
+    if batch_size <= 1:
+        return 1, 0
+    return (
+        min(batch_size, limits.get('MAX_BATCH_SIZE', 100)),
+        max(0, min(window_ms, limits.get('MAX_WINDOW_MS', 50))),
+    )
+
+
+def outbound_settings():
+    options = getattr(settings, 'CHAT_OUTBOUND_QUEUE', {})
+    policy = options.get('POLICY', POLICY_DROP_OLDEST)
+    if policy not in POLICIES:
+        raise ValueError(
+            f"Unknown outbound queue policy {policy!r}, expected one of {', '.join(POLICIES)}"
+        )
+    return {
+        'max_size': options.get('MAX_SIZE', 256),
+        'policy': policy,
+        'lag_threshold_ms': options.get('LAG_THRESHOLD_MS', 5000),
+        'close_code': options.get('CLOSE_CODE', SLOW_CONSUMER_CLOSE_CODE),
+    }
+
+
+class OutboundQueue:
+    """
+    Bounded queue of frames waiting to be sent to one WebSocket connection.
+
+    ``put`` never blocks, so a slow client can't hold up the consumer that
+    hands it frames. A separate task sends queued frames in order. When the
+    client falls behind, the policy decides what happens:
+
+    - ``drop_oldest``: discard the oldest queued frame to make room
+    - ``coalesce``: replace a queued frame with the same key, falling back
+      to ``drop_oldest`` for frames without one
+    - ``disconnect``: call ``on_lag`` once the queue is full or its oldest
+      frame has waited longer than ``lag_threshold_ms``
+
+    With a ``batch_size`` above 1, the sending task waits up to
+    ``batch_window_ms`` after the first queued item for more to arrive and
+    sends up to ``batch_size`` items as one frame built by ``join``.
+    """
+
+    def __init__(self, send, on_lag=None, name=None, max_size=256, policy=POLICY_DROP_OLDEST,
+                 lag_threshold_ms=5000, batch_size=1, batch_window_ms=0, join=None):
+        self.send = send
+        self.on_lag = on_lag
+        self.name = name
+        self.max_size = max_size
+        self.policy = policy
+        self.lag_threshold = lag_threshold_ms / 1000
+        self.batch_size = batch_size
+        self.batch_window = batch_window_ms / 1000
+        self.join = join
+        # Each entry is [enqueued_at, key, frame]
+        self.entries = collections.deque()
+        self.keyed = {}
+        self.sent = 0
+        self.sends = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnected = False
+        self.closed = False
+        # Enqueue time of the frame being sent right now
+        self._sending_since = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+        open_queues.add(self)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lag(self, now=None):
+        """Seconds the oldest unsent frame has been waiting"""
+        oldest = self._sending_since
+        if self.entries and (oldest is None or self.entries[0][0] < oldest):
+            oldest = self.entries[0][0]
+        if oldest is None:
+            return 0.0
+        return (now or time.monotonic()) - oldest
+
+    def put(self, frame, key=None):
+        """Queue a frame for sending, applying the policy if the client is behind"""
+        if self.closed:
+            return
+        now = time.monotonic()
+
+        if self.policy == POLICY_COALESCE and key is not None:
+            entry = self.keyed.get(key)
+            if entry is not None:
+                # Keep the queue position, send only the newest frame
+                entry[2] = frame
+                self.coalesced += 1
+                totals['coalesced'] += 1
+                return
+
+        if self.policy == POLICY_DISCONNECT and (
+            len(self.entries) >= self.max_size or self.lag(now) > self.lag_threshold
+        ):
+            self.disconnect()
+            return
+
+        if len(self.entries) >= self.max_size:
+            _, dropped_key, _ = self.entries.popleft()
+            if dropped_key is not None:
+                self.keyed.pop(dropped_key, None)
+            self.dropped += 1
+            totals['dropped'] += 1
+
+        entry = [now, key, frame]
+        self.entries.append(entry)
+        if self.policy == POLICY_COALESCE and key is not None:
+            self.keyed[key] = entry
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._drain())
+        self._wakeup.set()
+
+    async def _drain(self):
+        while not self.closed:
+            if not self.entries:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            enqueued_at, frame = self._pop()
+            self._sending_since = enqueued_at
+            count = 1
+            try:
+                if self.batch_size > 1:
+                    frames = [frame]
+                    await self._fill_batch(frames, enqueued_at + self.batch_window)
+                    count = len(frames)
+                    frame = self.join(frames)
+                await self.send(frame)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to send a queued frame to %s", self.name)
+                self.close()
+                return
+            finally:
+                self._sending_since = None
+            self.sent += count
+            self.sends += 1
+            totals['frames_sent'] += count
+            totals['sends'] += 1
+
+    def _pop(self):
+        entry = self.entries.popleft()
+        enqueued_at, key, frame = entry
+        if key is not None and self.keyed.get(key) is entry:
+            del self.keyed[key]
+        return enqueued_at, frame
+
+    async def _fill_batch(self, frames, deadline):
+        """Add queued frames to the batch until it's full or the window closes"""
+        while len(frames) < self.batch_size:
+            if self.entries:
+                frames.append(self._pop()[1])
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.closed:
+                return
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def disconnect(self):
+        """Stop sending and hand the connection to ``on_lag`` to be closed"""
+        logger.warning(
+            "Disconnecting slow consumer %s: %d frames queued, %.0fms behind",
+            self.name, len(self.entries), self.lag() * 1000
+        )
+        self.disconnected = True
+        totals['disconnected'] += 1
+        self.close()
+        if self.on_lag is not None:
+            asyncio.get_running_loop().create_task(self.on_lag())
+
+    def close(self):
+        """Discard queued frames and stop the sending task"""
+        self.closed = True
+        self.entries.clear()
+        self.keyed.clear()
+        open_queues.discard(self)
+        if self._task is not None and not self._task.done() and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    async def aclose(self):
+        """Close the queue and wait for the sending task to exit"""
+        task = self._task
+        self.close()
+        if task is not None and task is not asyncio.current_task():
+            # Collects the task's cancellation, so it isn't destroyed while pending
+            await asyncio.gather(task, return_exceptions=True)
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'depth': len(self.entries),
+            'lag_ms': round(self.lag() * 1000, 1),
+            'sent': self.sent,
+            'sends': self.sends,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+        }
+
+
+def outbound_stats(slowest=5):
+    """Queue depth and policy action counts for every connection in this process"""
+    config = outbound_settings()
+    queues = list(open_queues)
+    return {
+        'policy': config['policy'],
+        'max_size': config['max_size'],
+        'connections': len(queues),
+        'queued': sum(len(queue) for queue in queues),
+        'max_depth': max((len(queue) for queue in queues), default=0),
+        'dropped': totals['dropped'],
+        'coalesced': totals['coalesced'],
+        'disconnected': totals['disconnected'],
+        'frames_sent': totals['frames_sent'],
+        'sends': totals['sends'],
+        'slowest': [
+            queue.stats() for queue in sorted(queues, key=len, reverse=True)[:slowest] if len(queue)
+        ],
+    }
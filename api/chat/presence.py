@@ -0,0 +1,283 @@
+import asyncio
+import collections
+import logging
+import time
+import uuid
+from urllib.parse import parse_qs
+
+from django.conf import settings
+
+from .protocol import encode_event
+
+logger = logging.getLogger(__name__)
+
+# Every process's presence registry listens on this group for the others' changes
+SYNC_GROUP = "chat_presence_sync"
+
+
+def presence_group(room):
+    """Group of the room's connections that asked for presence updates"""
+    return f"presence_{room}"
+
+
+def connection_options(scope):
+    """
+    Return (username, wants_updates) for a connection. Clients pass
+    ``?username=<name>&presence=1`` on the WebSocket URL; without a username
+    an authenticated user's name is used, and otherwise "Anonymous".
+    """
+    params = parse_qs(scope.get('query_string', b'').decode('utf-8', 'ignore'))
+    username = params.get('username', [''])[0].strip()[:150]
+    if not username:
+        user = scope.get('user')
+        if user is not None and user.is_authenticated:
+            username = user.get_username()
+    wants_updates = params.get('presence', ['0'])[0] in ('1', 'true')
+    return username or 'Anonymous', wants_updates
+
+
+def presence_settings():
+    options = getattr(settings, 'CHAT_PRESENCE', {})
+    return {
+        'broadcast_interval': options.get('BROADCAST_INTERVAL_MS', 1000) / 1000,
+        'sync_interval': options.get('SYNC_INTERVAL_MS', 15000) / 1000,
+    }
+
+
+class PresenceRegistry:
+    """
+    Who is connected to each room, across every process on the channel layer.
+
+    Joins and leaves update a per-room username -> connection count map in
+    O(1). Processes share their changes through the channel layer:
+
+    - changes to local connections are sent to the other processes in small
+      batches of deltas, at most one message per tick
+    - every ``sync_interval`` each process also sends a snapshot of its
+      local connections. The snapshot replaces what the others know about
+      it, which repairs any lost delta. A process that hasn't been heard
+      from for three intervals is forgotten.
+
+    Room members that asked for presence updates get at most one update per
+    room every ``broadcast_interval``. An update lists the usernames that
+    came online or went offline since the last one. A user who drops and
+    reconnects within the interval never shows up, so reconnect storms
+    don't become presence storms. Updates are sent by one process only, the
+    one with the lowest process id, so each change is announced once.
+    """
+
+    # Resolution of the background loop
+    tick = 0.1
+
+    def __init__(self, broadcast_interval=1.0, sync_interval=15.0):
+        self.broadcast_interval = broadcast_interval
+        self.sync_interval = sync_interval
+        self.process_id = uuid.uuid4().hex
+        # room -> {channel_name: username} for this process's connections
+        self.local = {}
+        # room -> Counter(username -> connections) across all processes
+        self.counts = {}
+        # process_id -> [last_seen, {room: {username: connections}}]
+        self.remote = {}
+        # (room, username, change) waiting to be sent to the other processes
+        self.pending_deltas = []
+        # room -> {username: was_online} for usernames changed since the last update
+        self.changed = {}
+        self.channel_layer = None
+        self.channel = None
+        self._loop = None
+        self._tasks = ()
+        self.updates_sent = 0
+        self.updates_suppressed = 0
+
+    # Local connections
+
+    def join(self, room, channel_name, username, channel_layer):
+        self._ensure_started(channel_layer)
+        self.local.setdefault(room, {})[channel_name] = username
+        self._apply(room, username, 1)
+        self.pending_deltas.append((room, username, 1))
+
+    def leave(self, room, channel_name):
+        members = self.local.get(room)
+        if not members or channel_name not in members:
+            return
+        username = members.pop(channel_name)
+        if not members:
+            del self.local[room]
+        self._apply(room, username, -1)
+        self.pending_deltas.append((room, username, -1))
+
+    def _apply(self, room, username, change):
+        counts = self.counts.get(room)
+        if counts is None:
+            counts = self.counts[room] = collections.Counter()
+        was_online = counts[username] > 0
+        counts[username] += change
+        if counts[username] <= 0:
+            del counts[username]
+            if not counts:
+                del self.counts[room]
+        # Remember the state at the first change since the last update
+        self.changed.setdefault(room, {}).setdefault(username, was_online)
+
+    # Reads
+
+    def room(self, room):
+        counts = self.counts.get(room, {})
+        return {
+            'room': room,
+            'online': len(counts),
+            'connections': sum(counts.values()),
+            'users': [
+                {'username': username, 'connections': connections}
+                for username, connections in sorted(counts.items())
+            ],
+        }
+
+    def rooms(self):
+        return {
+            room: {'online': len(counts), 'connections': sum(counts.values())}
+            for room, counts in self.counts.items()
+        }
+
+    def stats(self):
+        return {
+            'processes': len(self.remote) + 1,
+            'rooms': len(self.counts),
+            'local_connections': sum(len(members) for members in self.local.values()),
+            'updates_sent': self.updates_sent,
+            'updates_suppressed': self.updates_suppressed,
+        }
+
+    # Sync with other processes
+
+    def _ensure_started(self, channel_layer):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and not any(task.done() for task in self._tasks):
+            return
+        self.channel_layer = channel_layer
+        self._loop = loop
+        self._tasks = (loop.create_task(self._listen()), loop.create_task(self._run()))
+
+    def local_snapshot(self):
+        snapshot = {}
+        for room, members in self.local.items():
+            snapshot[room] = dict(collections.Counter(members.values()))
+        return snapshot
+
+    async def _send(self, message):
+        await self.channel_layer.group_send(SYNC_GROUP, {'sender': self.process_id, **message})
+
+    async def _send_snapshot(self, kind='presence.snapshot'):
+        # The snapshot already includes every change not yet sent as a delta
+        self.pending_deltas = []
+        await self._send({'type': kind, 'snapshot': self.local_snapshot()})
+
+    async def _listen(self):
+        self.channel = await self.channel_layer.new_channel()
+        await self.channel_layer.group_add(SYNC_GROUP, self.channel)
+        # Ask the other processes for their connections
+        await self._send_snapshot('presence.hello')
+        while True:
+            message = await self.channel_layer.receive(self.channel)
+            sender = message.get('sender')
+            if sender == self.process_id:
+                continue
+            try:
+                kind = message['type']
+                if kind == 'presence.hello':
+                    self._replace_remote(sender, message['snapshot'])
+                    await self._send_snapshot()
+                elif kind == 'presence.snapshot':
+                    self._replace_remote(sender, message['snapshot'])
+                elif kind == 'presence.delta':
+                    self._apply_remote_deltas(sender, message['deltas'])
+            except Exception:
+                logger.exception("Ignoring bad presence message from process %s", sender)
+
+    def _replace_remote(self, process_id, snapshot):
+        previous = self.remote.get(process_id, [None, {}])[1]
+        self.remote[process_id] = [time.monotonic(), snapshot]
+        # Apply only the difference, so an unchanged snapshot changes nothing
+        for room in previous.keys() | snapshot.keys():
+            old = previous.get(room, {})
+            new = snapshot.get(room, {})
+            for username in old.keys() | new.keys():
+                change = new.get(username, 0) - old.get(username, 0)
+                if change:
+                    self._apply(room, username, change)
+
+    def _forget(self, process_id):
+        entry = self.remote.pop(process_id, None)
+        if entry is None:
+            return
+        for room, counts in entry[1].items():
+            for username, connections in counts.items():
+                self._apply(room, username, -connections)
+
+    def _apply_remote_deltas(self, process_id, deltas):
+        entry = self.remote.get(process_id)
+        if entry is None:
+            entry = self.remote[process_id] = [time.monotonic(), {}]
+        entry[0] = time.monotonic()
+        snapshot = entry[1]
+        for room, username, change in deltas:
+            counts = snapshot.setdefault(room, {})
+            counts[username] = counts.get(username, 0) + change
+            if counts[username] <= 0:
+                del counts[username]
+                if not counts:
+                    del snapshot[room]
+            self._apply(room, username, change)
+
+    async def _run(self):
+        last_update = last_sync = time.monotonic()
+        while True:
+            await asyncio.sleep(self.tick)
+            now = time.monotonic()
+            try:
+                if self.pending_deltas:
+                    deltas, self.pending_deltas = self.pending_deltas, []
+                    await self._send({'type': 'presence.delta', 'deltas': deltas})
+                if now - last_sync >= self.sync_interval:
+                    last_sync = now
+                    await self._send_snapshot()
+                    for process_id, (last_seen, _) in list(self.remote.items()):
+                        if now - last_seen > 3 * self.sync_interval:
+                            self._forget(process_id)
+                if now - last_update >= self.broadcast_interval:
+                    last_update = now
+                    await self._send_updates()
+            except Exception:
+                logger.exception("Presence sync failed")
+
+    def is_leader(self):
+        return all(self.process_id < process_id for process_id in self.remote)
+
+    async def _send_updates(self):
+        changed, self.changed = self.changed, {}
+        if not self.is_leader():
+            return
+        for room, before in changed.items():
+            counts = self.counts.get(room, {})
+            joined = sorted(username for username, was_online in before.items()
+                            if not was_online and username in counts)
+            left = sorted(username for username, was_online in before.items()
+                          if was_online and username not in counts)
+            if not joined and not left:
+                # Everyone who changed is back where they started
+                self.updates_suppressed += 1
+                continue
+            event = encode_event('presence.update', {
+                'type': 'presence',
+                'room': room,
+                'joined': joined,
+                'left': left,
+                'online': len(counts),
+            })
+            await self.channel_layer.group_send(presence_group(room), event)
+            self.updates_sent += 1
+
+
+presence_registry = PresenceRegistry(**presence_settings())
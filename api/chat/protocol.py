@@ -0,0 +1,200 @@
+import functools
+import json
+import zlib
+
+import msgpack
+from django.conf import settings
+
+# Subprotocols a client can request in Sec-WebSocket-Protocol, in the order
+# the server prefers them. Clients that request none get JSON text frames.
+SUBPROTOCOL_MSGPACK = 'chat.msgpack'
+SUBPROTOCOL_MSGPACK_ZLIB = 'chat.msgpack+zlib'
+
+# First byte of every chat.msgpack+zlib frame
+FLAG_RAW = b'\x00'
+FLAG_ZLIB = b'\x01'
+
+# Binary encodings kept for the most recent events
+ENCODING_CACHE_SIZE = 1024
+
+
+class ProtocolError(ValueError):
+    """A binary frame that can't be decoded"""
+
+
+def protocol_settings():
+    options = getattr(settings, 'CHAT_BINARY_PROTOCOL', {})
+    return {
+        'compression_threshold': options.get('COMPRESSION_THRESHOLD', 1024),
+        'compression_level': options.get('COMPRESSION_LEVEL', 6),
+        'max_message_size': options.get('MAX_MESSAGE_SIZE', 1024 * 1024),
+    }
+
+
+def encode_chat_frame(message, username, timestamp):
+    """Serialize a chat message into the JSON frame sent to clients"""
+    return json.dumps({
+        "message": message,
+        "username": username,
+        "timestamp": timestamp
+    })
+
+
+def compress_frame(payload, threshold, level):
+    """Prefix a msgpack payload with its flag byte, compressing it if it's large"""
+    if len(payload) >= threshold:
+        compressed = zlib.compress(payload, level)
+        if len(compressed) < len(payload):
+            return FLAG_ZLIB + compressed
+    return FLAG_RAW + payload
+
+
+def encode_event(event_type, data):
+    """
+    Build a group event with ``data`` encoded as a JSON frame. Binary
+    clients get it converted by ``msgpack_payload`` and
+    ``compressed_payload`` when the first of them is sent the event, so a
+    room of JSON clients never pays for msgpack or zlib, and a room that
+    mixes them still encodes each broadcast once per format rather than
+    once per recipient.
+    """
+    return {
+        "type": event_type,
+        "text": json.dumps(data),
+    }
+
+
+@functools.lru_cache(maxsize=ENCODING_CACHE_SIZE)
+def msgpack_payload(text):
+    """
+    The msgpack encoding of an event's JSON frame. Channel layers copy an
+    event for every recipient, but the copies share the frame string, so
+    caching on it encodes each event once however many clients get it.
+    """
+    return msgpack.packb(json.loads(text), use_bin_type=True)
+
+
+@functools.lru_cache(maxsize=ENCODING_CACHE_SIZE)
+def compressed_payload(text, threshold, level):
+    """The chat.msgpack+zlib frame for an event's JSON frame, cached like ``msgpack_payload``"""
+    return compress_frame(msgpack_payload(text), threshold, level)
+
+
+def encode_chat_event(message, username, timestamp, seq=None):
+    """
+    Build the chat_message group event for a chat message. ``seq``, the
+    message's sequence number in its room, goes in the frame and on the
+    event itself.
+    """
+    data = {
+        "message": message,
+        "username": username,
+        "timestamp": timestamp
+    }
+    if seq is None:
+        return encode_event("chat_message", data)
+    data["seq"] = seq
+    event = encode_event("chat_message", data)
+    event["seq"] = seq
+    return event
+
+
+def unpack(payload):
+    try:
+        data = msgpack.unpackb(payload, raw=False)
+    except Exception as e:
+        raise ProtocolError(f"Invalid msgpack frame: {e}")
+    if not isinstance(data, dict):
+        raise ProtocolError("Expected a msgpack map")
+    return data
+
+
+class JsonProtocol:
+    """JSON text frames, used when the client asks for no subprotocol"""
+    subprotocol = None
+
+    def decode(self, text_data=None, bytes_data=None):
+        if text_data is None:
+            raise ProtocolError("Binary frames need the chat.msgpack subprotocol")
+        return json.loads(text_data)
+
+    def frame(self, event):
+        return event["text"]
+
+    # Batched frames: clients that negotiated frame batching get a JSON
+    # array or msgpack array of messages in every frame
+
+    def element(self, event):
+        """The encoded message as it goes into a batch"""
+        return self.frame(event)
+
+    def join(self, elements):
+        """Build one batched frame from encoded messages"""
+        return "[" + ",".join(elements) + "]"
+
+
+class MsgpackProtocol(JsonProtocol):
+    """Binary frames holding one msgpack map each"""
+    subprotocol = SUBPROTOCOL_MSGPACK
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            # JSON text frames keep working on a binary connection
+            return super().decode(text_data=text_data)
+        return unpack(bytes_data)
+
+    def frame(self, event):
+        return msgpack_payload(event["text"])
+
+    def join(self, elements):
+        # A msgpack array is its header followed by the packed items
+        return msgpack.Packer().pack_array_header(len(elements)) + b"".join(elements)
+
+
+class CompressedMsgpackProtocol(MsgpackProtocol):
+    """
+    msgpack frames with a leading flag byte: 0 for a raw payload, 1 for a
+    zlib-compressed one. Only payloads over the compression threshold are
+    compressed.
+    """
+    subprotocol = SUBPROTOCOL_MSGPACK_ZLIB
+
+    def __init__(self, max_message_size=1024 * 1024, compression_threshold=1024, compression_level=6):
+        self.max_message_size = max_message_size
+        self.compression_threshold = compression_threshold
+        self.compression_level = compression_level
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            return super().decode(text_data=text_data)
+        flag, payload = bytes_data[:1], bytes_data[1:]
+        if flag == FLAG_ZLIB:
+            decompressor = zlib.decompressobj()
+            try:
+                payload = decompressor.decompress(payload, self.max_message_size)
+            except zlib.error as e:
+                raise ProtocolError(f"Invalid compressed frame: {e}")
+            if decompressor.unconsumed_tail:
+                raise ProtocolError(f"Frame decompresses to more than {self.max_message_size} bytes")
+        elif flag != FLAG_RAW:
+            raise ProtocolError(f"Unknown frame flag {flag!r}")
+        return unpack(payload)
+
+    def frame(self, event):
+        return compressed_payload(event["text"], self.compression_threshold, self.compression_level)
+
+    def element(self, event):
+        # Batches are compressed as a whole
+        return MsgpackProtocol.frame(self, event)
+
+    def join(self, elements):
+        return compress_frame(super().join(elements), self.compression_threshold, self.compression_level)
+
+
+def negotiate(requested):
+    """Pick the protocol for a connection from the subprotocols the client offered"""
+    if SUBPROTOCOL_MSGPACK_ZLIB in requested:
+        return CompressedMsgpackProtocol(**protocol_settings())
+    if SUBPROTOCOL_MSGPACK in requested:
+        return MsgpackProtocol()
+    return JsonProtocol()
@@ -0,0 +1,198 @@
+import collections
+import time
+
+from django.conf import settings
+
+from .protocol import protocol_settings
+
+# What to do with a frame that's over a limit
+ACTION_DROP = 'drop'
+# Hold the frame back until the bucket refills. The client's receive loop
+# stalls meanwhile, so TCP backpressure slows the sender down.
+ACTION_DELAY = 'delay'
+ACTION_CLOSE = 'close'
+ACTIONS = (ACTION_DROP, ACTION_DELAY, ACTION_CLOSE)
+
+# Close code sent to connections closed by the close action
+RATE_LIMIT_CLOSE_CODE = 4029
+
+# (scope, action) -> frames, across every connection in this process
+totals = collections.Counter()
+
+
+def rate_limit_settings():
+    options = getattr(settings, 'CHAT_RATE_LIMITS', {})
+    action = options.get('ACTION', ACTION_DROP)
+    if action not in ACTIONS:
+        raise ValueError(
+            f"Unknown rate limit action {action!r}, expected one of {', '.join(ACTIONS)}"
+        )
+
+    # A frame bigger than a byte burst could never pass, however long its
+    # sender waited, so bursts are raised to the largest allowed message
+    max_message_size = protocol_settings()['max_message_size']
+
+    def limits(name, defaults):
+        values = {**defaults, **options.get(name, {})}
+        return {
+            'messages_per_second': values['MESSAGES_PER_SECOND'],
+            'message_burst': values['MESSAGE_BURST'],
+            'bytes_per_second': values['BYTES_PER_SECOND'],
+            'byte_burst': max(values['BYTE_BURST'], max_message_size),
+        }
+
+    return {
+        'enabled': options.get('ENABLED', True),
+        'action': action,
+        'close_code': options.get('CLOSE_CODE', RATE_LIMIT_CLOSE_CODE),
+        'max_delay': options.get('MAX_DELAY_MS', 1000) / 1000,
+        'connection': limits('CONNECTION', {
+            'MESSAGES_PER_SECOND': 20, 'MESSAGE_BURST': 40,
+            'BYTES_PER_SECOND': 64 * 1024, 'BYTE_BURST': 1024 * 1024,
+        }),
+        'ip': limits('IP', {
+            'MESSAGES_PER_SECOND': 100, 'MESSAGE_BURST': 200,
+            'BYTES_PER_SECOND': 256 * 1024, 'BYTE_BURST': 1024 * 1024,
+        }),
+    }
+
+
+class TokenBucket:
+    """
+    Allows ``rate`` units per second on average, and bursts of up to
+    ``capacity`` units. Tokens are refilled lazily when the bucket is used,
+    so an idle bucket costs nothing.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount, now):
+        """Seconds until ``amount`` tokens are available, 0 if they are now"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        # The balance may go negative when a delayed frame reserves tokens
+        # ahead of time, which queues later frames behind it
+        self.tokens -= amount
+
+
+def make_buckets(limits):
+    """(messages, bytes) buckets for a set of limits; a rate of None means unlimited"""
+    return tuple(
+        TokenBucket(rate, burst) if rate else None
+        for rate, burst in (
+            (limits['messages_per_second'], limits['message_burst']),
+            (limits['bytes_per_second'], limits['byte_burst']),
+        )
+    )
+
+
+class ConnectionRateLimit:
+    """The token buckets that apply to one connection's incoming frames"""
+
+    def __init__(self, limiter, client_ip):
+        self.limiter = limiter
+        self.client_ip = client_ip
+        self.buckets = make_buckets(limiter.config['connection'])
+        self.limited = 0
+
+    def check(self, size):
+        """
+        Charge one frame of ``size`` bytes against the connection's and its
+        address's limits. Returns (action, delay): action is None for frames
+        within the limits, and delay is how long a delayed frame must wait.
+        """
+        limiter = self.limiter
+        if not limiter.enabled:
+            return None, 0
+        ip_buckets = limiter.ip_buckets.get(self.client_ip, (None, None, 0))
+        charges = (
+            ('connection', self.buckets[0], 1),
+            ('connection', self.buckets[1], size),
+            ('ip', ip_buckets[0], 1),
+            ('ip', ip_buckets[1], size),
+        )
+        now = time.monotonic()
+        wait, scope = 0, None
+        for charge_scope, bucket, amount in charges:
+            if bucket is not None:
+                bucket_wait = bucket.wait_time(amount, now)
+                if bucket_wait > wait:
+                    wait, scope = bucket_wait, charge_scope
+        if not wait:
+            for _, bucket, amount in charges:
+                if bucket is not None:
+                    bucket.take(amount)
+            return None, 0
+
+        action = limiter.config['action']
+        if action == ACTION_DELAY:
+            if wait <= limiter.config['max_delay']:
+                for _, bucket, amount in charges:
+                    if bucket is not None:
+                        bucket.take(amount)
+            else:
+                # Too far over the limit to catch up by waiting
+                action = ACTION_DROP
+        self.limited += 1
+        totals[scope, action] += 1
+        return action, wait
+
+    def release(self):
+        self.limiter.release(self.client_ip)
+
+
+class RateLimiter:
+    """
+    In-memory token-bucket limits on incoming WebSocket frames, per
+    connection and per client address, in messages and bytes per second.
+
+    Address buckets are shared by all of an address's connections in this
+    process and are discarded when its last connection closes, so memory
+    use follows the number of open connections.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.enabled = config['enabled']
+        # client_ip -> [message bucket, byte bucket, open connections]
+        self.ip_buckets = {}
+
+    def connect(self, client_ip):
+        entry = self.ip_buckets.get(client_ip)
+        if entry is None:
+            entry = self.ip_buckets[client_ip] = [*make_buckets(self.config['ip']), 0]
+        entry[2] += 1
+        return ConnectionRateLimit(self, client_ip)
+
+    def release(self, client_ip):
+        entry = self.ip_buckets.get(client_ip)
+        if entry is None:
+            return
+        entry[2] -= 1
+        if entry[2] <= 0:
+            del self.ip_buckets[client_ip]
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'action': self.config['action'],
+            'connection': self.config['connection'],
+            'ip': self.config['ip'],
+            'addresses': len(self.ip_buckets),
+            'limited': {
+                f"{scope}_{action}": count for (scope, action), count in sorted(totals.items())
+            },
+        }
+
+
+rate_limiter = RateLimiter(rate_limit_settings())
@@ -0,0 +1,253 @@
+import asyncio
+import collections
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+
+from .protocol import encode_chat_event
+from .rooms import room_registry
+
+SOURCE_BUFFER = 'buffer'
+SOURCE_DATABASE = 'database'
+
+
+def replay_settings():
+    options = getattr(settings, 'CHAT_MESSAGE_REPLAY', {})
+    return {
+        'buffer_size': options.get('BUFFER_SIZE', 500),
+        'max_rooms': options.get('MAX_ROOMS', 1000),
+        'max_database_messages': options.get('MAX_DATABASE_MESSAGES', 1000),
+    }
+
+
+def resume_from(scope):
+    """The last sequence number a reconnecting client saw, from ``?last_seq=N`` on the WebSocket URL"""
+    params = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    try:
+        last_seq = int(params['last_seq'][0])
+    except (KeyError, ValueError):
+        return None
+    return last_seq if last_seq >= 0 else None
+
+
+def last_sequence(room):
+    from .models import ChatMessage
+    return ChatMessage.objects.filter(room=room).aggregate(last=Max('seq'))['last'] or 0
+
+
+def unsaved_sequence(room):
+    """The highest sequence number of the room's messages still waiting to be written"""
+    from .buffers import get_chat_message_buffer
+    return max(
+        (instance.seq or 0 for instance in get_chat_message_buffer().unsaved() if instance.room == room),
+        default=0,
+    )
+
+
+def stored_events(room, after, through, limit):
+    """
+    Events for up to ``limit`` stored messages of a room with sequence
+    numbers in (after, through], oldest first. ``through`` may be None.
+    """
+    from .models import ChatMessage
+    queryset = ChatMessage.objects.filter(room=room, seq__gt=after)
+    if through is not None:
+        queryset = queryset.filter(seq__lte=through)
+    return [
+        encode_chat_event(
+            message.message,
+            message.username,
+            timezone.localtime(message.timestamp).strftime("%H:%M:%S"),
+            message.seq,
+        )
+        for message in queryset.order_by('seq')[:limit]
+    ]
+
+
+class RoomSequence:
+    """Sequence counter and replay buffer of one room"""
+    __slots__ = ('seq', 'floor', 'events', 'lock')
+
+    def __init__(self, size):
+        # Last sequence number assigned or seen, None until loaded
+        self.seq = None
+        # Every event after this sequence number is in events
+        self.floor = None
+        # (seq, event) pairs in sequence order
+        self.events = collections.deque(maxlen=size)
+        self.lock = asyncio.Lock()
+
+
+class MessageSequencer:
+    """
+    Numbers each room's chat messages and keeps the newest of them for
+    replay.
+
+    When the channel layer has a shared counter (``next_sequence``, as
+    UnixSocketChannelLayer does) numbers are taken from it, so they are
+    unique and increasing across every worker process using the layer.
+    Otherwise the counter is kept here, which is only right for a single
+    process. Either way a room's counter starts from the highest ``seq``
+    stored or still waiting to be written for it, and events of other
+    workers, seen as they are delivered, move it forward too.
+
+    The last ``buffer_size`` events of up to ``max_rooms`` rooms are kept,
+    whether or not anyone is connected, so clients reconnecting after a
+    network blip are served from memory. A gap that starts before the
+    buffer is read from the database. Rooms that ``is_active`` says still
+    have members here are never evicted, so more than ``max_rooms`` may be
+    kept while they are all in use.
+    """
+
+    def __init__(self, buffer_size=500, max_rooms=1000, max_database_messages=1000, is_active=None):
+        self.buffer_size = buffer_size
+        self.max_rooms = max_rooms
+        self.max_database_messages = max_database_messages
+        self.is_active = is_active or (lambda name: False)
+        self.rooms = collections.OrderedDict()
+
+        # Counters
+        self.replays = collections.Counter()
+        self.replayed = collections.Counter()
+        self.incomplete = 0
+
+    def _room(self, name):
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = RoomSequence(self.buffer_size)
+            if len(self.rooms) > self.max_rooms:
+                self._evict(name)
+        else:
+            self.rooms.move_to_end(name)
+        return room
+
+    def _evict(self, added):
+        """Forget the least recently used room, other than ``added``, that has no members here"""
+        for name in self.rooms:
+            if name != added and not self.is_active(name):
+                del self.rooms[name]
+                return
+
+    async def _loaded(self, name):
+        """The room's state, with its counter loaded"""
+        room = self._room(name)
+        if room.seq is None:
+            async with room.lock:
+                if room.seq is None:
+                    # Look at the queued rows before the table, so a row
+                    # written in between is seen in one or the other
+                    unsaved = unsaved_sequence(name)
+                    last = max(unsaved, await sync_to_async(last_sequence)(name))
+                    # Events seen while loading may have set it already
+                    if room.seq is None:
+                        room.seq = room.floor = last
+        return room
+
+    async def next(self, name):
+        """Return the next sequence number for a message in the room"""
+        room = await self._loaded(name)
+        shared_counter = self._shared_counter()
+        if shared_counter is None:
+            room.seq += 1
+            return room.seq
+        seq = await shared_counter(name, room.seq)
+        if seq > room.seq:
+            room.seq = seq
+        return seq
+
+    @staticmethod
+    def _shared_counter():
+        """The channel layer's cross-process counter, if it has one"""
+        return getattr(get_channel_layer(), 'next_sequence', None)
+
+    def record(self, name, event):
+        """Keep a numbered chat_message event for replay, ignoring ones already kept"""
+        seq = event.get('seq')
+        if seq is None:
+            return
+        room = self._room(name)
+        if room.seq is None:
+            # Nothing before this event has been seen
+            room.seq = seq
+            room.floor = seq - 1
+        elif seq > room.seq:
+            room.seq = seq
+        events = room.events
+        if events and seq <= events[-1][0]:
+            # Published out of order, or already kept
+            if seq <= room.floor:
+                return
+            position = len(events)
+            while position > 0 and events[position - 1][0] > seq:
+                position -= 1
+            if position > 0 and events[position - 1][0] == seq:
+                return
+            if len(events) == events.maxlen:
+                if position == 0:
+                    # Older than everything kept, so it's the one to evict
+                    room.floor = seq
+                    return
+                room.floor = events.popleft()[0]
+                position -= 1
+            events.insert(position, (seq, event))
+            return
+        if len(events) == events.maxlen:
+            room.floor = events[0][0]
+        events.append((seq, event))
+
+    async def missed(self, name, last_seq):
+        """
+        Return (events, source, complete, current) for a client that last
+        saw ``last_seq`` in the room, where ``current`` is the room's latest
+        sequence number. ``complete`` is False, and there are no events,
+        when the client can't be caught up by replaying and should reload
+        the room's history instead: the gap is longer than
+        ``max_database_messages``, or ``last_seq`` is ahead of the room,
+        e.g. after unsaved messages were lost in a restart.
+        """
+        room = await self._loaded(name)
+        current = room.seq
+        if last_seq > current:
+            self.incomplete += 1
+            return self._replayed(SOURCE_BUFFER, [], False, current)
+        if last_seq >= room.floor:
+            events = [event for seq, event in room.events if seq > last_seq]
+            return self._replayed(SOURCE_BUFFER, events, True, current)
+
+        # The gap starts before the buffer. Read up to the start of the
+        # buffer from the database and take the rest from the buffer, which
+        # has messages that may not be stored yet.
+        buffered = list(room.events)
+        through = room.floor if buffered else None
+        events = await sync_to_async(stored_events)(name, last_seq, through, self.max_database_messages + 1)
+        if len(events) > self.max_database_messages:
+            self.incomplete += 1
+            return self._replayed(SOURCE_DATABASE, [], False, current)
+        after = events[-1]['seq'] if events else last_seq
+        events += [event for seq, event in buffered if seq > after]
+        return self._replayed(SOURCE_DATABASE, events, True, current)
+
+    def _replayed(self, source, events, complete, current):
+        self.replays[source] += 1
+        self.replayed[source] += len(events)
+        return events, source, complete, current
+
+    def stats(self):
+        return {
+            'rooms': len(self.rooms),
+            'buffer_size': self.buffer_size,
+            'buffered': sum(len(room.events) for room in self.rooms.values()),
+            'replays': dict(self.replays),
+            'replayed_messages': dict(self.replayed),
+            'incomplete': self.incomplete,
+        }
+
+
+message_sequencer = MessageSequencer(
+    is_active=lambda name: room_registry.get(name) is not None,
+    **replay_settings()
+)
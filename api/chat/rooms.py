@@ -0,0 +1,184 @@
+import asyncio
+import collections
+import logging
+import time
+
+from django.conf import settings
+
+from .buffers import OVERFLOW_BLOCK, OVERFLOW_DROP
+from .metrics import GROUP_SEND_DURATION
+from .tracing import STAGE_PUBLISHED, TRACE_KEY, latency_tracer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROOM = "chat_room"
+ROOM_OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP)
+
+# Broadcasts dropped because a room's queue was full, and ones the channel
+# layer failed to send, across every room in this process
+totals = collections.Counter()
+
+
+def room_settings():
+    options = getattr(settings, 'CHAT_ROOMS', {})
+    policy = options.get('OVERFLOW_POLICY', OVERFLOW_BLOCK)
+    if policy not in ROOM_OVERFLOW_POLICIES:
+        raise ValueError(
+            f"Unknown room overflow policy {policy!r}, "
+            f"expected one of {', '.join(ROOM_OVERFLOW_POLICIES)}"
+        )
+    return {
+        'max_pending': options.get('MAX_PENDING', 1000),
+        'overflow_policy': policy,
+        'max_wait': options.get('MAX_WAIT_MS', 1000) / 1000,
+    }
+
+
+class Room:
+    """
+    Local membership and broadcast queue for one chat room.
+
+    Each room drains its own queue in its own task, one event at a time,
+    so a busy room takes turns with the others on the event loop instead
+    of holding up their broadcasts. Once ``max_pending`` broadcasts are
+    queued the overflow policy decides what happens to new ones:
+
+    - ``block``: the sender waits up to ``max_wait`` seconds for room in
+      the queue, and the broadcast is dropped only if there still is none
+    - ``drop``: the broadcast is dropped straight away
+    """
+
+    def __init__(self, registry, name, group_name, channel_layer, max_pending=1000,
+                 overflow_policy=OVERFLOW_BLOCK, max_wait=1.0):
+        self.registry = registry
+        self.name = name
+        self.group_name = group_name
+        self.channel_layer = channel_layer
+        self.max_pending = max_pending
+        self.overflow_policy = overflow_policy
+        self.max_wait = max_wait
+        self.members = set()
+        self.pending = collections.deque()
+        self.broadcasts = 0
+        self.waited = 0
+        self.dropped = 0
+        self.failed = 0
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._task = None
+
+    async def publish(self, event):
+        """Queue an event for broadcast to the room's group, returning False if it was dropped"""
+        if len(self.pending) >= self.max_pending and self.overflow_policy == OVERFLOW_BLOCK:
+            self.waited += 1
+            try:
+                await asyncio.wait_for(self._wait_for_space(), self.max_wait)
+            except asyncio.TimeoutError:
+                pass
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+            totals['dropped'] += 1
+            return False
+        self.pending.append(event)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._fan_out())
+        self._wakeup.set()
+        return True
+
+    async def _wait_for_space(self):
+        while len(self.pending) >= self.max_pending:
+            self._space.clear()
+            await self._space.wait()
+
+    async def _fan_out(self):
+        while True:
+            if not self.pending:
+                if not self.members:
+                    # Last member left and everything has been sent
+                    self.registry.discard(self)
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            event = self.pending.popleft()
+            self._space.set()
+            started = time.perf_counter()
+            try:
+                await self.channel_layer.group_send(self.group_name, event)
+            except Exception:
+                # One failed send mustn't stop the room's later broadcasts
+                logger.exception("Failed to broadcast to %s", self.group_name)
+                self.failed += 1
+                totals['failed'] += 1
+            else:
+                GROUP_SEND_DURATION.observe(time.perf_counter() - started)
+                latency_tracer.mark(event.get(TRACE_KEY), STAGE_PUBLISHED)
+                self.broadcasts += 1
+            # Let other rooms' broadcasts run between ours
+            await asyncio.sleep(0)
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stats(self):
+        return {
+            'members': len(self.members),
+            'pending_broadcasts': len(self.pending),
+            'broadcasts': self.broadcasts,
+            'waited_broadcasts': self.waited,
+            'dropped_broadcasts': self.dropped,
+            'failed_broadcasts': self.failed,
+        }
+
+
+class RoomRegistry:
+    """
+    Tracks which rooms have members in this process.
+
+    A room is created when its first member joins and removed once the last
+    member has left and its queued broadcasts have gone out.
+    """
+
+    def __init__(self, **room_options):
+        self.rooms = {}
+        # Passed on to each Room
+        self.room_options = room_options
+
+    def join(self, name, group_name, channel_layer, channel_name):
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(self, name, group_name, channel_layer, **self.room_options)
+        room.members.add(channel_name)
+        return room
+
+    def leave(self, name, channel_name):
+        room = self.rooms.get(name)
+        if room is None:
+            return
+        room.members.discard(channel_name)
+        if not room.members:
+            if room._task is None or room._task.done():
+                self.discard(room)
+            else:
+                # Let the fan-out task finish what's queued, then exit
+                room.wake()
+
+    def discard(self, room):
+        if self.rooms.get(room.name) is room and not room.members:
+            del self.rooms[room.name]
+
+    def get(self, name):
+        return self.rooms.get(name)
+
+    def stats(self):
+        return {
+            'rooms': len(self.rooms),
+            'members': sum(len(room.members) for room in self.rooms.values()),
+            'dropped_broadcasts': totals['dropped'],
+            'failed_broadcasts': totals['failed'],
+            'by_room': {name: room.stats() for name, room in self.rooms.items()},
+        }
+
+
+room_registry = RoomRegistry(**room_settings())
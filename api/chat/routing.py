@@ -2,5 +2,7 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
+    re_path(r'ws/chat/(?P<room_name>[A-Za-z0-9_-]{1,64})/$', consumers.ChatConsumer.as_asgi()),
     re_path(r'ws/chat/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/probe/$', consumers.ProbeConsumer.as_asgi()),
 ]
\ No newline at end of file
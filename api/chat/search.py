@@ -0,0 +1,158 @@
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .models import ChatMessage
+
+# External-content FTS5 index over ChatMessage, created on SQLite by
+# migration 0010_chatmessage_search_index
+FTS_TABLE = "chat_chatmessage_fts"
+CONTENT_TABLE = "chat_chatmessage"
+
+
+def search_settings():
+    options = getattr(settings, 'CHAT_SEARCH', {})
+    return {
+        'snippet_markers': tuple(options.get('SNIPPET_MARKERS', ('[', ']'))),
+        'snippet_tokens': options.get('SNIPPET_TOKENS', 12),
+        'page_size': options.get('PAGE_SIZE', 20),
+        'max_page_size': options.get('MAX_PAGE_SIZE', 100),
+    }
+
+
+def fts_supported(using='default'):
+    return connections[using].vendor == 'sqlite'
+
+
+def fts_available(using='default'):
+    """True if the index table exists in the database, checked once per database"""
+    available = _fts_available.get(using)
+    if available is None:
+        available = _fts_available[using] = fts_supported(using) and _fts_table_exists(using)
+    return available
+
+
+def _fts_table_exists(using):
+    with connections[using].cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+        return cursor.fetchone() is not None
+
+
+# alias -> whether the index exists
+_fts_available = {}
+
+
+def forget_fts_available(**kwargs):
+    """post_migrate handler, since migrating can create or drop the index"""
+    _fts_available.clear()
+
+
+def rebuild_search_index(using='default'):
+    """Re-index every ChatMessage row from scratch"""
+    with connections[using].cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+
+
+def match_expression(query):
+    """
+    Turn free text into an FTS5 query that can't be a syntax error: every
+    word becomes a quoted term, all of which must match. A trailing ``*``
+    keeps its meaning as a prefix search.
+    """
+    terms = []
+    for word in query.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if not word:
+            continue
+        term = '"' + word.replace('"', '""') + '"'
+        terms.append(term + '*' if prefix else term)
+    return ' '.join(terms)
+
+
+def search_messages(query, room=None, limit=20, offset=0, using='default', indexed=None):
+    """
+    Return the chat messages matching ``query`` as dicts, best match first
+    (by bm25), each with a snippet of the message around the matching words.
+
+    Without the FTS5 index, e.g. on another database backend, this falls
+    back to an unranked substring search. ``indexed`` is the result of
+    ``fts_available`` if the caller already has it.
+    """
+    expression = match_expression(query)
+    if not expression:
+        return []
+    if indexed is None:
+        indexed = fts_available(using)
+    if not indexed:
+        return fallback_search(query, room, limit, offset, using)
+
+    config = search_settings()
+    start, end = config['snippet_markers']
+    sql = f"""
+        SELECT m.id, m.room, m.username, m.message, m.timestamp,
+               snippet({FTS_TABLE}, 0, %s, %s, '...', %s),
+               bm25({FTS_TABLE})
+        FROM {FTS_TABLE}
+        JOIN {CONTENT_TABLE} m ON m.id = {FTS_TABLE}.rowid
+        WHERE {FTS_TABLE} MATCH %s
+    """
+    params = [start, end, config['snippet_tokens'], expression]
+    if room:
+        sql += " AND m.room = %s"
+        params.append(room)
+    sql += f" ORDER BY bm25({FTS_TABLE}) LIMIT %s OFFSET %s"
+    params += [limit, offset]
+
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    # Raw rows skip the ORM's converters, which make stored UTC times aware
+    timestamp_field = ChatMessage._meta.get_field('timestamp')
+    convert_timestamp = connection.ops.convert_datetimefield_value
+    return [
+        {
+            'id': row_id,
+            'room': row_room,
+            'username': username,
+            'message': message,
+            'timestamp': convert_timestamp(timestamp, timestamp_field, connection).isoformat(),
+            'snippet': snippet,
+            # bm25 scores are negative, lower is better
+            'rank': rank,
+        }
+        for row_id, row_room, username, message, timestamp, snippet, rank in rows
+    ]
+
+
+def fallback_search(query, room=None, limit=20, offset=0, using='default'):
+    queryset = ChatMessage.objects.using(using).order_by('-timestamp')
+    for word in query.split():
+        word = word.rstrip('*')
+        if word:
+            queryset = queryset.filter(Q(message__icontains=word) | Q(username__icontains=word))
+    if room:
+        queryset = queryset.filter(room=room)
+    return [
+        {
+            'id': message.id,
+            'room': message.room,
+            'username': message.username,
+            'message': message.message,
+            'timestamp': message.timestamp.isoformat(),
+            'snippet': message.message,
+            'rank': None,
+        }
+        for message in queryset[offset:offset + limit]
+    ]
+
+
+def matching_ids(query):
+    """
+    An expression for ``id__in`` selecting the messages that match
+    ``query``, so ordinary querysets can be filtered through the index.
+    """
+    return RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [match_expression(query)])
@@ -1,3 +1,1543 @@
-from django.test import TestCase
+import asyncio
+import concurrent.futures
+import copy as copy_module
+import csv
+import fcntl
+import gzip
+import io
+import json
+import os
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock
+from urllib.parse import urlencode
 
-# Create your tests here.
+import msgpack
+from asgiref.sync import sync_to_async
+from channels.layers import InMemoryChannelLayer
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from . import export, layers, rooms
+from .benchmarking import (
+    BENCHMARK_USER_AGENT,
+    benchmark_room,
+    chat_application,
+    delete_benchmark_connections,
+    delete_benchmark_messages,
+)
+from .buffers import OVERFLOW_DROP, WriteBehindBuffer, close_buffers, get_persistence_durability
+from .diagnostics import HandshakeProbe, probe_asgi_port
+from .export import CHAT_MESSAGE_FIELDS, iter_rows, stream_rows
+from .history import RecentMessageCache
+from .layers import Broker, BrokerThread, OpWriter, UnixSocketChannelLayer
+from .liveness import ConnectionTracker, connection_tracker
+from .metrics import MESSAGE_STAGE_LATENCY, Registry, registry
+from .middleware import WebSocketConnectionLoggingMiddleware
+from .models import (
+    ChatMessage,
+    ConnectionAttempt,
+    ConnectionErrorRollup,
+    ConnectionLifecycle,
+    ConnectionStatsRollup,
+)
+from .outbound import (
+    POLICY_COALESCE,
+    POLICY_DISCONNECT,
+    POLICY_DROP_OLDEST,
+    OutboundQueue,
+    frame_batching,
+)
+from .presence import PresenceRegistry, presence_group
+from .protocol import (
+    FLAG_RAW,
+    FLAG_ZLIB,
+    CompressedMsgpackProtocol,
+    JsonProtocol,
+    MsgpackProtocol,
+    ProtocolError,
+    encode_chat_event,
+    negotiate,
+)
+from .ratelimit import ACTION_DELAY, ACTION_DROP, RateLimiter, TokenBucket, rate_limit_settings, rate_limiter
+from .replay import SOURCE_BUFFER, SOURCE_DATABASE, MessageSequencer
+from .rooms import RoomRegistry
+from .search import fts_available, match_expression, search_messages
+from .tracing import STAGE_DELIVERED, STAGE_PUBLISHED, STAGE_RECEIVED, TRACE_KEY, LatencyTracer, latency_tracer
+from .writer import DatabaseWriter, db_writer
+
+
+class WriteBehindBufferTests(TransactionTestCase):
+    def setUp(self):
+        # Write on the test's own thread and connection
+        patcher = mock.patch.object(db_writer, 'enabled', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def message(self, text):
+        return ChatMessage(username='buffer-test', message=text)
+
+    async def test_waiters_resolve_once_their_batch_is_committed(self):
+        buffer = WriteBehindBuffer(ChatMessage, batch_size=10, flush_interval_ms=0)
+        results = await asyncio.gather(*(
+            buffer.enqueue(self.message(f"message {i}"), wait=True) for i in range(5)
+        ))
+        self.assertEqual(results, [True] * 5)
+        self.assertEqual(await ChatMessage.objects.filter(username='buffer-test').acount(), 5)
+        self.assertEqual(buffer.written, 5)
+        await buffer.close()
+
+    async def test_failed_write_resolves_waiters_with_false(self):
+        buffer = WriteBehindBuffer(ChatMessage, batch_size=10, flush_interval_ms=0)
+        with mock.patch.object(ChatMessage.objects, 'bulk_create', side_effect=RuntimeError("disk full")), \
+                self.assertLogs('chat.buffers', 'ERROR'):
+            saved = await buffer.enqueue(self.message("lost"), wait=True)
+        self.assertFalse(saved)
+        self.assertEqual(buffer.write_errors, 1)
+        await buffer.close()
+
+    async def test_close_flushes_pending_rows(self):
+        buffer = WriteBehindBuffer(ChatMessage, batch_size=100, flush_interval_ms=60000)
+        for i in range(3):
+            self.assertTrue(await buffer.enqueue(self.message(f"message {i}")))
+        await buffer.close()
+        self.assertEqual(await ChatMessage.objects.filter(username='buffer-test').acount(), 3)
+        self.assertEqual(buffer.stats()['queue_depth'], 0)
+
+    async def test_full_batch_is_written_without_waiting_for_the_interval(self):
+        buffer = WriteBehindBuffer(ChatMessage, batch_size=2, flush_interval_ms=60000)
+        for i in range(2):
+            await buffer.enqueue(self.message(f"message {i}"))
+        for _ in range(100):
+            if buffer.written == 2:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(buffer.written, 2)
+        self.assertEqual(buffer.flushes, 1)
+        await buffer.close()
+
+    async def test_drop_policy_discards_rows_when_full(self):
+        buffer = WriteBehindBuffer(ChatMessage, max_size=2, batch_size=100,
+                                   flush_interval_ms=60000, overflow_policy=OVERFLOW_DROP)
+        accepted = [await buffer.enqueue(self.message(f"message {i}")) for i in range(3)]
+        self.assertEqual(accepted, [True, True, False])
+        self.assertEqual(buffer.dropped, 1)
+        await buffer.close()
+
+    async def test_failed_write_is_counted_and_logged(self):
+        buffer = WriteBehindBuffer(ChatMessage, batch_size=10, flush_interval_ms=0)
+        with mock.patch.object(ChatMessage.objects, 'bulk_create', side_effect=RuntimeError("disk full")), \
+                self.assertLogs('chat.buffers', 'ERROR'):
+            await buffer.enqueue(self.message("lost"))
+            await buffer.close()
+        self.assertEqual(buffer.write_errors, 1)
+        self.assertEqual(buffer.written, 0)
+
+    def test_unknown_overflow_policy_is_rejected(self):
+        with self.assertRaises(ValueError):
+            WriteBehindBuffer(ChatMessage, overflow_policy='spill')
+
+    async def test_conflicting_row_does_not_lose_the_batch(self):
+        await ChatMessage.objects.acreate(room='numbered', username='buffer-test', message='first', seq=1)
+        buffer = WriteBehindBuffer(ChatMessage, batch_size=10, flush_interval_ms=60000)
+        rows = [ChatMessage(room='numbered', username='buffer-test', message=f"message {seq}", seq=seq)
+                for seq in (1, 2, 3)]
+        with self.assertLogs('chat.buffers', 'ERROR'):
+            results = await asyncio.gather(*(buffer.enqueue(row, wait=True) for row in rows), buffer.close())
+        self.assertEqual(results[:3], [False, True, True])
+        self.assertEqual(buffer.write_errors, 1)
+        self.assertEqual(buffer.written, 2)
+        stored = [seq async for seq in ChatMessage.objects.filter(room='numbered').order_by('seq').values_list('seq', flat=True)]
+        self.assertEqual(stored, [1, 2, 3])
+
+    async def test_unsaved_lists_queued_rows(self):
+        buffer = WriteBehindBuffer(ChatMessage, batch_size=10, flush_interval_ms=60000)
+        row = self.message("queued")
+        await buffer.enqueue(row)
+        self.assertEqual(buffer.unsaved(), [row])
+        await buffer.close()
+        self.assertEqual(buffer.unsaved(), [])
+
+
+class DatabaseWriterTests(TransactionTestCase):
+    """Batches run on the test's thread, which stands in for the writer thread"""
+
+    def operation(self, fn, *args):
+        future = concurrent.futures.Future()
+        return (fn, args, {}, future)
+
+    def create(self, text):
+        return ChatMessage.objects.create(username='writer-test', message=text).message
+
+    def create_and_raise(self, text):
+        ChatMessage.objects.create(username='writer-test', message=text)
+        raise ValueError(text)
+
+    def test_failed_operation_is_rolled_back_alone(self):
+        writer = DatabaseWriter()
+        batch = [self.operation(self.create, 'first'), self.operation(self.create_and_raise, 'bad'),
+                 self.operation(self.create, 'second')]
+        writer._execute(batch)
+        self.assertEqual(batch[0][3].result(), 'first')
+        with self.assertRaises(ValueError):
+            batch[1][3].result()
+        self.assertEqual(batch[2][3].result(), 'second')
+        self.assertEqual(
+            sorted(ChatMessage.objects.filter(username='writer-test').values_list('message', flat=True)),
+            ['first', 'second']
+        )
+        self.assertEqual((writer.operations, writer.transactions, writer.errors), (3, 1, 1))
+
+    def test_operations_are_retried_one_by_one_after_a_failed_commit(self):
+        writer = DatabaseWriter()
+        commit = connection.commit
+        failures = [OperationalError("disk I/O error")]
+
+        def flaky_commit():
+            if failures:
+                raise failures.pop()
+            commit()
+
+        batch = [self.operation(self.create, 'first'), self.operation(self.create, 'second')]
+        with mock.patch.object(connection, 'commit', flaky_commit), \
+                self.assertLogs('chat.writer', 'ERROR'):
+            writer._execute(batch)
+        self.assertEqual([operation[3].result() for operation in batch], ['first', 'second'])
+        self.assertEqual(ChatMessage.objects.filter(username='writer-test').count(), 2)
+        self.assertEqual((writer.retried, writer.transactions), (2, 2))
+
+    def test_results_are_only_delivered_after_the_commit(self):
+        writer = DatabaseWriter()
+        operation = self.operation(self.create, 'first')
+
+        def check_uncommitted():
+            self.assertFalse(operation[3].done())
+
+        writer._execute([operation, self.operation(check_uncommitted)])
+        self.assertEqual(operation[3].result(), 'first')
+
+
+class PersistenceDurabilityTests(SimpleTestCase):
+    def test_default_is_batched(self):
+        with self.settings(CHAT_MESSAGE_PERSISTENCE={}):
+            self.assertEqual(get_persistence_durability(), 'batched')
+
+    def test_unknown_level_is_rejected(self):
+        with self.settings(CHAT_MESSAGE_PERSISTENCE={'DURABILITY': 'eventually'}):
+            with self.assertRaises(ValueError):
+                get_persistence_durability()
+
+
+class UnixSocketChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'layer.sock')
+
+    def layer(self):
+        layer = UnixSocketChannelLayer(path=self.path)
+        self.addCleanup(lambda: layer._lock_file and layer._lock_file.close())
+        return layer
+
+    async def start_broker(self):
+        """Run a broker on the test loop, standing in for another process"""
+        broker = Broker()
+        server = await asyncio.start_unix_server(broker.handle, path=self.path)
+        return broker, server
+
+    async def stop_broker(self, broker, server):
+        server.close()
+        # As a dead process would, leave no socket behind for peers to retry
+        os.unlink(self.path)
+        for conns in list(broker.peers.values()):
+            for conn in list(conns):
+                conn.close()
+        await server.wait_closed()
+        # Let the connection handlers see the close and finish
+        await asyncio.sleep(0.01)
+
+    async def wait_for_member(self, broker_of, group, channel):
+        for _ in range(200):
+            broker = broker_of()
+            if broker is not None and channel in broker.groups.get(group, {}):
+                return broker
+            await asyncio.sleep(0.01)
+        self.fail(f"{channel} was never registered in {group}")
+
+    async def test_group_send_reaches_members_in_other_processes(self):
+        broker, server = await self.start_broker()
+        sender, receiver = self.layer(), self.layer()
+        channel = await receiver.new_channel()
+        await receiver.group_add('room', channel)
+        await self.wait_for_member(lambda: broker, 'room', channel)
+
+        await sender.group_send('room', {'type': 'chat.message', 'message': 'hello'})
+        message = await asyncio.wait_for(receiver.receive(channel), 1)
+        self.assertEqual(message['message'], 'hello')
+
+        await sender.close()
+        await receiver.close()
+        await self.stop_broker(broker, server)
+
+    async def test_groups_are_registered_again_after_broker_failover(self):
+        broker, server = await self.start_broker()
+        sender, receiver = self.layer(), self.layer()
+        channel = await receiver.new_channel()
+        await receiver.group_add('room', channel)
+        await sender.group_send('room', {'type': 'chat.message', 'message': 'before'})
+        await self.wait_for_member(lambda: broker, 'room', channel)
+
+        # The broker process exits: one of the remaining layers takes over
+        with self.assertLogs('chat.layers', 'WARNING'):
+            await self.stop_broker(broker, server)
+
+        def new_broker():
+            for layer in (sender, receiver):
+                if layer._broker_thread is not None:
+                    return layer._broker_thread.broker
+            return None
+
+        await self.wait_for_member(new_broker, 'room', channel)
+        # Only one process may hold the lock and run the broker
+        self.assertEqual(
+            sum(layer._broker_thread is not None for layer in (sender, receiver)), 1
+        )
+        await sender.group_send('room', {'type': 'chat.message', 'message': 'after'})
+        messages = []
+        while not messages or messages[-1]['message'] != 'after':
+            messages.append(await asyncio.wait_for(receiver.receive(channel), 1))
+        self.assertEqual(messages[-1]['message'], 'after')
+
+        await sender.close()
+        await receiver.close()
+
+    async def test_sequences_are_shared_and_carried_over_on_failover(self):
+        broker, server = await self.start_broker()
+        first, second = self.layer(), self.layer()
+        numbers = await asyncio.gather(*(
+            layer.next_sequence('room') for layer in (first, second) * 5
+        ))
+        self.assertEqual(sorted(numbers), list(range(1, 11)))
+        # A floor from stored messages moves the counter forward
+        self.assertEqual(await first.next_sequence('room', floor=20), 21)
+
+        with self.assertLogs('chat.layers', 'WARNING'):
+            await self.stop_broker(broker, server)
+        # The new broker starts from what the processes had seen
+        self.assertEqual(await second.next_sequence('room'), 22)
+        self.assertEqual(await first.next_sequence('room'), 23)
+
+        await first.close()
+        await second.close()
+
+    async def test_connecting_gives_up_while_another_process_holds_the_lock(self):
+        # The lock is held, but no broker ever starts listening
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            with mock.patch.object(layers, 'CONNECT_TIMEOUT', 0.2), \
+                    self.assertLogs('chat.layers', 'ERROR'), \
+                    self.assertRaises(FileNotFoundError):
+                await self.layer().group_add('room', 'specific.x!y')
+
+    async def test_starting_the_broker_does_not_block_the_loop(self):
+        run = BrokerThread.run
+
+        def slow_run(thread):
+            time.sleep(0.2)
+            run(thread)
+
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        layer = self.layer()
+        with mock.patch.object(BrokerThread, 'run', slow_run):
+            await layer.group_add('room', await layer.new_channel())
+        ticker.cancel()
+        self.assertIsNotNone(layer._broker_thread)
+        self.assertGreater(ticks, 5)
+        await layer.close()
+
+    def test_membership_is_still_sent_to_a_peer_that_is_not_reading(self):
+        writer = mock.Mock()
+        writer.transport.get_write_buffer_size.return_value = layers.MAX_WRITE_BUFFER + 1
+        conn = OpWriter(writer)
+        conn.ops = [['group_send', 'room', {}], ['group_add', 'room', 'a!b'], ['deliver', ['a!b'], {}],
+                    ['group_discard', 'room', 'a!c']]
+        conn.flush()
+        written = msgpack.unpackb(writer.write.call_args.args[0][layers.HEADER_SIZE:])
+        self.assertEqual([op[0] for op in written], ['group_add', 'group_discard'])
+        self.assertEqual(conn.dropped, 2)
+
+    async def test_discarded_channels_stop_receiving(self):
+        broker, server = await self.start_broker()
+        sender, receiver = self.layer(), self.layer()
+        channel = await receiver.new_channel()
+        await receiver.group_add('room', channel)
+        await self.wait_for_member(lambda: broker, 'room', channel)
+        await receiver.group_discard('room', channel)
+        for _ in range(200):
+            if 'room' not in broker.groups:
+                break
+            await asyncio.sleep(0.01)
+        self.assertNotIn('room', broker.groups)
+
+        await sender.close()
+        await receiver.close()
+        await self.stop_broker(broker, server)
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=10, capacity=5)
+        now = bucket.updated
+        for _ in range(5):
+            self.assertEqual(bucket.wait_time(1, now), 0)
+            bucket.take(1)
+        self.assertAlmostEqual(bucket.wait_time(1, now), 0.1)
+        # Half a second refills five tokens, but never more than the burst
+        self.assertEqual(bucket.wait_time(5, now + 0.5), 0)
+        self.assertEqual(bucket.wait_time(1, now + 10), 0)
+        self.assertEqual(bucket.tokens, 5)
+
+    def test_reserved_tokens_queue_later_frames(self):
+        bucket = TokenBucket(rate=10, capacity=1)
+        now = bucket.updated
+        bucket.take(1)
+        bucket.take(1)
+        self.assertAlmostEqual(bucket.wait_time(1, now), 0.2)
+
+    def test_byte_burst_fits_the_largest_message(self):
+        with self.settings(CHAT_BINARY_PROTOCOL={'MAX_MESSAGE_SIZE': 4 * 1024 * 1024},
+                           CHAT_RATE_LIMITS={'CONNECTION': {'BYTE_BURST': 1024}}):
+            config = rate_limit_settings()
+        self.assertEqual(config['connection']['byte_burst'], 4 * 1024 * 1024)
+
+
+class RateLimiterTests(SimpleTestCase):
+    def limiter(self, action=ACTION_DROP, ip_burst=None, **connection):
+        config = rate_limit_settings()
+        config.update(enabled=True, action=action, max_delay=1.5)
+        config['connection'] = {'messages_per_second': 1, 'message_burst': 2,
+                                'bytes_per_second': None, 'byte_burst': None, **connection}
+        config['ip'] = {'messages_per_second': ip_burst and 1, 'message_burst': ip_burst,
+                        'bytes_per_second': None, 'byte_burst': None}
+        return RateLimiter(config)
+
+    def test_connections_from_one_address_share_its_bucket(self):
+        limiter = self.limiter(ip_burst=3)
+        first, second = limiter.connect('10.0.0.1'), limiter.connect('10.0.0.1')
+        self.assertEqual([first.check(10)[0] for _ in range(2)], [None, None])
+        self.assertEqual(second.check(10)[0], None)
+        self.assertEqual(second.check(10)[0], ACTION_DROP)
+        first.release()
+        second.release()
+        self.assertEqual(limiter.ip_buckets, {})
+
+    def test_byte_limits(self):
+        limiter = self.limiter(bytes_per_second=100, byte_burst=150)
+        rate_limit = limiter.connect('10.0.0.1')
+        self.assertEqual(rate_limit.check(100)[0], None)
+        self.assertEqual(rate_limit.check(100)[0], ACTION_DROP)
+        self.assertEqual(rate_limit.limited, 1)
+
+    def test_delay_turns_into_drop_past_the_maximum_delay(self):
+        limiter = self.limiter(action=ACTION_DELAY)
+        rate_limit = limiter.connect('10.0.0.1')
+        rate_limit.check(1)
+        rate_limit.check(1)
+        action, delay = rate_limit.check(1)
+        self.assertEqual(action, ACTION_DELAY)
+        self.assertAlmostEqual(delay, 1, places=1)
+        # The delayed frame reserved its token, so the next one is too far behind
+        self.assertEqual(rate_limit.check(1)[0], ACTION_DROP)
+
+
+class ConnectionTrackerTests(SimpleTestCase):
+    async def test_sweep_reaps_idle_watched_connections_once(self):
+        tracker = ConnectionTracker(sweep_interval=60, tracking_ttl=3600)
+        idle_calls = []
+
+        async def on_idle():
+            idle_calls.append(True)
+
+        watched = tracker.open('10.0.0.1', '/ws/chat/')
+        watched.watch_idle(30, on_idle)
+        tracker.open('10.0.0.1', '/ws/chat/')
+        tracker.sweep(now=watched.last_seen + 10)
+        tracker.sweep(now=watched.last_seen + 31)
+        tracker.sweep(now=watched.last_seen + 40)
+        await asyncio.sleep(0)
+        self.assertEqual(idle_calls, [True])
+        self.assertEqual(tracker.stats()['reaped_idle'], 1)
+        # Reaped connections stay tracked until their handler closes them
+        self.assertEqual(tracker.stats()['tracked'], 2)
+        tracker.close(watched)
+        self.assertEqual((tracker.stats()['tracked'], tracker.live), (1, 1))
+
+    async def test_entries_past_the_tracking_ttl_expire(self):
+        tracker = ConnectionTracker(sweep_interval=60, tracking_ttl=3600)
+        connection = tracker.open('10.0.0.1', '/ws/chat/')
+        tracker.sweep(now=connection.last_seen + 3601)
+        self.assertEqual(tracker.stats()['tracked'], 0)
+        self.assertEqual(tracker.expired, 1)
+        # The handler closing later doesn't fail on the expired entry
+        tracker.close(connection)
+        self.assertEqual(tracker.live, 0)
+
+
+class LiveProbeTests(SimpleTestCase):
+    async def test_asgi_port_probe_waits_for_the_connection_to_close(self):
+        server = await asyncio.start_server(lambda reader, writer: writer.close(), 'localhost', 0)
+        port = server.sockets[0].getsockname()[1]
+        wait_closed = mock.AsyncMock()
+        with self.settings(ASGI_PORT=port), \
+                mock.patch.object(asyncio.StreamWriter, 'wait_closed', wait_closed):
+            self.assertEqual(await probe_asgi_port(), 'open')
+        wait_closed.assert_awaited_once()
+        server.close()
+        await server.wait_closed()
+        with self.settings(ASGI_PORT=port):
+            self.assertTrue((await probe_asgi_port()).startswith('closed'))
+
+
+class HandshakeProbeTests(TransactionTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(db_writer, 'enabled', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_in_process_probe_round_trip(self):
+        probe = HandshakeProbe(timeout=2)
+        result = await probe.run_once()
+        await close_buffers()
+        self.assertEqual(result['status'], 'ok', result['error'])
+        self.assertIsNotNone(result['handshake_ms'])
+        self.assertIsNotNone(result['round_trip_ms'])
+        self.assertEqual(probe.stats()['last'], result)
+        # Probe connections skip the logging middleware
+        self.assertFalse(await ConnectionLifecycle.objects.filter(connection_path='/ws/probe/').aexists())
+        self.assertEqual(connection_tracker.stats()['live'], 0)
+
+    async def test_failed_and_timed_out_connections_are_recorded(self):
+        probe = HandshakeProbe()
+        with mock.patch.object(probe, 'connect', side_effect=ConnectionRefusedError("refused")):
+            result = await probe.run_once()
+        self.assertEqual((result['status'], result['handshake_ms']), ('error', None))
+        self.assertIn('refused', result['error'])
+        with mock.patch.object(probe, 'connect', side_effect=asyncio.TimeoutError()):
+            self.assertEqual((await probe.run_once())['status'], 'timeout')
+        self.assertEqual((probe.runs, probe.failures), (2, 2))
+
+    async def test_wrong_echo_is_an_error(self):
+        client = mock.AsyncMock()
+        client.receive_text.return_value = 'something else'
+        probe = HandshakeProbe()
+        with mock.patch.object(probe, 'connect', return_value=client):
+            result = await probe.run_once()
+        self.assertEqual(result['status'], 'error')
+        client.close.assert_awaited_once()
+
+    async def test_inline_runs_wait_for_the_interval(self):
+        probe = HandshakeProbe(interval=60)
+        with mock.patch.object(probe, 'run_once', mock.AsyncMock()) as run_once:
+            await probe.run_if_due()
+            await probe.run_if_due()
+        run_once.assert_awaited_once()
+
+    async def connect_probe(self, client, token=None):
+        application = WebSocketConnectionLoggingMiddleware(chat_application())
+        headers = [(b'x-chat-probe-token', token.encode())] if token is not None else []
+        communicator = WebsocketCommunicator(application, '/ws/probe/', headers)
+        communicator.scope['client'] = client
+        connected, _ = await communicator.connect()
+        if connected:
+            await communicator.disconnect()
+        return connected
+
+    async def test_probe_endpoint_requires_the_token(self):
+        with self.settings(DEBUG=True, DIAGNOSTICS_HANDSHAKE_PROBE={'TOKEN': 'secret'}):
+            for client in (['127.0.0.1', 50000], ['203.0.113.9', 50000], None):
+                self.assertFalse(await self.connect_probe(client))
+                self.assertFalse(await self.connect_probe(client, 'wrong'))
+            self.assertTrue(await self.connect_probe(['203.0.113.9', 50000], 'secret'))
+
+    async def test_loopback_probe_sends_the_token(self):
+        probe = HandshakeProbe(mode='loopback', url='ws://localhost:1/ws/probe/')
+        with self.settings(DIAGNOSTICS_HANDSHAKE_PROBE={'TOKEN': 'secret'}), \
+                mock.patch('chat.benchmarking.LoopbackClient.connect', mock.AsyncMock()) as connect:
+            await probe.connect()
+        self.assertIn((b'x-chat-probe-token', b'secret'), connect.await_args.args[1])
+
+    async def test_background_task_only_runs_when_enabled(self):
+        disabled = HandshakeProbe(enabled=False)
+        disabled.ensure_started()
+        self.assertIsNone(disabled._task)
+        probe = HandshakeProbe(interval=60)
+        with mock.patch.object(probe, 'run_once', mock.AsyncMock()) as run_once:
+            probe.ensure_started()
+            probe.ensure_started()
+            await asyncio.sleep(0)
+            probe.stop()
+        run_once.assert_awaited_once()
+
+
+class MessageSequencerTests(TestCase):
+    def event(self, seq):
+        return encode_chat_event(f"message {seq}", 'tester', '12:00:00', seq)
+
+    def test_record_keeps_events_in_order_without_duplicates(self):
+        sequencer = MessageSequencer(buffer_size=10)
+        for seq in (1, 3, 2, 3, 4):
+            sequencer.record('room', self.event(seq))
+        room = sequencer.rooms['room']
+        self.assertEqual([seq for seq, _ in room.events], [1, 2, 3, 4])
+        self.assertEqual(room.seq, 4)
+        self.assertEqual(room.floor, 0)
+
+    def test_record_moves_the_floor_when_the_buffer_is_full(self):
+        sequencer = MessageSequencer(buffer_size=3)
+        for seq in range(1, 6):
+            sequencer.record('room', self.event(seq))
+        room = sequencer.rooms['room']
+        self.assertEqual([seq for seq, _ in room.events], [3, 4, 5])
+        self.assertEqual(room.floor, 2)
+
+    async def test_missed_from_buffer(self):
+        sequencer = MessageSequencer(buffer_size=10)
+        for seq in range(1, 6):
+            sequencer.record('room', self.event(seq))
+        events, source, complete, current = await sequencer.missed('room', 3)
+        self.assertEqual([event['seq'] for event in events], [4, 5])
+        self.assertEqual((source, complete, current), (SOURCE_BUFFER, True, 5))
+
+    async def test_missed_ahead_of_the_room_is_incomplete(self):
+        sequencer = MessageSequencer(buffer_size=10)
+        sequencer.record('room', self.event(1))
+        events, source, complete, current = await sequencer.missed('room', 7)
+        self.assertEqual((events, complete, current), ([], False, 1))
+        self.assertEqual(sequencer.incomplete, 1)
+
+    async def test_missed_before_the_buffer_reads_the_database(self):
+        await ChatMessage.objects.abulk_create([
+            ChatMessage(room='stored', username='tester', message=f"message {seq}", seq=seq)
+            for seq in range(1, 6)
+        ])
+        sequencer = MessageSequencer(buffer_size=3)
+        for seq in range(6, 9):
+            # Not stored yet
+            sequencer.record('stored', self.event(seq))
+        events, source, complete, current = await sequencer.missed('stored', 2)
+        self.assertEqual([event['seq'] for event in events], [3, 4, 5, 6, 7, 8])
+        self.assertEqual((source, complete, current), (SOURCE_DATABASE, True, 8))
+
+    async def test_next_continues_from_the_stored_sequence(self):
+        await ChatMessage.objects.acreate(room='numbered', username='tester', message='hi', seq=41)
+        sequencer = MessageSequencer()
+        self.assertEqual(await sequencer.next('numbered'), 42)
+        self.assertEqual(await sequencer.next('numbered'), 43)
+
+    async def test_next_continues_from_unsaved_messages(self):
+        await ChatMessage.objects.acreate(room='numbered', username='tester', message='hi', seq=41)
+        queued = ChatMessage(room='numbered', username='tester', message='queued', seq=44)
+        other_room = ChatMessage(room='other', username='tester', message='queued', seq=90)
+        buffer = mock.Mock(unsaved=lambda: [queued, other_room])
+        sequencer = MessageSequencer()
+        with mock.patch('chat.buffers.get_chat_message_buffer', return_value=buffer):
+            self.assertEqual(await sequencer.next('numbered'), 45)
+
+    async def test_next_takes_numbers_from_the_shared_counter(self):
+        await ChatMessage.objects.acreate(room='numbered', username='tester', message='hi', seq=41)
+        counter = mock.AsyncMock(side_effect=[50, 52])
+        sequencer = MessageSequencer()
+        with mock.patch.object(sequencer, '_shared_counter', return_value=counter):
+            self.assertEqual(await sequencer.next('numbered'), 50)
+            self.assertEqual(await sequencer.next('numbered'), 52)
+        # Each request says what this process has already seen
+        self.assertEqual(counter.await_args_list, [mock.call('numbered', 41), mock.call('numbered', 50)])
+
+    def test_rooms_with_members_are_not_evicted(self):
+        sequencer = MessageSequencer(max_rooms=2, is_active=lambda name: name == 'busy')
+        for name in ('busy', 'idle', 'new'):
+            sequencer.record(name, self.event(1))
+        self.assertEqual(list(sequencer.rooms), ['busy', 'new'])
+
+    async def test_long_gaps_are_incomplete(self):
+        await ChatMessage.objects.abulk_create([
+            ChatMessage(room='stored', username='tester', message=f"message {seq}", seq=seq)
+            for seq in range(1, 6)
+        ])
+        sequencer = MessageSequencer(buffer_size=3, max_database_messages=3)
+        events, source, complete, current = await sequencer.missed('stored', 0)
+        self.assertEqual((events, source, complete, current), ([], SOURCE_DATABASE, False, 5))
+        self.assertEqual(sequencer.incomplete, 1)
+
+
+class RecentMessageCacheTests(SimpleTestCase):
+    start = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+
+    def message(self, id, room='room'):
+        return ChatMessage(id=id, room=room, username='tester', message=f"message {id}",
+                           timestamp=self.start + timedelta(seconds=id))
+
+    def ids(self, page):
+        return [message['id'] for _, message in page]
+
+    def test_unknown_room_misses(self):
+        cache = RecentMessageCache(size=5)
+        self.assertIsNone(cache.page('room', 2))
+        self.assertEqual(cache.misses, 1)
+
+    def test_seeded_room_serves_pages(self):
+        cache = RecentMessageCache(size=5)
+        cache.seed('room', [self.message(i) for i in (3, 2, 1)])
+        self.assertEqual(self.ids(cache.page('room', 2)), [2, 3])
+        before = (self.start + timedelta(seconds=2), 2)
+        self.assertEqual(self.ids(cache.page('room', 5, before)), [1])
+        self.assertEqual(cache.hits, 2)
+
+    def test_added_messages_are_kept_in_order(self):
+        cache = RecentMessageCache(size=5)
+        cache.seed('room', [])
+        cache.add([self.message(1), self.message(3), self.message(2)])
+        self.assertEqual(self.ids(cache.page('room', 5)), [1, 2, 3])
+
+    def test_evicted_messages_send_older_pages_to_the_database(self):
+        cache = RecentMessageCache(size=2)
+        cache.seed('room', [])
+        cache.add([self.message(i) for i in (1, 2, 3)])
+        self.assertEqual(self.ids(cache.page('room', 2)), [2, 3])
+        self.assertIsNone(cache.page('room', 3))
+
+    def test_least_recently_used_room_is_dropped(self):
+        cache = RecentMessageCache(size=2, max_rooms=1)
+        cache.seed('first', [])
+        cache.seed('second', [])
+        self.assertIsNone(cache.page('first', 1))
+
+
+class ConnectionRollupTests(TestCase):
+    def lifecycle(self, successful=True, error_message=None, duration=100, **fields):
+        return ConnectionLifecycle(client_ip='127.0.0.1', successful=successful,
+                                   error_message=error_message, connection_duration_ms=duration, **fields)
+
+    def create_lifecycles(self):
+        ConnectionLifecycle.objects.bulk_create([
+            self.lifecycle(),
+            self.lifecycle(duration=300),
+            self.lifecycle(successful=False, error_message='refused'),
+            self.lifecycle(successful=False, error_message='refused', duration=None),
+        ])
+        self.lifecycle(successful=False, error_message='timeout').save()
+
+    def test_statistics_add_up_rows(self):
+        self.create_lifecycles()
+        statistics = ConnectionLifecycle.get_connection_statistics()
+        self.assertEqual(statistics['total_attempts'], 5)
+        self.assertEqual(statistics['successful_attempts'], 2)
+        self.assertEqual(statistics['failed_attempts'], 3)
+        self.assertEqual(statistics['success_rate'], 40.0)
+        self.assertEqual(statistics['avg_duration'], 150.0)
+        self.assertEqual(
+            [(error['error_message'], error['count']) for error in statistics['common_errors']],
+            [('refused', 2), ('timeout', 1)]
+        )
+        self.assertEqual(sum(hour['attempts'] for hour in statistics['hourly_data']), 5)
+
+    def test_remove_takes_rows_back_out(self):
+        kept = self.lifecycle()
+        removed = [self.lifecycle(), self.lifecycle(successful=False, error_message='refused')]
+        ConnectionLifecycle.objects.bulk_create([kept, *removed])
+        ConnectionStatsRollup.remove(removed)
+        total = ConnectionStatsRollup.objects.get(period=ConnectionStatsRollup.PERIOD_TOTAL)
+        self.assertEqual((total.attempts, total.successes, total.failures), (1, 1, 0))
+        self.assertEqual((total.duration_sum, total.duration_count), (100, 1))
+        self.assertFalse(ConnectionErrorRollup.objects.exists())
+
+    def test_benchmark_connections_are_deleted_and_uncounted(self):
+        self.create_lifecycles()
+        before = ConnectionLifecycle.get_connection_statistics()
+        ConnectionLifecycle.objects.bulk_create([
+            self.lifecycle(user_agent=BENCHMARK_USER_AGENT),
+            self.lifecycle(successful=False, error_message='bench error', user_agent=BENCHMARK_USER_AGENT),
+        ])
+        ConnectionAttempt.objects.bulk_create([ConnectionAttempt(user_agent=BENCHMARK_USER_AGENT)])
+        self.assertEqual(delete_benchmark_connections(), 3)
+        self.assertEqual(ConnectionLifecycle.get_connection_statistics(), before)
+        self.assertFalse(ConnectionLifecycle.objects.filter(user_agent=BENCHMARK_USER_AGENT).exists())
+
+    def test_rebuild_matches_incremental_rollups(self):
+        self.create_lifecycles()
+        incremental = ConnectionLifecycle.get_connection_statistics()
+        call_command('rebuild_connection_rollups', stdout=io.StringIO())
+        self.assertEqual(ConnectionLifecycle.get_connection_statistics(), incremental)
+
+
+class BenchmarkCleanupTests(TransactionTestCase):
+    def setUp(self):
+        # Write on the test's own thread and connection
+        patcher = mock.patch.object(db_writer, 'enabled', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_only_the_recorded_messages_are_deleted(self):
+        room = benchmark_room('bench')
+        self.assertNotEqual(room, benchmark_room('bench'))
+        ChatMessage.objects.bulk_create(
+            [ChatMessage(room=room, username='tester', message=str(seq), seq=seq) for seq in range(1, 4)]
+            + [ChatMessage(room='chat_room', username='chatbench', message='real', seq=1)]
+        )
+        self.assertEqual(delete_benchmark_messages(room, {1, 2, None}), 2)
+        self.assertEqual(
+            sorted(ChatMessage.objects.values_list('room', 'seq')), sorted([(room, 3), ('chat_room', 1)])
+        )
+
+    def test_bench_persistence_cleans_up_after_itself(self):
+        ChatMessage.objects.create(room='chat_room', username='chatbench', message='real')
+        call_command('bench_persistence', clients=2, messages=3, stdout=io.StringIO())
+        self.assertEqual(list(ChatMessage.objects.values_list('message', flat=True)), ['real'])
+
+    def test_chatbench_cleans_up_after_itself(self):
+        ChatMessage.objects.create(room='chat_room', username='chatbench', message='real')
+        output = io.StringIO()
+        with mock.patch.object(rate_limiter, 'enabled', True):
+            call_command('chatbench', clients=2, rate=20, duration=0.2, drain_timeout=1, json=True, stdout=output)
+        result = json.loads(output.getvalue())
+        self.assertTrue(result['room'].startswith('chatbench-'))
+        self.assertEqual(result['db_rows_written']['chat_messages'], result['messages_sent'])
+        self.assertEqual(list(ChatMessage.objects.values_list('message', flat=True)), ['real'])
+
+    def test_stress_db_writes_cleans_up_after_itself(self):
+        ChatMessage.objects.create(room='chat_room', username='stress_db_writes', message='real')
+        output = io.StringIO()
+        with mock.patch.object(rate_limiter, 'enabled', True):
+            call_command('stress_db_writes', connections=3, messages=2, readers=1, no_writer=True,
+                         json=True, stdout=output)
+        result = json.loads(output.getvalue())
+        self.assertEqual(result['db_rows_written']['chat_messages'], 6)
+        self.assertEqual(list(ChatMessage.objects.values_list('message', flat=True)), ['real'])
+
+
+class OutboundQueueTests(SimpleTestCase):
+    def sender(self):
+        """A send function that blocks until released, and the frames it sent"""
+        sent = []
+        release = asyncio.Event()
+
+        async def send(frame):
+            await release.wait()
+            sent.append(frame)
+
+        return send, sent, release
+
+    async def test_drop_oldest(self):
+        send, sent, release = self.sender()
+        queue = OutboundQueue(send, max_size=2, policy=POLICY_DROP_OLDEST)
+        queue.put('a')
+        # 'a' is being sent; 'b' is dropped to make room for 'd'
+        await asyncio.sleep(0)
+        for frame in ('b', 'c', 'd'):
+            queue.put(frame)
+        self.assertEqual(queue.dropped, 1)
+        release.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(sent, ['a', 'c', 'd'])
+        await queue.aclose()
+
+    async def test_coalesce_keeps_the_newest_frame_for_a_key(self):
+        send, sent, release = self.sender()
+        queue = OutboundQueue(send, max_size=10, policy=POLICY_COALESCE)
+        queue.put('a')
+        await asyncio.sleep(0)
+        queue.put('presence 1', key='presence')
+        queue.put('b')
+        queue.put('presence 2', key='presence')
+        self.assertEqual(queue.coalesced, 1)
+        release.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(sent, ['a', 'presence 2', 'b'])
+        await queue.aclose()
+
+    async def test_disconnect_hands_the_connection_to_on_lag(self):
+        send, sent, release = self.sender()
+        lagged = asyncio.Event()
+
+        async def on_lag():
+            lagged.set()
+
+        queue = OutboundQueue(send, on_lag=on_lag, max_size=2, policy=POLICY_DISCONNECT)
+        with self.assertLogs('chat.outbound', 'WARNING'):
+            for frame in ('a', 'b', 'c', 'd'):
+                queue.put(frame)
+        await asyncio.wait_for(lagged.wait(), 1)
+        self.assertTrue(queue.disconnected)
+        self.assertEqual(len(queue), 0)
+        await queue.aclose()
+
+    async def test_aclose_waits_for_the_sending_task(self):
+        send, sent, release = self.sender()
+        queue = OutboundQueue(send)
+        queue.put('a')
+        await asyncio.sleep(0)
+        task = queue._task
+        await queue.aclose()
+        self.assertTrue(task.done())
+        self.assertEqual(sent, [])
+
+    async def test_batches_share_a_frame(self):
+        sent = []
+
+        async def send(frame):
+            sent.append(frame)
+
+        protocol = JsonProtocol()
+        queue = OutboundQueue(send, batch_size=3, batch_window_ms=50, join=protocol.join)
+        for i in range(3):
+            queue.put(json.dumps(i))
+        await asyncio.sleep(0.01)
+        self.assertEqual(sent, ['[0,1,2]'])
+        await queue.aclose()
+
+    def test_frame_batching_is_clamped_to_the_settings(self):
+        def scope(query):
+            return {'query_string': query.encode()}
+
+        with self.settings(CHAT_FRAME_BATCHING={'MAX_BATCH_SIZE': 10, 'MAX_WINDOW_MS': 20}):
+            self.assertEqual(frame_batching(scope('')), (1, 0))
+            self.assertEqual(frame_batching(scope('batch_size=50&batch_window_ms=100')), (10, 20))
+            self.assertEqual(frame_batching(scope('batch_size=many')), (1, 0))
+
+
+class RoomTests(SimpleTestCase):
+    class Layer:
+        """A channel layer whose group_send waits until released"""
+
+        def __init__(self):
+            self.sent = []
+            self.release = asyncio.Event()
+            self.fail = set()
+
+        async def group_send(self, group, event):
+            await self.release.wait()
+            if event['n'] in self.fail:
+                raise ConnectionError("layer down")
+            self.sent.append(event['n'])
+
+    async def test_full_room_drops_and_counts_new_broadcasts(self):
+        layer = self.Layer()
+        room = RoomRegistry(max_pending=2, overflow_policy=OVERFLOW_DROP).join('room', 'chat_room', layer, 'member')
+        dropped = rooms.totals['dropped']
+        self.assertTrue(await room.publish({'n': 1}))
+        # The fan-out task takes 1 and waits on the layer; 2 and 3 fill the queue
+        await asyncio.sleep(0)
+        self.assertEqual([await room.publish({'n': n}) for n in (2, 3, 4)], [True, True, False])
+        self.assertEqual(room.stats()['dropped_broadcasts'], 1)
+        self.assertEqual(rooms.totals['dropped'], dropped + 1)
+        self.assertIn('chat_room_broadcasts_lost_total{reason="dropped"}', registry.render())
+        layer.release.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(layer.sent, [1, 2, 3])
+
+    async def test_full_room_makes_the_sender_wait_for_space(self):
+        layer = self.Layer()
+        room = RoomRegistry(max_pending=1, max_wait=1).join('room', 'chat_room', layer, 'member')
+        await room.publish({'n': 1})
+        await asyncio.sleep(0)
+        await room.publish({'n': 2})
+        waiting = asyncio.create_task(room.publish({'n': 3}))
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiting.done())
+        layer.release.set()
+        self.assertTrue(await waiting)
+        await asyncio.sleep(0.01)
+        self.assertEqual(layer.sent, [1, 2, 3])
+        self.assertEqual((room.waited, room.dropped), (1, 0))
+
+    async def test_waiting_for_space_is_bounded(self):
+        layer = self.Layer()
+        room = RoomRegistry(max_pending=1, max_wait=0.01).join('room', 'chat_room', layer, 'member')
+        await room.publish({'n': 1})
+        await asyncio.sleep(0)
+        await room.publish({'n': 2})
+        self.assertFalse(await room.publish({'n': 3}))
+        self.assertEqual((room.waited, room.dropped), (1, 1))
+        layer.release.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(layer.sent, [1, 2])
+
+    def test_unknown_overflow_policy_is_rejected(self):
+        with self.settings(CHAT_ROOMS={'OVERFLOW_POLICY': 'sample'}), self.assertRaises(ValueError):
+            rooms.room_settings()
+
+    async def test_failed_send_does_not_stop_the_room(self):
+        layer = self.Layer()
+        layer.fail.add(1)
+        layer.release.set()
+        room = RoomRegistry().join('room', 'chat_room', layer, 'member')
+        with self.assertLogs('chat.rooms', 'ERROR'):
+            for n in (1, 2):
+                await room.publish({'n': n})
+            await asyncio.sleep(0.01)
+        self.assertEqual(layer.sent, [2])
+        self.assertEqual((room.failed, room.broadcasts), (1, 1))
+
+    async def test_room_is_removed_once_empty_and_drained(self):
+        layer = self.Layer()
+        rooms_registry = RoomRegistry()
+        room = rooms_registry.join('room', 'chat_room', layer, 'member')
+        await room.publish({'n': 1})
+        rooms_registry.leave('room', 'member')
+        # Still sending what was queued
+        self.assertIs(rooms_registry.get('room'), room)
+        layer.release.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual(layer.sent, [1])
+        self.assertIsNone(rooms_registry.get('room'))
+
+
+class MetricsTests(SimpleTestCase):
+    def test_render_counters_and_cumulative_histograms(self):
+        registry = Registry()
+        requests = registry.counter('requests_total', "Requests", ['path'])
+        latency = registry.histogram('latency_seconds', "Latency", buckets=(0.1, 1.0))
+        requests.labels('/chat/"x"').inc(2)
+        for value in (0.05, 0.5, 5):
+            latency.observe(value)
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE requests_total counter', lines)
+        self.assertIn('requests_total{path="/chat/\\"x\\""} 2.0', lines)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1.0', lines)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 2.0', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3.0', lines)
+        self.assertIn('latency_seconds_count 3.0', lines)
+        self.assertIn('latency_seconds_sum 5.55', lines)
+
+    def test_labels_must_match_the_label_names(self):
+        counter = Registry().counter('frames_total', "Frames", ['direction'])
+        with self.assertRaises(ValueError):
+            counter.labels('in', 'extra')
+
+    def test_metrics_endpoint_renders_metrics_and_collectors(self):
+        response = self.client.get('/chat/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('# TYPE chat_connections_active gauge', body)
+        self.assertIn('# TYPE chat_handshake_duration_seconds histogram', body)
+        self.assertIn('# TYPE chat_write_buffer_depth gauge', body)
+        self.assertIn('chat_outbound_actions_total{action="dropped"}', body)
+
+
+
+class PresenceRegistryTests(SimpleTestCase):
+    def usernames(self, registry, room):
+        return {user['username']: user['connections'] for user in registry.room(room)['users']}
+
+    def test_remote_deltas_update_the_counts(self):
+        registry = PresenceRegistry()
+        registry._apply_remote_deltas('other', [
+            ('room', 'alice', 1), ('room', 'bob', 1), ('room', 'alice', 1),
+        ])
+        self.assertEqual(self.usernames(registry, 'room'), {'alice': 2, 'bob': 1})
+        registry._apply_remote_deltas('other', [('room', 'alice', -2)])
+        self.assertEqual(self.usernames(registry, 'room'), {'bob': 1})
+        self.assertEqual(registry.remote['other'][1], {'room': {'bob': 1}})
+
+    def test_snapshot_repairs_lost_deltas(self):
+        registry = PresenceRegistry()
+        registry._apply_remote_deltas('other', [('room', 'alice', 1), ('room', 'bob', 1)])
+        # The process missed bob leaving and carol joining
+        snapshot = {'room': {'alice': 1, 'carol': 2}}
+        registry._replace_remote('other', snapshot)
+        self.assertEqual(self.usernames(registry, 'room'), {'alice': 1, 'carol': 2})
+        registry._replace_remote('other', snapshot)
+        self.assertEqual(self.usernames(registry, 'room'), {'alice': 1, 'carol': 2})
+
+    async def test_silent_processes_are_forgotten(self):
+        registry = PresenceRegistry(broadcast_interval=60, sync_interval=0.02)
+        registry.tick = 0.01
+        registry.channel_layer = InMemoryChannelLayer()
+        registry._replace_remote('other', {'room': {'alice': 1}})
+        registry.remote['other'][0] -= 1
+        task = asyncio.get_running_loop().create_task(registry._run())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        self.assertNotIn('other', registry.remote)
+        self.assertEqual(registry.room('room')['online'], 0)
+
+    async def test_updates_list_net_changes_once_per_interval(self):
+        registry = PresenceRegistry()
+        layer = registry.channel_layer = InMemoryChannelLayer()
+        listener = await layer.new_channel()
+        await layer.group_add(presence_group('room'), listener)
+
+        registry._apply('room', 'alice', 1)
+        # bob reconnects within the interval and never shows up
+        registry._apply('room', 'bob', 1)
+        registry._apply('room', 'bob', -1)
+        await registry._send_updates()
+        update = json.loads((await layer.receive(listener))['text'])
+        self.assertEqual((update['joined'], update['left'], update['online']), (['alice'], [], 1))
+
+        registry._apply('room', 'alice', -1)
+        registry._apply('room', 'alice', 1)
+        await registry._send_updates()
+        self.assertEqual((registry.updates_sent, registry.updates_suppressed), (1, 1))
+
+    async def test_only_the_leader_sends_updates(self):
+        registry = PresenceRegistry()
+        layer = registry.channel_layer = InMemoryChannelLayer()
+        listener = await layer.new_channel()
+        await layer.group_add(presence_group('room'), listener)
+        registry._replace_remote('', {})
+        registry._apply('room', 'alice', 1)
+        await registry._send_updates()
+        self.assertEqual(registry.updates_sent, 0)
+        self.assertEqual(registry.changed, {})
+
+
+class ExportTests(TestCase):
+    start = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+
+    @classmethod
+    def setUpTestData(cls):
+        # Three messages share a timestamp, so chunks must break ties on id
+        times = [0, 1, 1, 1, 2]
+        ChatMessage.objects.bulk_create([
+            ChatMessage(room='a' if i % 2 == 0 else 'b', username='tester', message=f"message {i}",
+                        timestamp=cls.start + timedelta(seconds=seconds))
+            for i, seconds in enumerate(times)
+        ])
+
+    async def export(self, url):
+        response = await AsyncClient().get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join([chunk async for chunk in response.streaming_content])
+
+    async def test_rows_are_read_in_keyset_chunks(self):
+        with self.settings(CHAT_EXPORT_CHUNK_SIZE=2), \
+                mock.patch.object(export, 'fetch_chunk', wraps=export.fetch_chunk) as fetch_chunk:
+            output = b''.join([
+                chunk async for chunk in stream_rows(ChatMessage.objects.all(), CHAT_MESSAGE_FIELDS, 'ndjson')
+            ])
+        rows = [json.loads(line) for line in output.decode().splitlines()]
+        expected = [message.id async for message in ChatMessage.objects.order_by('timestamp', 'id')]
+        self.assertEqual([row['id'] for row in rows], expected)
+        self.assertEqual(fetch_chunk.call_count, 3)
+
+    async def test_filters_by_room_and_time_range(self):
+        query = urlencode({
+            'room': 'a',
+            'format': 'csv',
+            'since': (self.start + timedelta(seconds=1)).isoformat(),
+            'until': (self.start + timedelta(seconds=2)).isoformat(),
+        })
+        response, output = await self.export(f'/chat/export/messages/?{query}')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(output.decode())))
+        self.assertEqual([row['message'] for row in rows], ['message 2'])
+
+    async def test_gzip_output_matches_the_plain_export(self):
+        _, plain = await self.export('/chat/export/messages/')
+        response, compressed = await self.export('/chat/export/messages/?gzip=1')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('chat_messages.ndjson.gz', response['Content-Disposition'])
+        self.assertEqual(gzip.decompress(compressed), plain)
+        self.assertEqual(len(plain.splitlines()), 5)
+
+    async def test_wsgi_requests_stream_from_a_plain_iterator(self):
+        _, streamed = await self.export('/chat/export/messages/?format=csv&gzip=1')
+        response = await sync_to_async(self.client.get)('/chat/export/messages/?format=csv&gzip=1')
+        self.assertFalse(response.is_async)
+        self.assertEqual(b''.join(await sync_to_async(list)(response.streaming_content)), streamed)
+
+    def test_iter_rows_reads_the_same_keyset_chunks(self):
+        with self.settings(CHAT_EXPORT_CHUNK_SIZE=2), \
+                mock.patch.object(export, 'fetch_chunk', wraps=export.fetch_chunk) as fetch_chunk:
+            output = b''.join(iter_rows(ChatMessage.objects.all(), CHAT_MESSAGE_FIELDS, 'ndjson'))
+        self.assertEqual(len(output.splitlines()), 5)
+        self.assertEqual(fetch_chunk.call_count, 3)
+
+    def test_chunks_are_read_in_index_order(self):
+        after = ChatMessage.objects.order_by('timestamp', 'id').values_list('timestamp', 'id').first()
+        for queryset, index in ((ChatMessage.objects.all(), 'chat_msg_ts_id_idx'),
+                                (ChatMessage.objects.filter(room='a'), 'chat_msg_room_ts_id_idx')):
+            with CaptureQueriesContext(connection) as queries:
+                export.fetch_chunk(queryset, CHAT_MESSAGE_FIELDS, after, 2)
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + queries[0]['sql'])
+                plan = ' '.join(row[-1] for row in cursor.fetchall())
+            self.assertIn(index, plan)
+            # A sort would read every row after the key for each chunk
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    async def test_bad_parameters_are_rejected(self):
+        for query in ('format=xml', 'since=yesterday'):
+            response = await AsyncClient().get(f'/chat/export/messages/?{query}')
+            self.assertEqual(response.status_code, 400)
+
+
+class MatchExpressionTests(SimpleTestCase):
+    def test_words_are_quoted_terms(self):
+        self.assertEqual(match_expression('deploy failed'), '"deploy" "failed"')
+
+    def test_prefix_search(self):
+        self.assertEqual(match_expression('deploy*'), '"deploy"*')
+
+    def test_syntax_is_escaped(self):
+        self.assertEqual(match_expression('say "hi" OR NOT'), '"say" """hi""" "OR" "NOT"')
+        self.assertEqual(match_expression('* **'), '')
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        if not fts_available():
+            self.skipTest("SQLite was built without FTS5")
+
+    def test_best_match_first_with_snippets(self):
+        ChatMessage.objects.bulk_create([
+            ChatMessage(room='ops', username='tester', message="the deploy failed again, deploy is broken"),
+            ChatMessage(room='ops', username='tester', message="lunch?"),
+            ChatMessage(room='dev', username='tester', message="deploy finished"),
+        ])
+        results = search_messages('deploy')
+        self.assertEqual({result['room'] for result in results}, {'ops', 'dev'})
+        self.assertEqual(results, sorted(results, key=lambda result: result['rank']))
+        self.assertTrue(all('[deploy]' in result['snippet'] for result in results))
+        self.assertEqual([result['room'] for result in search_messages('deploy', room='dev')], ['dev'])
+        self.assertEqual(len(search_messages('dep*')), 2)
+
+    def test_index_follows_edits_and_deletes(self):
+        message = ChatMessage.objects.create(room='ops', username='tester', message="rollback started")
+        self.assertEqual(len(search_messages('rollback')), 1)
+        message.message = "rollout started"
+        message.save()
+        self.assertEqual(search_messages('rollback'), [])
+        self.assertEqual(len(search_messages('rollout')), 1)
+        message.delete()
+        self.assertEqual(search_messages('rollout'), [])
+
+    def test_timestamps_match_the_orm(self):
+        message = ChatMessage.objects.create(room='ops', username='tester', message="timezone check")
+        message.refresh_from_db()
+        result, = search_messages('timezone')
+        self.assertEqual(result['timestamp'], message.timestamp.isoformat())
+        self.assertIsNotNone(datetime.fromisoformat(result['timestamp']).tzinfo)
+
+    def test_availability_is_checked_once(self):
+        with self.assertNumQueries(0):
+            self.assertTrue(fts_available())
+        with mock.patch('chat.views.fts_available', wraps=fts_available) as available:
+            self.assertEqual(self.client.get('/chat/search/', {'q': 'disk'}).status_code, 200)
+        self.assertEqual(available.call_count, 1)
+
+    def test_search_view(self):
+        ChatMessage.objects.create(room='ops', username='tester', message="disk full")
+        response = self.client.get('/chat/search/', {'q': 'disk'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['message'] for result in response.json()['results']], ["disk full"])
+        self.assertEqual(self.client.get('/chat/search/', {'q': '**'}).status_code, 400)
+
+
+class SearchIndexMigrationTests(TransactionTestCase):
+    def setUp(self):
+        if not fts_available():
+            self.skipTest("SQLite was built without FTS5")
+
+    def test_migration_creates_and_drops_the_index(self):
+        ChatMessage.objects.create(room='ops', username='tester', message="disk full")
+        call_command('migrate', 'chat', '0009', verbosity=0)
+        self.assertFalse(fts_available())
+        self.assertEqual(search_messages('disk')[0]['rank'], None)
+
+        call_command('migrate', 'chat', verbosity=0)
+        self.assertTrue(fts_available())
+        # Messages stored before the index existed are indexed too
+        self.assertEqual(len(search_messages('disk')), 1)
+        self.assertIsNotNone(search_messages('disk')[0]['rank'])
+
+
+class LatencyTracerTests(SimpleTestCase):
+    def histogram_count(self, stage):
+        return sum(MESSAGE_STAGE_LATENCY.labels(stage).counts)
+
+    def test_sampling(self):
+        self.assertIsNone(LatencyTracer(sample_rate=0).start())
+        tracer = LatencyTracer(sample_rate=1)
+        trace = tracer.start()
+        self.assertEqual(trace['host'], tracer.host)
+        self.assertEqual(tracer.traced, 1)
+        with mock.patch('chat.tracing.random.random', return_value=0.5):
+            self.assertIsNone(LatencyTracer(sample_rate=0.25).start())
+            self.assertIsNotNone(LatencyTracer(sample_rate=0.75).start())
+
+    def test_start_keeps_the_receive_time(self):
+        trace = LatencyTracer(sample_rate=1).start(received_at=12.5)
+        self.assertEqual(trace[STAGE_RECEIVED], 12.5)
+
+    def test_stages_feed_the_histograms(self):
+        tracer = LatencyTracer(sample_rate=1, window=10)
+        published, delivered = self.histogram_count(STAGE_PUBLISHED), self.histogram_count(STAGE_DELIVERED)
+        trace = tracer.start()
+        tracer.mark(trace, STAGE_PUBLISHED)
+        for _ in range(3):
+            tracer.mark(dict(trace), STAGE_DELIVERED)
+        self.assertIn(STAGE_PUBLISHED, trace)
+        # Deliveries are recorded per recipient without changing the shared trace
+        self.assertNotIn(STAGE_DELIVERED, trace)
+        self.assertEqual(self.histogram_count(STAGE_PUBLISHED), published + 1)
+        self.assertEqual(self.histogram_count(STAGE_DELIVERED), delivered + 3)
+        self.assertEqual(tracer.stats()['stages'][STAGE_DELIVERED]['count'], 3)
+
+    def test_traces_from_other_hosts_are_skipped(self):
+        tracer = LatencyTracer(sample_rate=1)
+        tracer.mark({'host': 'elsewhere', 'received': 0}, STAGE_DELIVERED)
+        tracer.mark(None, STAGE_DELIVERED)
+        self.assertEqual(tracer.skipped, 1)
+        self.assertEqual(len(tracer.samples[STAGE_DELIVERED]), 0)
+
+
+class ProtocolTests(SimpleTestCase):
+    def test_negotiate_prefers_compressed_msgpack(self):
+        self.assertIsInstance(negotiate(['chat.msgpack', 'chat.msgpack+zlib']), CompressedMsgpackProtocol)
+        self.assertIsInstance(negotiate(['chat.msgpack']), MsgpackProtocol)
+        self.assertIsInstance(negotiate(['graphql-ws']), JsonProtocol)
+
+    def test_json_protocol_rejects_binary_frames(self):
+        with self.assertRaises(ProtocolError):
+            JsonProtocol().decode(bytes_data=b'\x81\xa1a\x01')
+
+    def test_msgpack_decode(self):
+        protocol = MsgpackProtocol()
+        self.assertEqual(protocol.decode(bytes_data=msgpack.packb({'message': 'hi'})), {'message': 'hi'})
+        # Text frames still work on binary connections
+        self.assertEqual(protocol.decode(text_data='{"message": "hi"}'), {'message': 'hi'})
+        for payload in (b'\xc1', msgpack.packb([1, 2])):
+            with self.assertRaises(ProtocolError):
+                protocol.decode(bytes_data=payload)
+
+    def test_compressed_decode(self):
+        protocol = CompressedMsgpackProtocol(max_message_size=1024)
+        payload = msgpack.packb({'message': 'x' * 500})
+        self.assertEqual(protocol.decode(bytes_data=FLAG_RAW + payload), {'message': 'x' * 500})
+        self.assertEqual(protocol.decode(bytes_data=FLAG_ZLIB + zlib.compress(payload)), {'message': 'x' * 500})
+        with self.assertRaises(ProtocolError):
+            protocol.decode(bytes_data=b'\x02' + payload)
+        with self.assertRaises(ProtocolError):
+            protocol.decode(bytes_data=FLAG_ZLIB + b'not zlib')
+
+    def test_compressed_decode_limits_the_decompressed_size(self):
+        protocol = CompressedMsgpackProtocol(max_message_size=1024)
+        bomb = FLAG_ZLIB + zlib.compress(msgpack.packb({'message': 'x' * 100000}))
+        with self.assertRaises(ProtocolError):
+            protocol.decode(bytes_data=bomb)
+
+    def test_chat_event_frames_for_every_protocol(self):
+        event = encode_chat_event('x' * 500, 'tester', '12:00:00')
+        expected = {'message': 'x' * 500, 'username': 'tester', 'timestamp': '12:00:00'}
+        self.assertEqual(json.loads(JsonProtocol().frame(event)), expected)
+        self.assertEqual(msgpack.unpackb(MsgpackProtocol().frame(event), raw=False), expected)
+        compressed = CompressedMsgpackProtocol(compression_threshold=64).frame(event)
+        self.assertEqual(compressed[:1], FLAG_ZLIB)
+        self.assertEqual(CompressedMsgpackProtocol().decode(bytes_data=compressed), expected)
+
+    def test_binary_encodings_are_made_lazily_once_per_event(self):
+        with mock.patch('chat.protocol.msgpack.packb', wraps=msgpack.packb) as packb, \
+                mock.patch('chat.protocol.zlib.compress', wraps=zlib.compress) as compress:
+            event = encode_chat_event('y' * 500, 'tester', '12:00:00', seq=7)
+            self.assertEqual((packb.call_count, compress.call_count), (0, 0))
+            # Every recipient gets its own copy of the event
+            for copy in (copy_module.deepcopy(event) for _ in range(3)):
+                MsgpackProtocol().frame(copy)
+                CompressedMsgpackProtocol(compression_threshold=64).frame(copy)
+        self.assertEqual((packb.call_count, compress.call_count), (1, 1))
+
+
+
+class ChatConsumerTests(TransactionTestCase):
+    def setUp(self):
+        # Write on the test's own thread and connection
+        patcher = mock.patch.object(db_writer, 'enabled', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def connect(self, path, application=None, **kwargs):
+        communicator = WebsocketCommunicator(application or chat_application(), path, **kwargs)
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    async def test_reconnecting_client_gets_what_it_missed(self):
+        sender, _ = await self.connect('/ws/chat/replay-test/')
+        for i in range(3):
+            await sender.send_json_to({'message': f"message {i}", 'username': 'tester'})
+            await sender.receive_json_from()
+
+        client, _ = await self.connect('/ws/chat/replay-test/?last_seq=1')
+        self.assertEqual([(await client.receive_json_from())['seq'] for _ in range(2)], [2, 3])
+        replay = await client.receive_json_from()
+        self.assertEqual(
+            {key: replay[key] for key in ('type', 'last_seq', 'replayed', 'source', 'complete')},
+            {'type': 'replay', 'last_seq': 3, 'replayed': 2, 'source': 'buffer', 'complete': True}
+        )
+
+        # Live messages keep arriving after the replay
+        await sender.send_json_to({'message': 'live', 'username': 'tester'})
+        self.assertEqual((await client.receive_json_from())['seq'], 4)
+
+        ahead, _ = await self.connect('/ws/chat/replay-test/?last_seq=99')
+        replay = await ahead.receive_json_from()
+        self.assertEqual((replay['last_seq'], replay['replayed'], replay['complete']), (4, 0, False))
+        # A client ahead of the room still gets live messages
+        await sender.send_json_to({'message': 'after reload', 'username': 'tester'})
+        self.assertEqual((await ahead.receive_json_from())['seq'], 5)
+
+        for communicator in (sender, client, ahead):
+            await communicator.disconnect()
+        await close_buffers()
+
+    async def test_msgpack_subprotocol(self):
+        client, subprotocol = await self.connect('/ws/chat/msgpack-test/', subprotocols=['chat.msgpack'])
+        self.assertEqual(subprotocol, 'chat.msgpack')
+        await client.send_to(bytes_data=msgpack.packb({'message': 'hi', 'username': 'tester'}))
+        frame = msgpack.unpackb(await client.receive_from(), raw=False)
+        self.assertEqual((frame['message'], frame['username']), ('hi', 'tester'))
+        await client.disconnect()
+        await close_buffers()
+
+    async def test_json_clients_get_text_frames(self):
+        client, subprotocol = await self.connect('/ws/chat/json-test/')
+        self.assertIsNone(subprotocol)
+        await client.send_json_to({'message': 'hi', 'username': 'tester'})
+        self.assertEqual((await client.receive_json_from())['message'], 'hi')
+        await client.disconnect()
+        await close_buffers()
+
+    async def test_sender_is_told_about_a_dropped_broadcast(self):
+        client, _ = await self.connect('/ws/chat/busy-test/')
+        with mock.patch.object(rooms.Room, 'publish', mock.AsyncMock(return_value=False)):
+            await client.send_json_to({'message': 'hi', 'username': 'tester'})
+            error = await client.receive_json_from()
+        self.assertEqual((error['type'], error['error'], error['seq']), ('error', 'room_busy', 1))
+        await client.disconnect()
+        await close_buffers()
+
+    async def test_undecodable_frame_closes_with_1007(self):
+        client, _ = await self.connect('/ws/chat/msgpack-test/', subprotocols=['chat.msgpack'])
+        await client.send_to(bytes_data=b'\xc1')
+        output = await client.receive_output()
+        self.assertEqual(output, {'type': 'websocket.close', 'code': 1007})
+        await client.wait()
+
+    async def test_frames_over_the_rate_limit_are_dropped(self):
+        config = rate_limit_settings()
+        config.update(enabled=True, action=ACTION_DROP)
+        config['connection'] = {'messages_per_second': 0.01, 'message_burst': 1,
+                                'bytes_per_second': None, 'byte_burst': None}
+        limiter = RateLimiter(config)
+        application = WebSocketConnectionLoggingMiddleware(chat_application())
+        with mock.patch('chat.middleware.rate_limiter', limiter):
+            client, _ = await self.connect('/ws/chat/rate-limit-test/', application)
+            await client.send_json_to({'message': 'first', 'username': 'tester'})
+            await client.send_json_to({'message': 'second', 'username': 'tester'})
+            self.assertEqual((await client.receive_json_from())['message'], 'first')
+            self.assertTrue(await client.receive_nothing(0.1))
+            await client.disconnect()
+        await close_buffers()
+        self.assertEqual(limiter.ip_buckets, {})
+        self.assertEqual(
+            await ChatMessage.objects.filter(room='rate-limit-test').acount(), 1
+        )
+
+    async def test_silent_heartbeat_clients_are_closed_with_4408(self):
+        application = WebSocketConnectionLoggingMiddleware(chat_application())
+        liveness = {'HEARTBEAT_INTERVAL_MS': 20, 'IDLE_TIMEOUT_MS': 50}
+        with self.settings(CHAT_CONNECTION_LIVENESS=liveness), \
+                mock.patch.object(connection_tracker, 'sweep_interval', 0.01):
+            client, _ = await self.connect('/ws/chat/idle-test/?heartbeat=1', application)
+            self.assertEqual((await client.receive_json_from())['type'], 'ping')
+            output = await client.receive_output(1)
+            while output['type'] == 'websocket.send':
+                output = await client.receive_output(1)
+            self.assertEqual(output, {'type': 'websocket.close', 'code': 4408})
+            await client.wait()
+        await close_buffers()
+        self.assertNotIn('/ws/chat/idle-test/', [
+            connection.path for connection in connection_tracker.connections.values()
+        ])
+
+    async def test_one_lifecycle_row_per_connection(self):
+        application = WebSocketConnectionLoggingMiddleware(chat_application())
+        client, _ = await self.connect('/ws/chat/lifecycle-test/', application)
+        for i in range(2):
+            await client.send_json_to({'message': f"message {i}", 'username': 'tester'})
+            await client.receive_json_from()
+        await client.disconnect(code=1000)
+        await close_buffers()
+
+        lifecycle = await ConnectionLifecycle.objects.aget(connection_path='/ws/chat/lifecycle-test/')
+        self.assertEqual(lifecycle.outcome, ConnectionLifecycle.OUTCOME_CLOSED)
+        self.assertTrue(lifecycle.successful)
+        self.assertEqual(lifecycle.close_code, 1000)
+        self.assertEqual((lifecycle.frames_in, lifecycle.frames_out), (2, 2))
+        self.assertGreater(lifecycle.bytes_in, 0)
+        self.assertIsNotNone(lifecycle.connected_at)
+        self.assertIsNotNone(lifecycle.closed_at)
+        self.assertLessEqual(lifecycle.first_message_at, lifecycle.last_message_at)
+        self.assertFalse(
+            await ConnectionAttempt.objects.filter(connection_path='/ws/chat/lifecycle-test/').aexists()
+        )
+
+    async def test_sampled_messages_are_traced_to_delivery(self):
+        with mock.patch.object(latency_tracer, 'sample_rate', 1):
+            client, _ = await self.connect('/ws/chat/trace-test/')
+            other, _ = await self.connect('/ws/chat/trace-test/')
+            delivered = len(latency_tracer.samples[STAGE_DELIVERED])
+            await client.send_json_to({'message': 'traced', 'username': 'tester'})
+            for communicator in (client, other):
+                frame = await communicator.receive_json_from()
+                # The trace stays on the server
+                self.assertNotIn(TRACE_KEY, frame)
+            self.assertEqual(len(latency_tracer.samples[STAGE_DELIVERED]), delivered + 2)
+            for communicator in (client, other):
+                await communicator.disconnect()
+        await close_buffers()
+
+    async def test_trace_starts_before_the_frame_is_decoded(self):
+        decoded_at = []
+        decode = JsonProtocol.decode
+
+        def slow_decode(protocol, **kwargs):
+            decoded_at.append(time.monotonic())
+            return decode(protocol, **kwargs)
+
+        with mock.patch.object(latency_tracer, 'sample_rate', 1), \
+                mock.patch.object(latency_tracer, 'start', wraps=latency_tracer.start) as start, \
+                mock.patch.object(JsonProtocol, 'decode', slow_decode):
+            client, _ = await self.connect('/ws/chat/trace-decode/')
+            await client.send_json_to({'message': 'traced', 'username': 'tester'})
+            await client.receive_json_from()
+            await client.disconnect()
+        await close_buffers()
+        (received_at,), _ = start.call_args
+        self.assertLessEqual(received_at, decoded_at[0])
+
+    async def test_batched_msgpack_frames_hold_an_array(self):
+        client, _ = await self.connect('/ws/chat/batch-test/?batch_size=2&batch_window_ms=50',
+                                       subprotocols=['chat.msgpack'])
+        for i in range(2):
+            await client.send_to(bytes_data=msgpack.packb({'message': f"message {i}", 'username': 'tester'}))
+        frame = msgpack.unpackb(await client.receive_from(), raw=False)
+        self.assertEqual([message['message'] for message in frame], ['message 0', 'message 1'])
+        await client.disconnect()
+        await close_buffers()
@@ -0,0 +1,92 @@
+import collections
+import random
+import socket
+import time
+
+from django.conf import settings
+
+from .benchmarking import latency_summary
+from .metrics import MESSAGE_STAGE_LATENCY
+
+# Key of the trace carried by sampled chat_message events
+TRACE_KEY = 'trace'
+
+# Stages a traced message goes through, in the order they usually happen.
+# With 'batched' durability the message is persisted after it's published.
+STAGE_RECEIVED = 'received'
+STAGE_PERSISTED = 'persisted'
+STAGE_PUBLISHED = 'published'
+STAGE_DELIVERED = 'delivered'
+STAGES = (STAGE_PERSISTED, STAGE_PUBLISHED, STAGE_DELIVERED)
+
+
+def tracing_settings():
+    options = getattr(settings, 'CHAT_LATENCY_TRACING', {})
+    return {
+        'sample_rate': options.get('SAMPLE_RATE', 0.01),
+        'window': options.get('WINDOW', 1000),
+    }
+
+
+class LatencyTracer:
+    """
+    Follows a sample of chat messages through the broadcast path.
+
+    A sampled message carries a dict of ``time.monotonic()`` timestamps in
+    its group event, starting with when ``ChatConsumer.receive`` got it.
+    Each later stage adds its own timestamp and records the time since
+    receive in the ``chat_message_stage_latency_seconds`` histogram and in a
+    window of recent samples for the diagnostics endpoint. Delivery is
+    recorded once per recipient, when its consumer handles the event.
+
+    Monotonic clocks are only comparable within one host, so delivery
+    times from other hosts sharing a channel layer are skipped.
+    """
+
+    def __init__(self, sample_rate=0.01, window=1000):
+        self.sample_rate = sample_rate
+        self.host = socket.gethostname()
+        self.samples = {stage: collections.deque(maxlen=window) for stage in STAGES}
+        self._histograms = {stage: MESSAGE_STAGE_LATENCY.labels(stage) for stage in STAGES}
+
+        # Counters
+        self.traced = 0
+        self.skipped = 0
+
+    def start(self, received_at=None):
+        """
+        Return a new trace for a received message, or None if it isn't
+        sampled. ``received_at`` is the ``time.monotonic()`` at which the
+        frame arrived, if it was taken before now.
+        """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        self.traced += 1
+        return {'host': self.host, STAGE_RECEIVED: time.monotonic() if received_at is None else received_at}
+
+    def mark(self, trace, stage):
+        """Record that a traced message reached ``stage``"""
+        if trace is None:
+            return
+        if trace.get('host') != self.host:
+            self.skipped += 1
+            return
+        now = time.monotonic()
+        if stage != STAGE_DELIVERED:
+            # Delivery happens once per recipient, on copies of the event
+            trace[stage] = now
+        elapsed = now - trace[STAGE_RECEIVED]
+        self._histograms[stage].observe(elapsed)
+        self.samples[stage].append(elapsed * 1000)
+
+    def stats(self):
+        return {
+            'sample_rate': self.sample_rate,
+            'traced': self.traced,
+            'skipped': self.skipped,
+            # Milliseconds since the message was received, over the last window of samples
+            'stages': {stage: latency_summary(list(samples)) for stage, samples in self.samples.items()},
+        }
+
+
+latency_tracer = LatencyTracer(**tracing_settings())
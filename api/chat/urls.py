@@ -4,4 +4,10 @@ from . import views
 urlpatterns = [
     path('status/', views.chat_status, name='chat_status'),
     path('diagnostics/', views.websocket_diagnostics, name='websocket_diagnostics'),
+    path('history/', views.chat_history, name='chat_history'),
+    path('metrics/', views.metrics, name='metrics'),
+    path('presence/', views.presence, name='presence'),
+    path('search/', views.search, name='search'),
+    path('export/messages/', views.export_chat_messages, name='export_chat_messages'),
+    path('export/connections/', views.export_connection_attempts, name='export_connection_attempts'),
 ]
\ No newline at end of file
@@ -1,18 +1,41 @@
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 import sys
 import os
+import functools
 import importlib
-import socket
 import json
 import channels
 import daphne
 import asgiref
 from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
 from django.middleware.csrf import get_token
-from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from django.utils import timezone
+from .buffers import get_connection_log_buffer
+from .diagnostics import handshake_probe, live_probes
+from .export import (
+    CHAT_MESSAGE_FIELDS,
+    CONNECTION_LIFECYCLE_FIELDS,
+    CONTENT_TYPES,
+    EXPORT_FORMATS,
+    filter_time_range,
+    iter_rows,
+    stream_rows,
+)
+from .history import decode_cursor, encode_cursor, fetch_history, history_settings, recent_messages
+from .liveness import connection_tracker
+from .metrics import registry
+from .models import ChatMessage, ConnectionLifecycle
+from .outbound import outbound_stats
+from .presence import presence_registry
+from .ratelimit import rate_limiter
+from .replay import message_sequencer
+from .rooms import DEFAULT_ROOM, room_registry
+from .search import fts_available, match_expression, search_messages, search_settings
+from .tracing import latency_tracer
+from .writer import db_writer
 
 # Create your views here.
 
@@ -25,75 +48,29 @@ def chat_status(request):
         "message": "Chat server is running"
     })
 
-def websocket_diagnostics(request):
+def metrics(request):
     """
-    A comprehensive diagnostics endpoint that checks the WebSocket server's status and configuration
+    In-process counters and histograms in the Prometheus text format.
+    Each worker process reports its own numbers.
+    """
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@functools.lru_cache(maxsize=None)
+def get_static_diagnostics():
+    """
+    Diagnostics that don't change while the server runs (versions, settings,
+    middleware). Collected once and reused by every request.
     """
-    # Set CORS headers for the preflight request
-    if request.method == "OPTIONS":
-        response = JsonResponse({})
-        response["Access-Control-Allow-Origin"] = "*"
-        response["Access-Control-Allow-Methods"] = "GET, OPTIONS"
-        response["Access-Control-Allow-Headers"] = "Content-Type"
-        return response
-    
-    # Get CSRF token to check if it's required for WebSocket connections
-    csrf_token = get_token(request)
-    
-    # Get the client's IP address
-    client_ip = get_client_ip(request)
-    
     # Check if channel layer is configured
     channel_layer_config = None
     channel_layer_available = False
     try:
-        channel_layer = get_channel_layer()
+        get_channel_layer()
         channel_layer_available = True
         channel_layer_config = settings.CHANNEL_LAYERS
     except Exception as e:
         channel_layer_available = False
     
-    # Test if we can communicate with the channel layer
-    channel_layer_test = None
-    try:
-        if channel_layer_available:
-            # Test sending a message to a test group
-            async_to_sync(channel_layer.group_add)("test_group", "test_channel")
-            async_to_sync(channel_layer.group_send)(
-                "test_group", 
-                {
-                    "type": "test.message",
-                    "text": "Hello from diagnositcs"
-                }
-            )
-            channel_layer_test = "Successfully sent test message to channel layer"
-    except Exception as e:
-        channel_layer_test = f"Error testing channel layer: {str(e)}"
-    
-    # Check if ASGI server port is open
-    asgi_port = getattr(settings, 'ASGI_PORT', 8001)
-    asgi_port_status = check_port_is_open('localhost', asgi_port)
-    
-    # Get recent connection attempts
-    from .models import ConnectionAttempt
-    recent_attempts = [
-        {
-            "client_ip": attempt.client_ip,
-            "timestamp": attempt.timestamp.isoformat(),
-            "user_agent": attempt.user_agent,
-            "successful": attempt.successful,
-            "error_message": attempt.error_message,
-            "connection_stage": attempt.connection_stage,
-            "connection_duration_ms": attempt.connection_duration_ms,
-            "close_code": attempt.close_code,
-            "connection_path": attempt.connection_path
-        }
-        for attempt in ConnectionAttempt.objects.order_by('-timestamp')[:20]
-    ]
-    
-    # Get connection statistics
-    connection_statistics = ConnectionAttempt.get_connection_statistics()
-    
     # Collect WebSocket configuration
     websocket_config = {
         "ASGI_APPLICATION": getattr(settings, 'ASGI_APPLICATION', None),
@@ -103,13 +80,7 @@ def websocket_diagnostics(request):
     }
     
     # Get middleware configuration
-    middleware_classes = []
-    
-    try:
-        for middleware in settings.MIDDLEWARE:
-            middleware_classes.append(middleware)
-    except:
-        pass
+    middleware_classes = list(getattr(settings, 'MIDDLEWARE', []))
         
     # Check for security settings
     security_settings = {
@@ -119,13 +90,6 @@ def websocket_diagnostics(request):
         "SESSION_COOKIE_SECURE": getattr(settings, 'SESSION_COOKIE_SECURE', None),
     }
     
-    # Check TLS/SSL configuration
-    tls_config = {
-        "using_https": request.is_secure(),
-        "x_forwarded_proto": request.META.get('HTTP_X_FORWARDED_PROTO', None),
-        "server_port": request.META.get('SERVER_PORT', None)
-    }
-    
     # Collect module versions
     versions = {
         "Python": sys.version,
@@ -141,56 +105,91 @@ def websocket_diagnostics(request):
         "Platform": sys.platform,
     }
     
-    # Create response with all diagnostics data
-    response_data = {
-        "status": "online",
-        "server_diagnostics": {
-            "client_ip": client_ip,
-            "csrf_enabled": csrf_token is not None,
-            "channel_layer_available": channel_layer_available,
-            "channel_layer_test": channel_layer_test,
-            "asgi_port_status": asgi_port_status,
-            "asgi_port": asgi_port,
-            "websocket_config": websocket_config,
-            "versions": versions,
-            "os_info": os_info,
-            "security_settings": security_settings,
-            "middleware_classes": middleware_classes,
-            "tls_config": tls_config,
-            "recent_connection_attempts": recent_attempts,
-            "connection_statistics": connection_statistics,
-            "server_time": timezone.now().isoformat()
-        }
+    return {
+        "channel_layer_available": channel_layer_available,
+        "asgi_port": getattr(settings, 'ASGI_PORT', 8001),
+        "websocket_config": websocket_config,
+        "versions": versions,
+        "os_info": os_info,
+        "security_settings": security_settings,
+        "middleware_classes": middleware_classes,
     }
+
+async def websocket_diagnostics(request):
+    """
+    A comprehensive diagnostics endpoint that checks the WebSocket server's status and configuration.
+    Live probes run concurrently with a timeout and are cached for DIAGNOSTICS_PROBE_CACHE_TTL seconds.
+    """
+    # Set CORS headers for the preflight request
+    if request.method == "OPTIONS":
+        response = JsonResponse({})
+        response["Access-Control-Allow-Origin"] = "*"
+        response["Access-Control-Allow-Methods"] = "GET, OPTIONS"
+        response["Access-Control-Allow-Headers"] = "Content-Type"
+        return response
     
-    # Send the response with CORS headers
-    response = JsonResponse(response_data)
-    response["Access-Control-Allow-Origin"] = "*"
-    return response
-        "Daphne": get_module_version('daphne'),
-        "ASGI": get_module_version('asgiref'),
-    }
+    # Get CSRF token to check if it's required for WebSocket connections
+    csrf_token = get_token(request)
     
-    # Collect OS info
-    os_info = {
-        "OS": os.name,
-        "Platform": sys.platform,
+    # Get the client's IP address
+    client_ip = get_client_ip(request)
+    
+    static_diagnostics = get_static_diagnostics()
+    if isinstance(request, ASGIRequest):
+        # Runs on its own schedule; this only reads its latest result
+        handshake_probe.ensure_started()
+    else:
+        # The request's loop ends with it, so a background task wouldn't survive
+        await handshake_probe.run_if_due()
+    probes, probes_cached = await live_probes.get()
+    
+    channel_layer_probe = probes["channel_layer"]
+    if channel_layer_probe["status"] == "ok":
+        channel_layer_test = channel_layer_probe["result"]
+    else:
+        channel_layer_test = f"Error testing channel layer: {channel_layer_probe['result'] or channel_layer_probe['status']}"
+    
+    asgi_port_probe = probes["asgi_port"]
+    asgi_port_status = asgi_port_probe["result"] if asgi_port_probe["status"] == "ok" else asgi_port_probe["status"]
+    
+    connection_log = probes["connection_log"]["result"] if probes["connection_log"]["status"] == "ok" else {}
+    
+    # Check TLS/SSL configuration
+    tls_config = {
+        "using_https": request.is_secure(),
+        "x_forwarded_proto": request.META.get('HTTP_X_FORWARDED_PROTO', None),
+        "server_port": request.META.get('SERVER_PORT', None)
     }
     
     # Create response with all diagnostics data
     response_data = {
         "status": "online",
         "server_diagnostics": {
+            **static_diagnostics,
             "client_ip": client_ip,
             "csrf_enabled": csrf_token is not None,
-            "channel_layer_available": channel_layer_available,
             "channel_layer_test": channel_layer_test,
             "asgi_port_status": asgi_port_status,
-            "asgi_port": asgi_port,
-            "websocket_config": websocket_config,
-            "versions": versions,
-            "os_info": os_info,
-            "recent_connection_attempts": recent_attempts
+            "websocket_probe": handshake_probe.stats(),
+            "tls_config": tls_config,
+            "recent_connection_attempts": connection_log.get("recent_connection_attempts", []),
+            "connection_statistics": connection_log.get("connection_statistics", {}),
+            "probes": {
+                name: {"status": probe["status"], "duration_ms": probe["duration_ms"]}
+                for name, probe in probes.items()
+            },
+            "probes_cached": probes_cached,
+            "log_buffer": get_connection_log_buffer().stats(),
+            "rooms": room_registry.stats(),
+            "presence": presence_registry.stats(),
+            "outbound_queues": outbound_stats(),
+            "rate_limits": rate_limiter.stats(),
+            "database_writer": db_writer.stats(),
+            "connection_tracking": connection_tracker.stats(),
+            "history_cache": recent_messages.stats(),
+            "message_replay": message_sequencer.stats(),
+            "latency_tracing": latency_tracer.stats(),
+            "server_time": timezone.now().isoformat()
         }
     }
     
@@ -199,6 +198,40 @@ def websocket_diagnostics(request):
     response["Access-Control-Allow-Origin"] = "*"
     return response
 
+def chat_history(request):
+    """
+    Return a page of a room's chat history, oldest message first.
+
+    Query parameters:
+        room: the room name (defaults to the default room)
+        limit: page size
+        before: cursor from a previous page's ``next_cursor`` to fetch older messages
+    """
+    history_config = history_settings()
+    room = request.GET.get('room', DEFAULT_ROOM)
+    try:
+        limit = int(request.GET.get('limit', history_config.get('PAGE_SIZE', 50)))
+        before = request.GET.get('before')
+        before = decode_cursor(before) if before else None
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    limit = max(1, min(limit, history_config.get('MAX_PAGE_SIZE', 200)))
+
+    page, cached = fetch_history(room, limit, before)
+    next_cursor = None
+    if len(page) == limit:
+        timestamp, message_id = page[0][0]
+        next_cursor = encode_cursor(timestamp, message_id)
+
+    response = JsonResponse({
+        "room": room,
+        "messages": [message for _, message in page],
+        "next_cursor": next_cursor,
+        "source": "cache" if cached else "database",
+    })
+    response["Access-Control-Allow-Origin"] = "*"
+    return response
+
 def get_client_ip(request):
     """Get the client's IP address from the request"""
     x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
@@ -215,16 +248,104 @@ def get_module_version(module_name):
     except ImportError:
         return 'not installed'
 
-def check_port_is_open(host, port):
-    """Check if a port is open on the given host"""
+async def presence(request):
+    """
+    Who is online, from the in-memory presence registry.
+
+    With ``?room=<name>`` returns that room's usernames and connection
+    counts, otherwise the online and connection totals of every room.
+    Runs on the event loop, next to the registry it reads.
+    """
+    room = request.GET.get('room')
+    if room:
+        data = presence_registry.room(room)
+    else:
+        data = {"rooms": presence_registry.rooms()}
+    response = JsonResponse(data)
+    response["Access-Control-Allow-Origin"] = "*"
+    return response
+
+def export_response(request, queryset, fields, name):
+    """
+    Stream ``queryset`` as NDJSON or CSV.
+
+    Query parameters:
+        format: ``ndjson`` (default) or ``csv``
+        since, until: ISO 8601 times, rows with since <= timestamp < until
+        gzip: ``1`` to gzip the output as it streams
+    """
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse(
+            {"error": f"Unknown format {export_format!r}, expected one of {', '.join(EXPORT_FORMATS)}"},
+            status=400
+        )
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(1)
-        result = s.connect_ex((host, port))
-        s.close()
-        if result == 0:
-            return "open"
-        else:
-            return f"closed (error code: {result})"
-    except Exception as e:
-        return f"error checking: {str(e)}"
+        queryset = filter_time_range(queryset, request.GET.get('since'), request.GET.get('until'))
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    compress = request.GET.get('gzip') in ('1', 'true')
+
+    filename = f"{name}.{export_format}"
+    content_type = CONTENT_TYPES[export_format]
+    if compress:
+        filename += ".gz"
+        content_type = "application/gzip"
+    # Each server gets the kind of iterator it can stream without buffering
+    # the whole export first
+    if isinstance(request, ASGIRequest):
+        rows = stream_rows(queryset, fields, export_format, compress)
+    else:
+        rows = iter_rows(queryset, fields, export_format, compress)
+    response = StreamingHttpResponse(rows, content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+def export_chat_messages(request):
+    """Stream chat messages, optionally only those of one ``room``"""
+    queryset = ChatMessage.objects.all()
+    room = request.GET.get('room')
+    if room:
+        queryset = queryset.filter(room=room)
+    return export_response(request, queryset, CHAT_MESSAGE_FIELDS, "chat_messages")
+
+def export_connection_attempts(request):
+    """Stream the connection log, one row per connection, optionally only those for one ``path``"""
+    queryset = ConnectionLifecycle.objects.all()
+    path = request.GET.get('path')
+    if path:
+        queryset = queryset.filter(connection_path=path)
+    return export_response(request, queryset, CONNECTION_LIFECYCLE_FIELDS, "connection_attempts")
+
+def search(request):
+    """
+    Full-text search over chat messages, best match first.
+
+    Query parameters:
+        q: the words to search for, all of which must match. A trailing
+           ``*`` matches any word starting with the given prefix.
+        room: only search this room
+        limit, offset: page size and position
+    """
+    query = request.GET.get('q', '').strip()
+    if not match_expression(query):
+        return JsonResponse({"error": "Missing search query q"}, status=400)
+    config = search_settings()
+    try:
+        limit = int(request.GET.get('limit', config['page_size']))
+        offset = max(0, int(request.GET.get('offset', 0)))
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    limit = max(1, min(limit, config['max_page_size']))
+    room = request.GET.get('room')
+
+    indexed = fts_available()
+    results = search_messages(query, room=room, limit=limit, offset=offset, indexed=indexed)
+    response = JsonResponse({
+        "query": query,
+        "room": room,
+        "results": results,
+        "indexed": indexed,
+    })
+    response["Access-Control-Allow-Origin"] = "*"
+    return response
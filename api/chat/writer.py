@@ -0,0 +1,161 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import queue
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+
+def writer_settings():
+    options = getattr(settings, 'DATABASE_WRITER', {})
+    return {
+        'enabled': options.get('ENABLED', True),
+        'max_batch': options.get('MAX_BATCH', 500),
+    }
+
+
+class DatabaseWriter:
+    """
+    The one thread in this process that writes to the database.
+
+    Write operations from the event loop are queued to a dedicated thread,
+    which owns its own database connection and runs them in order. Each
+    time it wakes up it takes everything queued, up to ``max_batch``
+    operations, and runs them in a single transaction, so a burst of
+    writes costs one commit. Every operation runs in its own savepoint: one
+    that raises is rolled back alone and its caller gets the exception,
+    while the others still commit. Callers are only resumed once their
+    operation is committed.
+
+    Reads keep using the connections of the threads they run on, which
+    with SQLite in WAL mode never wait for the writer.
+    """
+
+    def __init__(self, enabled=True, max_batch=500):
+        self.enabled = enabled
+        self.max_batch = max_batch
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        # Counters
+        self.operations = 0
+        self.transactions = 0
+        self.retried = 0
+        self.errors = 0
+        self.largest_batch = 0
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue ``fn(*args, **kwargs)`` and return a Future for its result"""
+        self._ensure_started()
+        future = concurrent.futures.Future()
+        self._queue.put((fn, args, kwargs, future))
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """Run a write operation on the writer thread and wait for it to commit"""
+        if not self.enabled:
+            return await sync_to_async(fn)(*args, **kwargs)
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='chat-db-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.largest_batch = max(self.largest_batch, len(batch))
+            try:
+                self._execute(batch)
+            except Exception:
+                # Never let the thread die with operations waiting on it
+                logger.exception("Database writer failed to run %d operations", len(batch))
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError("Database writer failed"))
+
+    def _execute(self, batch):
+        try:
+            with transaction.atomic():
+                for operation in batch:
+                    self._call(operation)
+            self.transactions += 1
+        except Exception:
+            # The commit itself failed, so nothing in the batch was written.
+            # Run what's left one transaction at a time.
+            logger.exception("Group commit of %d operations failed, retrying them one by one", len(batch))
+            for operation in batch:
+                if operation[3].done():
+                    continue
+                self.retried += 1
+                try:
+                    with transaction.atomic():
+                        self._call(operation)
+                    self.transactions += 1
+                except Exception as e:
+                    self.errors += 1
+                    if not operation[3].done():
+                        operation[3].set_exception(e)
+        # The connection is kept open between batches, unless it broke
+        if connection.errors_occurred:
+            if not connection.is_usable():
+                connection.close()
+            connection.errors_occurred = False
+
+    def _call(self, operation):
+        fn, args, kwargs, future = operation
+        # Already running when retried after a failed group commit
+        if not future.running() and not future.set_running_or_notify_cancel():
+            return
+        self.operations += 1
+        try:
+            with transaction.atomic():
+                result = fn(*args, **kwargs)
+        except Exception as e:
+            self.errors += 1
+            future.set_exception(e)
+        else:
+            transaction.on_commit(functools.partial(future.set_result, result))
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'running': self._thread is not None and self._thread.is_alive(),
+            'queue_depth': self._queue.qsize(),
+            'operations': self.operations,
+            'transactions': self.transactions,
+            'retried': self.retried,
+            'errors': self.errors,
+            'largest_batch': self.largest_batch,
+        }
+
+
+db_writer = DatabaseWriter(**writer_settings())
+
+
+def write_operation(fn):
+    """
+    Decorator turning a synchronous function that writes to the database
+    into a coroutine that runs it on the writer thread, in the manner of
+    ``database_sync_to_async``.
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await db_writer.run(fn, *args, **kwargs)
+    return wrapper